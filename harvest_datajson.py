@@ -16,6 +16,10 @@ parser.add_argument("--catalog_url", type=str, help="URL for write CKAN API", re
 parser.add_argument("--ckan_api_key", type=str, help="API KEY working at CKAN instance", required=True)
 parser.add_argument("--limit_datasets", type=int, default=0, help="Limit datasets to harvest on each source. Defualt=0 => no limit")
 parser.add_argument("--config", type=str, help="Configuration of source, str-dict (validation_schema, default_groups, etc)")
+parser.add_argument("--resume", action='store_true', help="Resume the write stage of a previous (unfinished) harvest")
+parser.add_argument("--fused", action='store_true', help="Download, compare and write in one pipeline (no intermediate files)")
+parser.add_argument("--save_debug_files", action='store_true',
+                    help="In fused mode, also save the download and compare results")
 
 logger.info('Start a DataJSON harvest process')
 
@@ -25,24 +29,49 @@ args = parser.parse_args()
 destination = CKANHarvestDestination(catalog_url=args.catalog_url,
                                      api_key=args.ckan_api_key,
                                      organization_id=args.ckan_owner_org_id,
-                                     harvest_source_id=args.harvest_source_id)
+                                     harvest_source_id=args.harvest_source_id,
+                                     config=args.config)
 
 logger.info(f'Harvest source: CKAN {args.url}')
 logger.info(f'Harvest Destination: CKAN {args.catalog_url}')
 
 hdj = HarvestDataJSON(name=args.name,
                       url=args.url,
-                      destination=destination)
+                      destination=destination,
+                      config=args.config)
 hdj.limit_datasets = args.limit_datasets
 
-logger.info('Downloading from source')
-res = hdj.download()
-hdj.save_download_results(flow_results=res)
-logger.info('Comparing data')
-res = hdj.compare()
-hdj.save_compare_results(flow_results=res)
-logger.info('Writting results at destination')
-res = hdj.write_destination()
-hdj.save_write_results(flow_results=res)
+if args.resume and not hdj.can_resume():
+    logger.warning('Unable to resume: the write journal or the compare results of a previous harvest '
+                   f'are missing at {hdj.get_base_path()}. Running a full harvest instead')
+
+if args.resume and hdj.can_resume():
+    # use the previous compare results, skip the actions already written
+    logger.info('Resuming the write stage')
+    res = hdj.write_destination(resume=True, keep_results=False)
+    hdj.save_write_results(flow_results=res)
+elif args.fused:
+    logger.info('Harvesting (download, compare and write)')
+    res = hdj.harvest(save_debug_files=args.save_debug_files, keep_results=False)
+    if hdj.source_unchanged:
+        logger.info('No changes in the source since the last harvest')
+    else:
+        hdj.save_write_results(flow_results=res)
+else:
+    logger.info('Downloading from source')
+    # results are saved as JSON lines, we don't need them in memory
+    res = hdj.download(keep_results=False)
+    if hdj.source_unchanged:
+        # skip compare and write stages
+        logger.info('No changes in the source since the last harvest')
+    else:
+        hdj.save_download_results(flow_results=res)
+        logger.info('Comparing data')
+        res = hdj.compare(keep_results=False)
+        hdj.save_compare_results(flow_results=res)
+        logger.info('Writting results at destination')
+        res = hdj.write_destination(keep_results=False)
+        hdj.save_write_results(flow_results=res)
 logger.info('Writting final report')
 hdj.write_final_report()
+destination.close()
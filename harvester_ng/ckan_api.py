@@ -0,0 +1,527 @@
+""" CKAN API client with a long-lived HTTP session
+    The harvester_adapters CKANPortalAPI opens a new connection for each request.
+    Here we keep a pool of keep-alive connections to the catalog (shared by all the
+    write steps in a harvest run) and we use timeouts for all the requests.
+    Requests are throttled and retried when the catalog is overloaded """
+import json
+import logging
+import threading
+import time
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from harvester_adapters.ckan.api import CKANPortalAPI
+from harvester_ng.ckan_diff import get_changed_fields
+from harvester_ng.logs import logger
+from harvester_ng.throttle import AdaptiveThrottle, CircuitBreaker, backoff_delay
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10  # seconds
+DEFAULT_READ_TIMEOUT = 300  # seconds. Big packages are slow to save
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 0.5  # seconds
+DEFAULT_BACKOFF_MAX = 60  # seconds
+DEFAULT_BREAKER_FAILURES = 5  # consecutive failures to pause all the requests
+DEFAULT_BREAKER_PAUSE = 30  # seconds
+
+# the catalog is overloaded or restarting, it's safe to try again
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+# the catalog didn't apply the request, it's safe to send a write action again
+WRITE_RETRY_STATUS_CODES = [429, 503]
+
+# package fields we need to compare with the source (slim listing)
+SLIM_FIELDS = ['id', 'name', 'metadata_modified', 'extras_identifier', 'extras_source_hash']
+
+
+def is_connect_error(error):
+    """ the request was never sent (we couldn't connect to the catalog) """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and len(error.args) > 0:
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+def normalize_slim_package(result):
+    """ a package_search result with just the SLIM_FIELDS ("fl" param)
+        in the same format (extras list) of a full package """
+    package = {'extras': []}
+    for key, value in result.items():
+        if key.startswith('extras_'):
+            if type(value) == list:  # multivalued at Solr
+                value = value[0]
+            package['extras'].append({'key': key[len('extras_'):], 'value': value})
+        else:
+            package[key] = value
+    return package
+
+
+class CKANSessionAPI(CKANPortalAPI):
+    """ CKANPortalAPI using a pooled requests session """
+    package_patch_url = '/api/3/action/package_patch'
+
+    def __init__(self, base_url='https://catalog.data.gov', api_key=None,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_base=DEFAULT_BACKOFF_BASE,
+                 backoff_max=DEFAULT_BACKOFF_MAX,
+                 breaker_failures=DEFAULT_BREAKER_FAILURES,
+                 breaker_pause=DEFAULT_BREAKER_PAUSE):
+        super().__init__(base_url=base_url, api_key=api_key)
+        # at CKANPortalAPI these are class attributes (shared by all instances).
+        # We don't keep the listed packages here, memory would grow with the source
+        self.package_list = []
+        self.total_packages = 0
+
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        # block (instead of opening extra connections) if all the pool is in use
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.throttle = AdaptiveThrottle(max_limit=pool_size)
+        self.circuit_breaker = CircuitBreaker(max_failures=breaker_failures, pause=breaker_pause)
+        self.stats = {'requests': 0, 'retries': 0, 'retried_requests': 0, 'gave_up': 0}
+        self.stats_lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
+
+    def count(self, key, value=1):
+        with self.stats_lock:
+            self.stats[key] += value
+
+    def get_stats(self):
+        """ retries, throttle and circuit breaker state """
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['throttle'] = self.throttle.get_stats()
+        stats['circuit_breaker'] = self.circuit_breaker.get_stats()
+        return stats
+
+    def get_retry_delay(self, req, attempt):
+        """ seconds to wait before retry. Respect the Retry-After header (in seconds) """
+        if req is not None and req.headers.get('Retry-After', '').isdigit():
+            return min(self.backoff_max, int(req.headers['Retry-After']))
+        return backoff_delay(attempt, base=self.backoff_base, max_delay=self.backoff_max)
+
+    def request(self, method, url, idempotent=True, retry_state=None, **kwargs):
+        """ throttled HTTP request to the catalog.
+            Connection errors and RETRY_STATUS_CODES are retried with backoff.
+            Not idempotent requests (write actions) are just retried if they were never
+            sent (connect errors) or the catalog rejected them (WRITE_RETRY_STATUS_CODES),
+            other errors are returned at once (see post_write).
+            retry_state: dict with the retries already done for this request
+            Returns the last response (or raise the last connection error) """
+        state = retry_state if retry_state is not None else {'attempt': 0}
+        if state['attempt'] == 0:
+            self.count('requests')
+        while True:
+            self.circuit_breaker.wait()
+            self.throttle.acquire()
+            start = time.monotonic()
+            req = None
+            error = None
+            try:
+                req = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                self.throttle.release()
+
+            if error is None and req.status_code not in RETRY_STATUS_CODES:
+                # each CKAN action has its own baseline latency (e.g. deletes are faster than creates)
+                action = url.split('?')[0].rstrip('/').split('/')[-1]
+                self.throttle.on_success(latency=time.monotonic() - start, key=action)
+                self.circuit_breaker.on_success()
+                return req
+
+            self.throttle.on_error()
+            self.circuit_breaker.on_failure()
+            reason = error if error is not None else f'HTTP {req.status_code}'
+            if not idempotent and not self.never_applied(req, error):
+                logger.info(f'{method} {url} failed: {reason}. The catalog could have applied it, not retried')
+                if error is not None:
+                    raise error
+                return req
+            if state['attempt'] >= self.max_retries:
+                self.count('gave_up')
+                logger.error(f'{method} {url} failed after {state["attempt"]} retries: {reason}')
+                if error is not None:
+                    raise error
+                return req
+
+            delay = self.add_retry(req, state)
+            logger.info(f'{method} {url} failed ({reason}). Retry {state["attempt"]}/{self.max_retries} in {delay:.2f}s')
+            time.sleep(delay)
+
+    def add_retry(self, req, state):
+        """ count a new retry. Returns the seconds to wait before it """
+        state['attempt'] += 1
+        self.count('retries')
+        if state['attempt'] == 1:
+            self.count('retried_requests')
+        return self.get_retry_delay(req, state['attempt'])
+
+    def never_applied(self, req, error):
+        """ a failed request the catalog didn't apply (safe to send again) """
+        if error is not None:
+            return is_connect_error(error)
+        return req.status_code in WRITE_RETRY_STATUS_CODES
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def post_write(self, url, check, **kwargs):
+        """ POST a write action (create, update, patch or delete).
+            If the catalog could have applied it (e.g. read timeout, HTTP 502 or 504)
+            we don't send it again at once: "check" re-reads the package and returns the
+            JSON content for the action if it's already done (or None to send it again).
+            Returns: the last response, the JSON content from "check" (None if not used) """
+        state = {'attempt': 0}
+        while True:
+            req = None
+            error = None
+            try:
+                req = self.request('POST', url, idempotent=False, retry_state=state, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if error is None and req.status_code not in RETRY_STATUS_CODES:
+                return req, None
+            if self.never_applied(req, error) or state['attempt'] >= self.max_retries:
+                if not self.never_applied(req, error):
+                    # (request() already retried the other errors)
+                    self.count('gave_up')
+                    logger.error(f'POST {url} failed after {state["attempt"]} retries')
+                if error is not None:
+                    raise error
+                return req, None
+
+            time.sleep(self.add_retry(req, state))
+            done = check()
+            if done is not None:
+                logger.info(f'POST {url} was applied by the catalog, not sent again')
+                return req, done
+            logger.info(f'POST {url} was not applied. Retry {state["attempt"]}/{self.max_retries}')
+
+    def get_package_or_none(self, ckan_package_id_or_name):
+        """ package_show result. None if the package does not exist """
+        url = '{}{}'.format(self.base_url, self.package_show_url)
+        headers = self.get_request_headers(include_api_key=True)
+        req = self.get(url, params={'id': ckan_package_id_or_name}, headers=headers)
+        if req.status_code == 404:
+            return None
+        return self.read_json_content(req, error_message='ERROR showing CKAN package')['result']
+
+    def check_package_saved(self, ckan_package_id_or_name, ckan_package):
+        """ "check" for post_write: the saved package is like "ckan_package" """
+        existing = self.get_package_or_none(ckan_package_id_or_name)
+        if existing is None or len(get_changed_fields(existing, ckan_package)) > 0:
+            return None
+        return {'success': True, 'result': existing}
+
+    def read_json_content(self, req, error_message):
+        """ parse and check a CKAN API response.
+            Returns: JSON content """
+        content = req.content
+        if req.status_code >= 400:
+            error = '{}: {} \n\t Status code: {} \n\t content:{}'.format(error_message, req.url, req.status_code, content)
+            logger.error(error)
+            raise Exception(error)
+
+        try:
+            json_content = json.loads(content)
+        except Exception as e:
+            error = 'ERROR parsing JSON data: {} [{}]'.format(content, e)
+            raise ValueError(error)
+
+        if not json_content['success']:
+            error = 'API response failed: {}'.format(json_content.get('error', None))
+            logger.error(error)
+
+        return json_content
+
+    def search_page(self, start, rows, method='POST', harvest_source_id=None,
+                    harvest_type=None, source_type=None, sort=None, fl=None, fq=None,
+                    modified_since=None):
+        """ get one page of harvested packages or harvest sources
+            Params:
+                fl: list of fields to get (instead of full packages)
+                fq: custom filter query (instead of harvest_source_id or harvest_type)
+                modified_since: Solr date. Just packages modified since this date (included)
+            Returns: the package_search result (count and results) """
+        url = '{}{}'.format(self.base_url, self.package_search_url)
+        params = {'start': start, 'rows': rows}
+        if sort is not None:
+            params['sort'] = sort
+        if fl is not None:
+            params['fl'] = fl  # sent as a list (repeated param)
+        if fq is not None:
+            params['fq'] = fq
+        elif harvest_source_id is not None:
+            params['fq'] = f'+harvest_ng_source_id:"{harvest_source_id}"'
+        elif harvest_type is not None:
+            params['fq'] = f'+dataset_type:{harvest_type}'
+            if source_type is not None:
+                params['q'] = f'(type:{harvest_type} source_type:{source_type})'
+            else:
+                params['q'] = f'(type:{harvest_type})'
+        if modified_since is not None:
+            params['fq'] = '{} +metadata_modified:[{} TO *]'.format(params.get('fq', ''), modified_since).strip()
+
+        logger.info(f'Searching {url} start:{start}, rows:{rows} with params: {params}')
+
+        headers = self.get_request_headers()
+        try:
+            if method == 'POST':  # depend on CKAN version
+                req = self.post(url, data=params, headers=headers)
+            else:
+                req = self.get(url, params=params, headers=headers)
+        except Exception as e:
+            raise ValueError('Failed to get package list at {} [{}]'.format(url, e))
+
+        json_content = self.read_json_content(req, error_message='ERROR searching CKAN package')
+        if not json_content['success']:
+            raise ValueError('API response failed: {}'.format(json_content.get('error', None)))
+
+        return json_content['result']
+
+    def search_harvest_packages(self, rows=1000, method='POST', harvest_source_id=None,
+                                harvest_type=None, source_type=None, fl=None, modified_since=None, sort=None):
+        """ search harvested packages or harvest sources
+            "rows" is the page size.
+            You could search for an specific harvest_source_id """
+
+        start = 0
+        while True:
+            result = self.search_page(start=start, rows=rows, method=method,
+                                      harvest_source_id=harvest_source_id,
+                                      harvest_type=harvest_type,
+                                      source_type=source_type,
+                                      fl=fl,
+                                      sort=sort,
+                                      modified_since=modified_since)
+            results = result['results']
+            self.total_packages += len(results)
+            logger.info(f'{len(results)} results')
+
+            if len(results) == 0:
+                break
+            start += rows
+            yield(results)
+
+    def timed_search_page(self, **kwargs):
+        """ Returns: package_search result, seconds """
+        start = time.monotonic()
+        result = self.search_page(**kwargs)
+        return result, time.monotonic() - start
+
+    def search_harvest_packages_in_parallel(self, harvest_source_id, workers=4, rows=1000,
+                                            min_rows=100, max_rows=1000, page_seconds=5,
+                                            method='POST', fl=None, modified_since=None):
+        """ search harvested packages requesting up to "workers" pages at once.
+            The first page gives us the total count. Pages are sorted by ID (so the
+            pages don't change between requests) and yielded in order.
+            The page size ("rows") adapts to get pages in about "page_seconds" """
+
+        search = dict(method=method, harvest_source_id=harvest_source_id, sort='id asc', fl=fl,
+                      modified_since=modified_since)
+        result, seconds = self.timed_search_page(start=0, rows=rows, **search)
+        count = result['count']
+        results = result['results']
+        if len(results) < rows and len(results) < count:
+            # CKAN limits the page size (ckan.search.rows_max)
+            max_rows = len(results)
+        rows = self.adapt_page_size(rows, seconds, min_rows, max_rows, page_seconds)
+        next_start = len(results)
+        self.total_packages += len(results)
+        if len(results) > 0:
+            yield results
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = deque()  # (start, rows, future) sorted by start
+        try:
+            while next_start < count or len(pending) > 0:
+                while next_start < count and len(pending) < workers:
+                    future = executor.submit(self.timed_search_page, start=next_start, rows=rows, **search)
+                    pending.append((next_start, rows, future))
+                    next_start += rows
+
+                start, page_rows, future = pending.popleft()
+                result, seconds = future.result()
+                count = result['count']
+                results = result['results']
+                if 0 < len(results) < page_rows and start + len(results) < count:
+                    # we get less than requested, ask again for the missing packages
+                    max_rows = len(results)
+                    missing_start = start + len(results)
+                    future = executor.submit(self.timed_search_page, start=missing_start,
+                                             rows=page_rows - len(results), **search)
+                    pending.appendleft((missing_start, page_rows - len(results), future))
+
+                rows = self.adapt_page_size(rows, seconds, min_rows, max_rows, page_seconds)
+                logger.info(f'Page at {start}: {len(results)} results in {seconds:.2f}s. Next page size: {rows}')
+                self.total_packages += len(results)
+                if len(results) > 0:
+                    yield results
+        finally:
+            # the listing could stop before the end, don't request more pages
+            for start, page_rows, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def show_packages(self, ckan_ids):
+        """ get a list of full packages in one request
+            Returns: dict (CKAN ID: package). Packages not found are not included """
+        ids = ' OR '.join([f'"{ckan_id}"' for ckan_id in ckan_ids])
+        result = self.search_page(start=0, rows=len(ckan_ids), fq=f'id:({ids})')
+        return {package['id']: package for package in result['results']}
+
+    def adapt_page_size(self, rows, seconds, min_rows, max_rows, page_seconds):
+        """ new page size to get a page in about "page_seconds" (at most x2 or /2 each time) """
+        factor = page_seconds / max(seconds, 0.001)
+        factor = min(2, max(0.5, factor))
+        return min(max_rows, max(min_rows, int(rows * factor)))
+
+    def create_package(self, ckan_package, on_duplicated='RAISE'):
+        """ POST to CKAN API to create a new package/dataset
+            Params:
+             - ckan_package: a dict with with a ready-to-save package
+             - on_duplicated (str): action to take where the package already exists:
+               + RAISE: raise an error
+               + SKIP: returns show_package results
+               + DELETE: remove the package and try to create again
+               + UPSERT: update the existing package (keeps the CKAN ID)
+            The response includes "on_duplicated" if the package already existed """
+        url = '{}{}'.format(self.base_url, self.package_create_url)
+        headers = self.get_request_headers(include_api_key=True)
+        headers['Content-Type'] = 'application/json'
+
+        logger.info(f'POST {url} data:{ckan_package}')
+        req, done = self.post_write(url, data=json.dumps(ckan_package), headers=headers,
+                                    check=lambda: self.check_package_saved(ckan_package['name'], ckan_package))
+        if done is not None:
+            return done
+
+        content = req.content
+        try:
+            json_content = json.loads(content)
+        except Exception as e:
+            error = 'ERROR parsing JSON data: {} [{}]'.format(content, e)
+            logger.error(error)
+            raise
+
+        if req.status_code == 409:
+            logger.info(f'409 json_content: {json_content}')
+            name_errors = json_content['error'].get('name', [])
+            dataset_exists = len([ne for ne in name_errors if "That URL is already in use" in ne]) > 0
+            if dataset_exists:
+                logger.error(f'Already exists! ACTION: {on_duplicated}')
+                if on_duplicated == 'SKIP':
+                    response = self.show_package(ckan_package_id_or_name=ckan_package['name'])
+                elif on_duplicated == 'DELETE':
+                    delr = self.delete_package(ckan_package_id_or_name=ckan_package['name'])
+                    if not delr['success']:
+                        raise Exception('Failed to delete {}'.format(ckan_package['name']))
+                    response = self.create_package(ckan_package=ckan_package, on_duplicated='RAISE')
+                elif on_duplicated == 'UPSERT':
+                    response = self.upsert_package(ckan_package=ckan_package)
+                else:
+                    response = None
+
+                if response is not None:
+                    response['on_duplicated'] = on_duplicated
+                    return response
+
+        return self.read_json_content(req, error_message='ERROR creating CKAN package')
+
+    def upsert_package(self, ckan_package):
+        """ update the existing package with the same name (instead of creating it).
+            Resources with the same URL keep their IDs """
+        existing = self.show_package(ckan_package_id_or_name=ckan_package['name'])['result']
+        existing_resources = {resource['url']: resource['id'] for resource in existing.get('resources', [])}
+        resources = []
+        for resource in ckan_package.get('resources', []):
+            if 'id' not in resource and resource.get('url', None) in existing_resources:
+                resource = dict(resource, id=existing_resources[resource['url']])
+            resources.append(resource)
+        ckan_package = dict(ckan_package, id=existing['id'], resources=resources)
+        return self.update_package(ckan_package=ckan_package)
+
+    def update_package(self, ckan_package):
+        """ POST to CKAN API to update a package/dataset """
+        url = '{}{}'.format(self.base_url, self.package_update_url)
+        headers = self.get_request_headers(include_api_key=True)
+        headers['Content-Type'] = 'application/json'
+
+        id_or_name = ckan_package.get('id', ckan_package.get('name', None))
+        logger.info(f'POST {url} data:{ckan_package}')
+        req, done = self.post_write(url, data=json.dumps(ckan_package), headers=headers,
+                                    check=lambda: self.check_package_saved(id_or_name, ckan_package))
+        if done is not None:
+            return done
+        return self.read_json_content(req, error_message='ERROR updating CKAN package')
+
+    def patch_package(self, ckan_package):
+        """ POST to CKAN API to update just some fields of a package/dataset.
+            Other fields are not changed. Lists (extras, resources) are fully replaced """
+        url = '{}{}'.format(self.base_url, self.package_patch_url)
+        headers = self.get_request_headers(include_api_key=True)
+        headers['Content-Type'] = 'application/json'
+
+        def check():
+            existing = self.get_package_or_none(ckan_package['id'])
+            if existing is None or len(get_changed_fields(existing, dict(existing, **ckan_package))) > 0:
+                return None
+            return {'success': True, 'result': existing}
+
+        logger.info(f'POST {url} data:{ckan_package}')
+        req, done = self.post_write(url, data=json.dumps(ckan_package), headers=headers, check=check)
+        if done is not None:
+            return done
+        return self.read_json_content(req, error_message='ERROR patching CKAN package')
+
+    def delete_package(self, ckan_package_id_or_name):
+        """ POST to CKAN API to delete a package/dataset """
+        url = '{}{}'.format(self.base_url, self.package_delete_url)
+        headers = self.get_request_headers(include_api_key=True)
+        data = {'id': ckan_package_id_or_name}
+
+        def check():
+            existing = self.get_package_or_none(ckan_package_id_or_name)
+            if existing is None or existing.get('state', None) == 'deleted':
+                return {'success': True, 'result': None}
+            return None
+
+        logger.info(f'POST {url} data:{data}')
+        req, done = self.post_write(url, data=data, headers=headers, check=check)
+        if done is not None:
+            return done
+        return self.read_json_content(req, error_message='ERROR deleting CKAN package')
+
+    def show_package(self, ckan_package_id_or_name):
+        """ GET to CKAN API to show a package/dataset """
+        url = '{}{}'.format(self.base_url, self.package_show_url)
+        headers = self.get_request_headers(include_api_key=True)
+        data = {'id': ckan_package_id_or_name}
+
+        logger.info(f'GET {url} data:{data}')
+        req = self.get(url, params=data, headers=headers)
+        return self.read_json_content(req, error_message='ERROR showing CKAN package')
@@ -0,0 +1,103 @@
+""" Compare CKAN packages
+    Detect the fields that really change between an existing CKAN package
+    (from package_show or package_search) and a new one we want to save.
+    Fields managed by CKAN (IDs, dates, counters), empty values and the
+    order of tags, extras and resources are not changes """
+import json
+
+
+# fields managed by CKAN (or by the harvester at other steps)
+VOLATILE_FIELDS = ['id', 'metadata_created', 'metadata_modified', 'revision_id',
+                   'num_resources', 'num_tags', 'creator_user_id', 'organization',
+                   'groups', 'relationships_as_object', 'relationships_as_subject',
+                   'tracking_summary', 'isopen', 'license_title', 'license_url', 'type',
+                   'tag_string',  # merged with tags
+                   'comparison_results']  # harvester data in the same row
+# the source hash changes with the data.json dataset even if the CKAN package does not
+VOLATILE_EXTRAS = ['source_hash']
+VOLATILE_RESOURCE_FIELDS = ['id', 'package_id', 'position', 'created', 'last_modified',
+                            'metadata_modified', 'revision_id', 'cache_url', 'cache_last_updated',
+                            'hash', 'size', 'state', 'datastore_active', 'url_type',
+                            'mimetype_inner', 'resource_type', 'webstore_url',
+                            'webstore_last_updated', 'tracking_summary', 'has_views']
+
+
+def is_empty(value):
+    return value is None or value == '' or value == [] or value == {}
+
+
+def normalize_value(value):
+    """ CKAN saves extras values as strings """
+    return value if type(value) == str else str(value)
+
+
+def normalize_resource(resource):
+    return {key: value for key, value in resource.items()
+            if key not in VOLATILE_RESOURCE_FIELDS and not is_empty(value)}
+
+
+def normalize_package(package, volatile_extras=VOLATILE_EXTRAS):
+    """ comparable version of a CKAN package (a dict) """
+    normalized = {key: value for key, value in package.items()
+                  if key not in VOLATILE_FIELDS and not is_empty(value)}
+
+    tags = set(tag['name'] for tag in package.get('tags', None) or [])
+    tag_string = package.get('tag_string', None) or ''
+    tags.update(tag.strip() for tag in tag_string.split(',') if tag.strip() != '')
+    normalized['tags'] = sorted(tags)
+
+    normalized['extras'] = {extra['key']: normalize_value(extra['value'])
+                            for extra in package.get('extras', None) or []
+                            if extra['key'] not in volatile_extras and not is_empty(extra['value'])}
+
+    resources = [normalize_resource(resource) for resource in package.get('resources', None) or []]
+    normalized['resources'] = sorted(resources, key=lambda resource: json.dumps(resource, sort_keys=True))
+
+    return normalized
+
+
+def get_changed_fields(existing_package, new_package):
+    """ list of top level fields that differ between two CKAN packages.
+        Empty if saving the new package changes nothing """
+    volatile_extras = VOLATILE_EXTRAS
+    new_extras = [extra['key'] for extra in new_package.get('extras', None) or []]
+    if 'collection_package_id' not in new_extras:
+        # the collection ID is unknown when writing this package (see assing_collection_pkg_id)
+        volatile_extras = volatile_extras + ['collection_package_id']
+    existing = normalize_package(existing_package, volatile_extras=volatile_extras)
+    new = normalize_package(new_package, volatile_extras=volatile_extras)
+
+    # the new package could use the organization name as owner_org
+    organization = existing_package.get('organization', None) or {}
+    if new.get('owner_org', None) in [organization.get('name', None), organization.get('id', None)]:
+        new['owner_org'] = existing.get('owner_org', None)
+
+    fields = set(existing.keys()) | set(new.keys())
+    return sorted(field for field in fields if existing.get(field, None) != new.get(field, None))
+
+
+def get_package_patch(existing_package, new_package, changed_fields):
+    """ package_patch data to save the changed fields of the new package.
+        CKAN replaces the full lists (extras and resources), we send them just if they changed """
+    patch = {'id': existing_package['id']}
+    for field in changed_fields:
+        if field == 'tags':
+            tags = normalize_package(new_package)['tags']
+            patch['tags'] = [{'name': tag} for tag in tags]
+        elif field in new_package:
+            patch[field] = new_package[field]
+        else:
+            # removed at the new package
+            patch[field] = [] if type(existing_package[field]) == list else ''
+
+    # we always need the new source hash (used to compare at the next harvest)
+    new_extras = {extra['key']: extra['value'] for extra in new_package.get('extras', [])}
+    existing_extras = {extra['key']: extra['value'] for extra in existing_package.get('extras', None) or []}
+    if 'extras' in patch or new_extras.get('source_hash', None) != existing_extras.get('source_hash', None):
+        extras = list(new_package.get('extras', []))
+        # keep the collection ID, it is not at the new package
+        if 'collection_package_id' in existing_extras and 'collection_package_id' not in new_extras:
+            extras.append({'key': 'collection_package_id', 'value': existing_extras['collection_package_id']})
+        patch['extras'] = extras
+
+    return patch
@@ -0,0 +1,80 @@
+""" Local snapshot of the CKAN packages from one harvest source
+    We save all the packages listed from CKAN in a SQLite file. The next harvest
+    just asks CKAN for the packages modified after the newest one we have
+    (high-water mark) and merge them. Deleted packages are only detected
+    with a full sync (or because we deleted them) """
+import json
+import logging
+import sqlite3
+from dateutil.parser import parse
+from harvester_ng.logs import logger
+
+
+logger = logging.getLogger(__name__)
+
+
+def solr_date(metadata_modified):
+    """ CKAN metadata_modified (naive UTC date) as a Solr date (milliseconds, rounded down) """
+    modified = parse(metadata_modified)
+    return modified.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(modified.microsecond // 1000)
+
+
+class CKANSnapshot:
+    """ CKAN packages keyed by ID """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS packages (
+                                id TEXT PRIMARY KEY,
+                                metadata_modified TEXT,
+                                data TEXT NOT NULL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS info (
+                                key TEXT PRIMARY KEY,
+                                value TEXT)""")
+        self.conn.commit()
+
+    def get_info(self, key, default=None):
+        res = self.conn.execute('SELECT value FROM info WHERE key = ?', (key, )).fetchone()
+        return default if res is None else json.loads(res[0])
+
+    def set_info(self, key, value):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def reset(self):
+        """ remove all packages and info (before a full sync).
+            If the sync stops, the next harvest finds no info and starts a full sync again """
+        with self.conn:
+            self.conn.execute('DELETE FROM packages')
+            self.conn.execute('DELETE FROM info')
+
+    def add_many(self, packages):
+        """ add or replace a list of packages """
+        values = [(package['id'], package.get('metadata_modified', None), json.dumps(package))
+                  for package in packages]
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO packages (id, metadata_modified, data) VALUES (?, ?, ?)',
+                                  values)
+
+    def remove_many(self, ckan_ids):
+        with self.conn:
+            self.conn.executemany('DELETE FROM packages WHERE id = ?', [(ckan_id, ) for ckan_id in ckan_ids])
+
+    def high_water_mark(self):
+        """ newest metadata_modified in the snapshot (None if empty) """
+        return self.conn.execute('SELECT MAX(metadata_modified) FROM packages').fetchone()[0]
+
+    def packages(self):
+        """ yield all packages sorted by ID """
+        cursor = self.conn.execute('SELECT data FROM packages ORDER BY id')
+        for res in cursor:
+            yield json.loads(res[0])
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM packages').fetchone()[0]
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
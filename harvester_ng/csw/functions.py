@@ -6,6 +6,7 @@ import requests
 from datapackage import Package, Resource
 from slugify import slugify
 
+from harvester_ng.duplicates import deduplicate
 from harvester_ng.helpers import encode_identifier
 from harvesters import config
 from harvesters.csw.harvester import CSWSource
@@ -43,30 +44,8 @@ def get_csw_from_url(url):
 
 
 def clean_duplicated_identifiers(rows):
-    """ clean duplicated datasets identifiers on data.json source """
-
-    logger.info('Cleaning duplicates')
-    unique_identifiers = []
-    duplicates = []
-    processed = 0
-    # resource = rows.res
-    # logger.error('Rows from resource {}'.format(resource.name))
-
-    for row in rows:
-        if row['identifier'] not in unique_identifiers:
-            unique_identifiers.append(row['identifier'])
-            yield(row)
-            processed += 1
-        else:
-            duplicates.append(row['identifier'])
-            row['is_duplicate'] = 'True'
-            yield(row)
-            # do not log all duplicates. Sometimes they are too many.
-            if len(duplicates) < 10:
-                logger.error('Duplicated {}'.format(row['identifier']))
-            elif len(duplicates) == 10:
-                logger.error('... more duplicates not shown')
-    logger.info('{} duplicates deleted. {} OK'.format(len(duplicates), processed))
+    """ clean duplicated datasets identifiers on CSW source """
+    yield from deduplicate(rows)
 
 
 def validate_datasets(row):
@@ -1,14 +1,12 @@
-import glob
-import json
 import logging
-import os
 import pytz
 
-from datapackage import Package, Resource
 from dateutil.parser import parse
 from harvesters.datajson.harvester import DataJSONDataset
 from harvester_ng import helpers
+from harvester_ng.duplicates import deduplicate
 from harvester_ng.logs import logger
+from harvester_ng.staging import StagingStore
 
 
 logger = logging.getLogger(__name__)
@@ -16,21 +14,17 @@ logger = logging.getLogger(__name__)
 
 def clean_duplicated_identifiers(rows):
     """ clean duplicated datasets identifiers on data.json source """
+    yield from deduplicate(rows)
 
-    logger.info('Cleaning duplicates')
-    unique_identifiers = []
-    c = 0
-    for row in rows:
-        c += 1
-        idf = row['identifier']
-        logger.info(f'Searching duplicates {c} {idf}')
-        if idf not in unique_identifiers:
-            unique_identifiers.append(idf)
-            yield row
-        else:
-            row['is_duplicate'] = True
-            logger.info(f'{idf} is duplicated')
-            yield row
+
+def remove_duplicates(policy='first', summary=None):
+    """ clean duplicated datasets identifiers with a custom policy (see DEDUP_POLICIES)
+        and fill a summary dict """
+
+    def f(rows):
+        yield from deduplicate(rows, policy=policy, summary=summary)
+
+    return f
 
 
 def validate_datasets(row):
@@ -43,33 +37,44 @@ def validate_datasets(row):
         logger.error(f'Error validating {row}: {errors}')
 
 
-def save_as_data_packages(path):
-    """ save dataset from data.json as data package
-        We will use this files as a queue to process later """
-
-    logger.info(f'Saving as data packages at {path}')
-    def f(row):
-        package = Package()
-        logger.debug(f'Resource {row}')
-        # TODO check this, I'm learning datapackages.
-        resource = Resource({'data': row})
-        resource.infer()  # adds "name": "inline"
-        if not resource.valid:
-            raise Exception('Invalid resource')
+def save_to_staging(path, batch_size=500):
+    """ save each dataset from data.json in the staging store
+        We will use this store as a queue to process later """
 
-        encoded_identifier = helpers.encode_identifier(identifier=row['identifier'])
+    logger.info(f'Saving datasets at staging store {path}')
 
-        package.add_resource(descriptor=resource.descriptor)
-        filename = f'data-json-{encoded_identifier}.json'
-        package_path = os.path.join(path, filename)
+    def f(rows):
+        store = StagingStore(path=path)
+        store.reset()
+        batch = []
+        for row in rows:
+            # duplicates are not saved, we keep the first one
+            if 'is_duplicate' not in row:
+                batch.append(row)
+            if len(batch) >= batch_size:
+                store.add_many(batch)
+                batch = []
+            yield row
 
-        # no not rewrite if exists
-        if not os.path.isfile(package_path):
-            package.save(target=package_path)
+        store.add_many(batch)
+        logger.info(f'{store.count()} datasets saved at staging store')
+        store.close()
 
     return f
 
 
+def mark_collections_in_staging(path, identifiers):
+    """ mark saved datasets as collections (is_collection = True).
+        Required when we read the data.json as a stream
+        and the parents are saved before we know they have children """
+
+    store = StagingStore(path=path)
+    for identifier in identifiers:
+        if not store.update(identifier, {'is_collection': True}):
+            logger.error(f'Collection {identifier} not found in data.json')
+    store.close()
+
+
 def compare_resources_validate(row):
     """ validate a row while comparing resources.
         Check for extras and identifier.
@@ -95,31 +100,50 @@ def compare_resources_validate(row):
     return True, None
 
 
-def compare_resources_resource_exists(data_packages_path, identifier):
-    """ Check if a row is for detele
-    Returns: Boolean, expected file path """
-    encoded_identifier = helpers.encode_identifier(identifier)
-    expected_filename = f'data-json-{encoded_identifier}.json'
-    expected_path = os.path.join(data_packages_path, expected_filename)
-    logger.debug(f'Expected path {expected_path}')
+def add_catalog_values(datajson_dataset):
+    """ add the catalog values (data.json headers) we save as extras """
+    for key, value in datajson_dataset['headers'].items():
+        if key in ['@context', '@id', 'conformsTo', 'describedBy']:
+            datajson_dataset[f'catalog_{key}'] = value
 
-    file_exists = os.path.isfile(expected_path)
-    if not file_exists:
-        logger.info(f'Dataset: {identifier} not in DATA.JSON.')
+    datajson_dataset['source_schema_version'] = datajson_dataset['headers']['schema_version']
+    return datajson_dataset
 
-    return file_exists, expected_path
 
+def get_source_hash(datajson_dataset):
+    """ hash a data.json dataset in the same way we save it
+        as the "source_hash" extra at write time """
+    dataset = add_catalog_values(datajson_dataset.copy())
+    return helpers.hash_dataset(dataset=dataset)
 
-def compare_resource_require_update(data_package_expected_path, row):
+
+def compare_resource_require_update(data_json_data, row):
     """ Check if a row require update or it's ok to ignore 
-    Returns: Boolean (if we need to update), new data readed from package """
+    Returns: Boolean (if we need to update), reason """
+
+    # compare the hash of the dataset with the one saved in the last harvest
+    ckan_source_hash = None
+    for extra in row.get('extras', []):
+        if extra['key'] == 'source_hash':
+            ckan_source_hash = extra['value']
+
+    if ckan_source_hash is not None:
+        require_update = ckan_source_hash != get_source_hash(data_json_data)
+        reason = 'The source dataset changed' if require_update else 'The resource is updated'
+        logger.info(f'Comparing hashes: require update = {require_update}')
+        return require_update, reason
+
+    # we don't have a hash, compare modified dates
+    require_update = compare_resource_modified_dates(data_json_data, row)
+    reason = 'The resource is older' if require_update else 'The resource is updated'
+    return require_update, reason
+
+
+def compare_resource_modified_dates(data_json_data, row):
+    """ Check if the data.json dataset is newer than the CKAN one
+    Returns: Boolean (if we need to update) """
 
     default_tzinfo_for_naives_dates = pytz.UTC
-    expected_path = data_package_expected_path
-    datajson_package = Package(expected_path)
-            
-    data_json = datajson_package.get_resource('inline')
-    data_json_data = data_json.source
     data_json_modified = parse(data_json_data['modified'])  # It's a naive date
     
     ckan_json = row
@@ -136,37 +160,62 @@ def compare_resource_require_update(data_package_expected_path, row):
     diff_times = data_json_modified - ckan_json_modified
     seconds = diff_times.total_seconds()
 
-    os.remove(expected_path)
-
     # requires update if the data.json date is newer.
     # We ask for a day of differente because some dates are naives.
     require_update = seconds > 86400
     logger.info(f'Comparing times: {seconds}>86400 = {require_update}')
-    return require_update, data_json_data
+    return require_update
 
 
-def compare_resource_get_new_datasets(data_packages_path):
-    """ get new datesets,
-    Yield this datasets """
-    
-    for name in glob.glob(f'{data_packages_path}/data-json-*.json'):
-        package = Package(name)
-        data_json = package.get_resource('inline')
-        data_json_data = data_json.source
+# dataset fields we need before loading the full dataset (to sort, link collections and report)
+REFERENCE_FIELDS = ['identifier', 'isPartOf', 'validation_errors']
 
-        yield data_json_data
 
-        # Delete the data.json file
-        os.remove(name)
+def get_new_data_reference(data_json_data):
+    """ compact reference to a staged dataset, used as "new_data" in the compare results.
+        The writer loads the full dataset from the staging store (see load_new_data) """
+    reference = {key: data_json_data[key] for key in REFERENCE_FIELDS if key in data_json_data}
+    reference['staged_hash'] = helpers.hash_dataset(data_json_data)
+    return reference
+
+
+def is_new_data_reference(new_data):
+    return new_data is not None and 'staged_hash' in new_data
+
+
+def load_new_data(store, reference):
+    """ full staged dataset from a reference.
+        Returns the dataset (None on error), error """
+    data_json_data = store.get(reference['identifier'])
+    if data_json_data is None:
+        return None, f'Dataset {reference["identifier"]} not found at the staging store'
+    if helpers.hash_dataset(data_json_data) != reference['staged_hash']:
+        # e.g. downloaded again after the compare
+        return None, f'Dataset {reference["identifier"]} changed at the staging store after the comparison'
+    return data_json_data, None
+
+
+def compare_resource_get_new_datasets(store, staged_identifiers, seen_identifiers):
+    """ get new datesets: staged but not found in the destination
+    Yield this datasets """
+    
+    for identifier in staged_identifiers:
+        if identifier not in seen_identifiers:
+            yield store.get(identifier)
 
 
-def compare_resources(data_packages_path):
+def compare_resources(staging_path):
     """ read the previous resource (CKAN API results)
         and yield any comparison result with current rows
         """
-    logger.info(f'Comparing resources at {data_packages_path}')
+    logger.info(f'Comparing resources at {staging_path}')
 
     def f(rows):
+        # the store is read-only here, we can compare again (e.g. after a crash)
+        store = StagingStore(path=staging_path)
+        staged_identifiers = store.identifiers()
+        staged_index = set(staged_identifiers)
+        seen_identifiers = set()  # identifiers found at CKAN
 
         # Calculate minimum statistics
         total = 0
@@ -190,8 +239,9 @@ def compare_resources(data_packages_path):
             extras = row.get('extras', False)
             identifier = [extra['value'] for extra in extras if extra['key'] == 'identifier'][0]
 
-            file_exists, expected_path = compare_resources_resource_exists(data_packages_path, identifier)
-            if not file_exists:
+            seen_identifiers.add(identifier)
+            if identifier not in staged_index:
+                logger.info(f'Dataset: {identifier} not in DATA.JSON.')
                 deleted += 1
                 row['comparison_results'] = {
                         'action': 'delete', 
@@ -203,13 +253,14 @@ def compare_resources(data_packages_path):
                 yield row
                 continue
 
-            require_update, data_json_data = compare_resource_require_update(expected_path, row)
+            data_json_data = store.get(identifier)
+            require_update, reason = compare_resource_require_update(data_json_data, row)
             if require_update:
                 row['comparison_results'] = {
                         'action': 'update',
                         'ckan_id': ckan_id,
-                        'new_data': data_json_data,
-                        'reason': f'The resource is older'
+                        'new_data': get_new_data_reference(data_json_data),
+                        'reason': reason
                         }
                 logger.info(f'Mark for update: ID {ckan_id}')
                 found_update += 1
@@ -218,7 +269,7 @@ def compare_resources(data_packages_path):
                         'action': 'ignore',
                         'ckan_id': ckan_id,
                         'new_data': None,  # don't need this
-                        'reason': 'The resource is updated'
+                        'reason': reason
                         }
                 found_not_update += 1
                 logger.info(f'Mark for ignore: ID {ckan_id}')
@@ -226,19 +277,20 @@ def compare_resources(data_packages_path):
             
         # detect new datasets
         news = 0
-        for data_json_data in compare_resource_get_new_datasets(data_packages_path):
+        for data_json_data in compare_resource_get_new_datasets(store, staged_identifiers, seen_identifiers):
             total += 1
             news += 1            
             row = {
                 'comparison_results': {
                     'action': 'create',
                     'ckan_id': None,
-                    'new_data': data_json_data,
+                    'new_data': get_new_data_reference(data_json_data),
                     'reason': 'Not found in the CKAN results'}
                 }
 
             yield row
 
+        store.close()
         found = found_not_update + found_update
 
         total_errors = len(errors)
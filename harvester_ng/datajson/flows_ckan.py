@@ -1,42 +1,117 @@
 """ Flows for CKAN destinations """
 import logging
 import pytz
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from harvesters.datajson.ckan.dataset import DataJSONSchema1_1
 from harvester_ng.logs import logger
 from harvester_ng import helpers
-from harvester_adapters.ckan.api import CKANPortalAPI
+from harvester_ng.ckan_diff import get_changed_fields, get_package_patch
+from harvester_ng.datajson.flows import add_catalog_values, is_new_data_reference, load_new_data
+from harvester_ng.staging import StagingStore
 
 
 logger = logging.getLogger(__name__)
 
 
-def write_results(destination_obj):
-    """ save results to destination. Yield results to continue flow process """
+def write_results(destination_obj, journal=None, staging_path=None):
+    """ save results to destination. Yield results to continue flow process.
+        Up to destination_obj.write_workers CKAN calls run at once.
+        Rows are yielded (and counted) in the same order we get them.
+        If the collection (isPartOf) of a dataset was already written (see order_parents_first)
+        the collection_package_id is saved with the dataset.
+        With a journal (WriteJournal) each completed action is saved and
+        the actions already done (resuming a harvest) are skipped.
+        If "new_data" is a reference to a staged dataset (see get_new_data_reference)
+        the full dataset is loaded from the staging store at staging_path just while writing it """
     
     logger.info('****************** Writting results')
-    
+    workers = destination_obj.write_workers
+
+    def submit(executor, cpa, row):
+        if executor is not None:
+            return executor.submit(write_row, destination_obj, cpa, row)
+        return completed(write_row(destination_obj, cpa, row))
+
+    def completed(result=None):
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def count_action(actions, action):
+        if action not in actions.keys():
+            actions[action] = {'total': 0, 'success': 0, 'fails': 0}
+        actions[action]['total'] += 1
+
+    def get_identifier(row):
+        """ data.json identifier for a row (if any) """
+        new_data = row['comparison_results'].get('new_data', None)
+        if new_data is not None:
+            return new_data['identifier']
+        for extra in row.get('extras', None) or []:
+            if extra['key'] == 'identifier':
+                return extra['value']
+        return None
+
+    def finish_row(row, future, actions, related_ids, in_flight, references):
+        # raise any main error here (e.g. unknown schema version)
+        future.result()
+        comparison_results = row['comparison_results']
+        reference = references.pop(id(row), None)
+        if reference is not None:
+            # don't keep the full dataset in the results
+            comparison_results['new_data'] = reference
+        action = comparison_results['action']
+        identifier = get_identifier(row)
+        if identifier in in_flight:
+            in_flight.remove(identifier)
+            if comparison_results['action_results']['success']:
+                related_ids[identifier] = row['id']
+        if comparison_results['action_results'].get('write_skipped', False):
+            # counted as update, nothing changed so it's an ignore now
+            actions['update']['total'] -= 1
+            count_action(actions, action)
+            destination_obj.avoided_writes += 1
+        if comparison_results['action_results'].get('name_collision', False):
+            actions[action]['collisions'] = actions[action].get('collisions', 0) + 1
+        if comparison_results['action_results'].get('resumed', False):
+            actions[action]['resumed'] = actions[action].get('resumed', 0) + 1
+        elif journal is not None and action != 'error':
+            journal.append(identifier=identifier,
+                           action=action,
+                           ckan_id=row.get('id', comparison_results['ckan_id']),
+                           success=comparison_results['action_results']['success'],
+                           timestamp=comparison_results['action_results'].get('timestamp', None))
+        if comparison_results['action_results']['success']:
+            actions[action]['success'] += 1
+        else:
+            actions[action]['fails'] += 1
+        return row
 
     def f(rows):
+        cpa = destination_obj.get_ckan_api()
+        executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        pending = deque()  # (row, future) in the original order
         actions = {}
-        c = 0
+        related_ids = {}  # data.json identifier -> CKAN ID
+        in_flight = set()  # data.json identifiers being created
+        references = {}  # id(row) -> "new_data" reference, for the rows loaded from staging
+        store = StagingStore(path=staging_path) if staging_path is not None else None
         for row in rows:
-            c += 1
             if 'is_duplicate' in row:
                 logger.info(f'Duplicated writting results: {row}')
                 continue
 
             comparison_results = row['comparison_results']
             action = comparison_results['action']
-            if action not in actions.keys():
-                actions[action] = {'total': 0, 'success': 0, 'fails': 0}
-            actions[action]['total'] += 1
+            count_action(actions, action)
 
             """ comparison_results is something like this
             row['comparison_results'] {
                 "action": "update" | "delete" | "create",
                 "ckan_id": "1bfc8520-17b0-46b9-9940-a6646615436c",
-                "new_data": {data json dataset format},
+                "new_data": {data json dataset format} or a reference to the staged dataset,
                 "reason": "Some reason for the action"
                 }
             """
@@ -44,149 +119,333 @@ def write_results(destination_obj):
             results = {'success': False, 'warnings': [], 'errors': []}
             comparison_results['action_results'] = results
 
-            if action == 'error':
+            identifier = get_identifier(row)
+            if action in ['ignore', 'update'] and identifier is not None:
+                related_ids[identifier] = row['id']
+
+            if action == 'ignore':
+                continue
+
+            done = None
+            if journal is not None and action != 'error':
+                done = journal.get_done(identifier=identifier,
+                                        ckan_id=comparison_results['ckan_id'],
+                                        action=action)
+
+            if done is not None:
+                # already written by a previous harvest (stopped before finish)
+                logger.info(f'Already written, skip {action} {identifier}')
+                results.update({'success': True, 'resumed': True, 'timestamp': done['timestamp']})
+                if done['ckan_id'] is not None:
+                    row['id'] = done['ckan_id']
+                    comparison_results['ckan_id'] = done['ckan_id']
+                    if identifier is not None and action != 'delete':
+                        related_ids[identifier] = done['ckan_id']
+                future = completed()
+            elif action == 'error':
                 results['errors'].append(comparison_results['reason'])
-                actions[action]['fails'] += 1
-                yield row
                 logger.info(f'Ignored for error: {row}')
-                continue
+                future = completed()
+            else:
+                error = None
+                if action in ['update', 'create'] and is_new_data_reference(comparison_results['new_data']):
+                    if store is None:
+                        raise Exception('A staging store is required to write datasets from references')
+                    reference = comparison_results['new_data']
+                    new_data, error = load_new_data(store, reference)
+                    if error is None:
+                        comparison_results['new_data'] = new_data
+                        references[id(row)] = reference
+
+                if error is not None:
+                    logger.error(error)
+                    results['errors'].append(error)
+                    future = completed()
+                else:
+                    if action in ['update', 'create']:
+                        is_part_of = comparison_results['new_data'].get('isPartOf', None)
+                        if is_part_of is not None:
+                            # wait until the collection is created to know its CKAN ID
+                            while is_part_of in in_flight:
+                                yield finish_row(*pending.popleft(), actions, related_ids, in_flight, references)
+                            comparison_results['collection_pkg_id'] = related_ids.get(is_part_of, None)
+                        if action == 'create':
+                            in_flight.add(identifier)
+                    future = submit(executor, cpa, row)
+
+            pending.append((row, future))
+            # limit the rows in process (and in memory)
+            while len(pending) > max(workers, 1) * 2:
+                yield finish_row(*pending.popleft(), actions, related_ids, in_flight, references)
+
+        while len(pending) > 0:
+            yield finish_row(*pending.popleft(), actions, related_ids, in_flight, references)
+
+        if executor is not None:
+            executor.shutdown()
+        if store is not None:
+            store.close()
+        logger.info(f'Actions detected {actions}. Avoided writes (no changes): {destination_obj.avoided_writes}')
+    
+    return f
 
-            # if it's an update we need to merge internal resources
-            if action == 'update':
-                existing_resources = row['resources']
-            elif action == 'create':
-                existing_resources = None
 
-            if action in ['update', 'create']:
-                datajson_dataset = comparison_results['new_data']
+def write_row(destination_obj, cpa, row):
+    """ transform and write (create, update or delete) one row at CKAN.
+        Could run in a thread, it only changes this row
+        (action_results, CKAN ID and extras) """
+
+    comparison_results = row['comparison_results']
+    action = comparison_results['action']
+    results = comparison_results['action_results']
+
+    # if it's an update we need to merge internal resources
+    if action == 'update':
+        existing_resources = row['resources']
+    elif action == 'create':
+        existing_resources = None
+
+    if action in ['update', 'create']:
+        datajson_dataset = comparison_results['new_data']
+
+        schema_version = datajson_dataset['headers']['schema_version'] 
+        if schema_version not in ['1.1']:  # main error
+            raise Exception(f'Unknown schema version: "{schema_version}"')
+
+        # add required extras
+        add_catalog_values(datajson_dataset)
+        datajson_dataset['source_hash'] = helpers.hash_dataset(dataset=datajson_dataset)
+        # the collection was written before, save the link now (it's not part of the source hash)
+        if comparison_results.get('collection_pkg_id', None) is not None:
+            datajson_dataset['collection_pkg_id'] = comparison_results['collection_pkg_id']
+
+        # harvest extras
+        # check if a local harvest source is required
+        # https://github.com/ckan/ckanext-harvest/blob/master/ckanext/harvest/logic/action/create.py#L27
+        datajson_dataset['harvest_ng_source_title'] = destination_obj.source.name
+        datajson_dataset['harvest_ng_source_id'] = destination_obj.harvest_source_id
+
+        # CKAN hides this extras if we not define as harvest type, see
+        # https://github.com/ckan/ckanext-harvest/blob/3a72337f1e619bf9ea3221037ca86615ec22ae2f/ckanext/harvest/plugin.py#L125
+        datajson_dataset['harvest_source_title'] = destination_obj.source.name
+        datajson_dataset['harvest_source_id'] = destination_obj.harvest_source_id
+
+        if schema_version == '1.1':
+            djss = DataJSONSchema1_1(original_dataset=datajson_dataset)
+
+        #  ORG is required!
+        djss.ckan_owner_org_id = destination_obj.organization_id
+        ckan_dataset = djss.transform_to_ckan_dataset(existing_resources=existing_resources)
+        logger.info(f'Transformed to CKAN dataset: {ckan_dataset}')
+
+        # check errors
+        results['errors'] += [str(err) for err in djss.errors]
+        if ckan_dataset is None:
+            error = 'Package skipped with errors: {}'.format(results['errors'])
+            logger.error(error)
+            return
+
+    patch_update = destination_obj.patch_updates
+    if action == 'update' and (destination_obj.skip_unchanged or destination_obj.patch_updates):
+        changed_fields = get_changed_fields(existing_package=row, new_package=ckan_dataset)
+        unchanged = destination_obj.skip_unchanged and len(changed_fields) == 0
+        source_hash = get_extra_value(ckan_dataset, 'source_hash')
+        if unchanged and source_hash != get_extra_value(row, 'source_hash'):
+            # save the new hash (or the next harvest will try to update this package again)
+            logger.info(f'Just the source hash changed at CKAN package {row["id"]}')
+            comparison_results['reason'] = 'Just the source hash changed'
+            extras = [dict(extra) for extra in row.get('extras', None) or []]
+            ckan_dataset = helpers.set_extra(ckan_dataset={'id': row['id'], 'extras': extras},
+                                             key='source_hash',
+                                             value=source_hash)
+            patch_update = True
+        # skip the CKAN write (and reindex) if nothing changes
+        elif unchanged:
+            logger.info(f'No changes at CKAN package {row["id"]}, skip update')
+            comparison_results['action'] = 'ignore'
+            comparison_results['reason'] = 'No changes at the CKAN package'
+            results['success'] = True
+            results['write_skipped'] = True
+            results['timestamp'] = datetime.now(pytz.utc).isoformat()
+            return
+        elif destination_obj.patch_updates:
+            ckan_dataset = get_package_patch(existing_package=row, new_package=ckan_dataset,
+                                             changed_fields=changed_fields)
+            logger.info(f'Fields to patch at {row["id"]}: {list(ckan_dataset.keys())}')
+
+    if action == 'create':
+        try:
+            ckan_response = cpa.create_package(ckan_package=ckan_dataset,
+                                               on_duplicated=destination_obj.on_duplicated)
+        except Exception as e:
+            ckan_response = {'success': False, 'error': str(e)}
+            logger.error(f'Failed to create package at CKAN: {e}')
+
+        results['success'] = ckan_response['success']
+        results['ckan_response'] = ckan_response
+        # the name was already in use at CKAN
+        results['name_collision'] = ckan_response.get('on_duplicated', None) is not None
+
+        if ckan_response['success']:
+            # add this new CKAN ID in the case we need as collection_pkg_id
+            row['id'] = ckan_response['result']['id']
+            row['extras'] = ckan_response['result'].get('extras', [])
+            comparison_results['ckan_id'] = ckan_response['result']['id']
+        else:
+            error = 'Error creating dataset: {}'.format(ckan_response['error'])
+            results['errors'].append(error)
+            logger.error(error)
+
+    elif action == 'update':
+        try:
+            if patch_update:
+                ckan_response = cpa.patch_package(ckan_package=ckan_dataset)
+            else:
+                ckan_response = cpa.update_package(ckan_package=ckan_dataset)
+        except Exception as e:
+            ckan_response = {'success': False, 'error': str(e)}
+            logger.error(f'Failed to update package at CKAN: {e}')
+
+        results['success'] = ckan_response['success']
+        results['ckan_response'] = ckan_response
+
+        if ckan_response['success']:
+            row['extras'] = ckan_response['result'].get('extras', [])
+        else:
+            error = 'Error updating dataset: {}'.format(ckan_response['error'])
+            results['errors'].append(error)
+            logger.error(error)
+
+    elif action == 'delete':
+        ckan_id = row['comparison_results']['ckan_id']
+        try:
+            ckan_response = cpa.delete_package(ckan_package_id_or_name=ckan_id)
+        except Exception as e:
+            ckan_response = {'success': False, 'error': str(e)}
+            error = 'Error deleting dataset: {}'.format(ckan_response['error'])
+            results['errors'].append(error)
+            logger.error(error)
+
+        results['success'] = ckan_response['success']
+        results['ckan_response'] = ckan_response
+
+    else:
+        error = 'Unexpected action for this dataset: {}'.format(action)
+        results['errors'].append(error)
+        logger.error(error)
+
+    results['timestamp'] = datetime.now(pytz.utc).isoformat()  # iso format move as string to save to disk
+
+
+def get_extra_value(package, key):
+    """ value of an extra at a CKAN package (None if not found) """
+    for extra in package.get('extras', None) or []:
+        if extra['key'] == key:
+            return extra['value']
+    return None
+
+
+def hydrate_packages(destination_obj):
+    """ read (in batches) the full CKAN packages for the rows we need to update.
+        Required after a slim listing, we need the existing resources to update """
+
+    logger.info('Reading full packages to update')
+    batch_size = destination_obj.hydrate_batch_size
+
+    def need_package(row):
+        return row['comparison_results']['action'] == 'update' and 'resources' not in row
+
+    def hydrate(cpa, rows):
+        ckan_ids = [row['id'] for row in rows if need_package(row)]
+        try:
+            packages = cpa.show_packages(ckan_ids)
+        except Exception as e:
+            logger.error(f'Failed to read packages {ckan_ids}: {e}')
+            packages = {}
 
-                # add required extras
-                # set catalog extras
-                for key, value in datajson_dataset['headers'].items():
-                    if key in ['@context', '@id', 'conformsTo', 'describedBy']:
-                        datajson_dataset[f'catalog_{key}'] = value
-
-                schema_version = datajson_dataset['headers']['schema_version'] 
-                if schema_version not in ['1.1']:  # main error
-                    raise Exception(f'Unknown schema version: "{schema_version}"')
-                
-                datajson_dataset['source_schema_version'] = schema_version
-                datajson_dataset['source_hash'] = helpers.hash_dataset(dataset=datajson_dataset)
-
-                # harvest extras
-                # check if a local harvest source is required
-                # https://github.com/ckan/ckanext-harvest/blob/master/ckanext/harvest/logic/action/create.py#L27
-                datajson_dataset['harvest_ng_source_title'] = destination_obj.source.name
-                datajson_dataset['harvest_ng_source_id'] = destination_obj.harvest_source_id
-
-                # CKAN hides this extras if we not define as harvest type
-                # if https://github.com/ckan/ckanext-harvest/blob/3a72337f1e619bf9ea3221037ca86615ec22ae2f/ckanext/harvest/plugin.py#L125
-                datajson_dataset['harvest_source_title'] = destination_obj.source.name
-                datajson_dataset['harvest_source_id'] = destination_obj.harvest_source_id
-
-                if schema_version == '1.1':
-                    djss = DataJSONSchema1_1(original_dataset=datajson_dataset)
-
-                #  ORG is required!
-                djss.ckan_owner_org_id = destination_obj.organization_id
-                ckan_dataset = djss.transform_to_ckan_dataset(existing_resources=existing_resources)
-                logger.info(f'Transformed to CKAN dataset: {ckan_dataset}')
-
-                # check errors
-                results['errors'] += [str(err) for err in djss.errors]
-                if ckan_dataset is None:
-                    error = 'Package skipped with errors: {}'.format(results['errors'])
+        for row in rows:
+            if need_package(row):
+                package = packages.get(row['id'], None)
+                if package is None:
+                    error = f'Unable to read the full package {row["id"]} to update'
                     logger.error(error)
-                    actions[action]['fails'] += 1
-                    yield row
-                    continue
-
-            if action == 'create':
-                cpa = CKANPortalAPI(base_url=destination_obj.catalog_url,
-                                    api_key=destination_obj.api_key)
-
-                try:
-                    ckan_response = cpa.create_package(ckan_package=ckan_dataset, on_duplicated='DELETE')
-                except Exception as e:
-                    ckan_response = {'success': False, 'error': str(e)}
-                    logger.error(f'Failed to create package at CKAN: {e}')
-
-                results['success'] = ckan_response['success']
-                results['ckan_response'] = ckan_response
-
-                if ckan_response['success']:
-                    actions[action]['success'] += 1
-                    # add this new CKAN ID in the case we need as collection_pkg_id
-                    row['id'] = ckan_response['result']['id']
-                    row['extras'] = ckan_response['result'].get('extras', [])
-                    comparison_results['ckan_id'] = ckan_response['result']['id']
+                    row['comparison_results'].update({'action': 'error', 'new_data': None, 'reason': error})
                 else:
-                    actions[action]['fails'] += 1
-                    error = 'Error creating dataset: {}'.format(ckan_response['error'])
-                    results['errors'].append(error)
-                    logger.error(error)
+                    row.update(package)
+            yield row
 
-            elif action == 'update':
-                cpa = CKANPortalAPI(base_url=destination_obj.catalog_url,
-                                    api_key=destination_obj.api_key)
+    def f(rows):
+        cpa = destination_obj.get_ckan_api()
+        batch = []  # all the rows (to keep the order) until we have a batch of packages to read
+        to_read = 0
+        for row in rows:
+            batch.append(row)
+            if need_package(row):
+                to_read += 1
+            if to_read >= batch_size:
+                yield from hydrate(cpa, batch)
+                batch = []
+                to_read = 0
 
-                try:
-                    ckan_response = cpa.update_package(ckan_package=ckan_dataset)
-                except Exception as e:
-                    ckan_response = {'success': False, 'error': str(e)}
-                    logger.error(f'Failed to update package at CKAN: {e}')
+        yield from hydrate(cpa, batch)
 
-                results['success'] = ckan_response['success']
-                results['ckan_response'] = ckan_response
-                # row['id'] = comparison_results['ckan_id']
+    return f
 
-                if ckan_response['success']:
-                    actions[action]['success'] += 1
-                    row['extras'] = ckan_response['result'].get('extras', [])
-                else:
-                    actions[action]['fails'] += 1
-                    error = 'Error updating dataset: {}'.format(ckan_response['error'])
-                    results['errors'].append(error)
-                    logger.error(error)
 
-            elif action == 'delete':
-                ckan_id = row['comparison_results']['ckan_id']
-                cpa = CKANPortalAPI(base_url=destination_obj.catalog_url, api_key=destination_obj.api_key)
+def order_parents_first():
+    """ write the collections before their datasets (isPartOf).
+        Then write_results knows the collection CKAN ID when writing each dataset.
+        Rows are streamed: we just hold back the datasets whose collection we didn't
+        see yet, until it passes (or until the end, if it's not in this harvest) """
+    logger.info('Ordering collections before their datasets')
+
+    def get_identifier_and_parent(row):
+        comparison_results = row['comparison_results']
+        new_data = comparison_results.get('new_data', None)
+        if new_data is not None:
+            return new_data['identifier'], new_data.get('isPartOf', None)
+        # ignore, delete and error rows, they don't need to wait
+        for extra in row.get('extras', None) or []:
+            if extra['key'] == 'identifier':
+                return extra['value'], None
+        return None, None
 
-                try:
-                    ckan_response = cpa.delete_package(ckan_package_id_or_name=ckan_id)
-                except Exception as e:
-                    ckan_response = {'success': False, 'error': str(e)}
-                    error = 'Error deleting dataset: {}'.format(ckan_response['error'])
-                    results['errors'].append(error)
-                    logger.error(error)
+    def f(rows):
+        passed = set()  # identifiers already yielded
+        waiting = {}  # collection identifier -> [(position, row)] waiting for it
 
-                results['success'] = ckan_response['success']
-                results['ckan_response'] = ckan_response
-                
-                if ckan_response['success']:
-                    actions[action]['success'] += 1
-                else:
-                    actions[action]['fails'] += 1
+        def release(identifier):
+            """ yield the rows waiting for this identifier (and the ones waiting for them) """
+            passed.add(identifier)
+            for position, row in waiting.pop(identifier, []):
+                yield row
+                yield from release(get_identifier_and_parent(row)[0])
 
-            elif action == 'ignore':
+        for position, row in enumerate(rows):
+            identifier, parent = get_identifier_and_parent(row)
+            if parent is not None and parent not in passed and parent != identifier:
+                waiting.setdefault(parent, []).append((position, row))
                 continue
-
-            else:
-                error = 'Unexpected action for this dataset: {}'.format(action)
-                results = {'success': False, 'error': error}
-
-            results['timestamp'] = datetime.now(pytz.utc).isoformat()  # iso format move as string to save to disk
             yield row
+            if identifier is not None:
+                yield from release(identifier)
+
+        # collections not found (or loops), in the original order
+        while len(waiting) > 0:
+            parent = min(waiting.keys(), key=lambda key: waiting[key][0][0])
+            position, row = waiting[parent].pop(0)
+            if len(waiting[parent]) == 0:
+                del waiting[parent]
+            yield row
+            yield from release(get_identifier_and_parent(row)[0])
 
-        logger.info(f'Actions detected {actions}')
-    
     return f
 
 
 def assing_collection_pkg_id(destination_obj):
     """ detect new CKAN ids for collections.
-        The IDs are at different rows so we need to iterate all rows
+        The IDs are at different rows so we need to iterate all rows.
+        Datasets saved with the collection ID by write_results are skipped
         """
     logger.info('Assignment of collection identifiers')
     
@@ -212,43 +471,52 @@ def assing_collection_pkg_id(destination_obj):
 
                 # if is part of a collection, get the CKAN ID
                 is_part_of = datajson_dataset.get('isPartOf', None)
-                if is_part_of is None:
+                if is_part_of is None or comparison_results.get('collection_pkg_id', None) is not None:
                     yield row
                 else:
                     need_update_rows.append(row)
 
-        cpa = CKANPortalAPI(base_url=destination_obj.catalog_url,
-                            api_key=destination_obj.api_key)
+        cpa = destination_obj.get_ckan_api()
 
-        for row in need_update_rows:
+        def save_collection_pkg_id(row):
             comparison_results = row['comparison_results']
+            if not comparison_results['action_results']['success']:
+                return  # the error is already at the results
             datajson_dataset = comparison_results['new_data']
             old_identifier = datajson_dataset['isPartOf']  # ID at data.json
             new_ckan_identifier = related_ids.get(old_identifier, None)
-            if new_ckan_identifier is not None:
+            if new_ckan_identifier is None:
+                error = f'Unable to detect the collection_pkg_id at {row}'
+                comparison_results['action_results']['errors'].append(error)
+                return
 
-                res3 = cpa.show_package(ckan_package_id_or_name=row['id'])
-                if res3['success'] != True:
-                    error = 'Unable to read package for update collection_pkg_id'
+            # we have the extras from the write response (no need to read the package)
+            extras = row.get('extras', None)
+            if extras is None or comparison_results['action_results'].get('resumed', False):
+                try:
+                    res3 = cpa.show_package(ckan_package_id_or_name=row['id'])
+                    extras = res3['result'].get('extras', [])
+                except Exception as e:
+                    error = f'Unable to read package for update collection_pkg_id: {e}'
                     comparison_results['action_results']['errors'].append(error)
-                else:
-                    # update ckan package
-                    ckan_dataset = res3['result']
-                    ckan_dataset = helpers.set_extra(ckan_dataset=ckan_dataset,
-                                                        key='collection_package_id',
-                                                        value=new_ckan_identifier)
-
-                    try:
-                        ckan_response = cpa.update_package(ckan_package=ckan_dataset)
-                        # save for not ask package_show again in tests
-                        row['extras'] = ckan_response['result']['extras']
-                    except Exception as e:
-                        error = f'Error updating collection_package_id at {ckan_dataset}: {e}'
-                        comparison_results['action_results']['errors'].append(error)
-
-            else:
-                error = f'Unable to detect the collection_pkg_id at {row}'
+                    return
+
+            # patch just the extras (CKAN replaces the full list)
+            ckan_dataset = {'id': row['id'], 'extras': [dict(extra) for extra in extras]}
+            ckan_dataset = helpers.set_extra(ckan_dataset=ckan_dataset,
+                                             key='collection_package_id',
+                                             value=new_ckan_identifier)
+            try:
+                ckan_response = cpa.patch_package(ckan_package=ckan_dataset)
+                # save for not ask package_show again in tests
+                row['extras'] = ckan_response['result']['extras']
+            except Exception as e:
+                error = f'Error updating collection_package_id at {ckan_dataset}: {e}'
                 comparison_results['action_results']['errors'].append(error)
 
-            yield row
-    return f
\ No newline at end of file
+        # each call just changes its own row
+        workers = max(destination_obj.write_workers, 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for row, _ in zip(need_update_rows, executor.map(save_collection_pkg_id, need_update_rows)):
+                yield row
+    return f
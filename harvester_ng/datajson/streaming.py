@@ -0,0 +1,84 @@
+""" Incremental parsing of data.json sources
+    We read the HTTP body as a stream and yield each dataset as soon as it is complete,
+    so memory is bounded by one dataset (plus buffers) instead of the full catalog """
+import logging
+import ijson
+from harvester_ng.logs import logger
+
+
+logger = logging.getLogger(__name__)
+
+CONTAINER_START_EVENTS = ['start_map', 'start_array']
+CONTAINER_END_EVENTS = ['end_map', 'end_array']
+
+
+class TeeReader:
+    """ file-like wrapper. Everything readed from the source is also written to a sink
+        (e.g. the local data.json cache file) and to a hasher (e.g. hashlib.sha256()) """
+
+    def __init__(self, source, sink=None, hasher=None):
+        self.source = source
+        self.sink = sink
+        self.hasher = hasher
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = self.source.read(size)
+        if chunk:
+            self.bytes_read += len(chunk)
+            if self.sink is not None:
+                self.sink.write(chunk)
+            if self.hasher is not None:
+                self.hasher.update(chunk)
+        return chunk
+
+
+def iter_datajson_datasets(fileobj, headers):
+    """ parse a data.json file-like object and yield each dataset in the "dataset" list.
+        Params:
+            fileobj: file-like object (with a "read" method) returning bytes
+            headers: dict to fill with all the catalog values (all except "dataset").
+                     Headers are filled as soon as they are readed. In most data.json
+                     files they are before the "dataset" list so they are complete
+                     when the first dataset is yielded """
+
+    current_key = None
+    in_datasets = False
+    builder = None
+    target = None
+    depth = 0
+
+    for prefix, event, value in ijson.parse(fileobj, use_float=True):
+        if builder is None:
+            if prefix == '' and event == 'start_array':
+                raise ValueError('Data.json is a simple list. We expect a dict')
+            if prefix == '' and event in ['start_map', 'end_map']:
+                continue
+            if prefix == '' and event == 'map_key':
+                current_key = value
+                continue
+            if current_key == 'dataset' and prefix == 'dataset':
+                if event == 'start_array':
+                    in_datasets = True
+                    continue
+                if event == 'end_array':
+                    in_datasets = False
+                    continue
+
+            # a new value starts
+            builder = ijson.ObjectBuilder()
+            target = 'dataset' if in_datasets else current_key
+            depth = 0
+
+        builder.event(event, value)
+        if event in CONTAINER_START_EVENTS:
+            depth += 1
+        elif event in CONTAINER_END_EVENTS:
+            depth -= 1
+
+        if depth == 0:
+            if target == 'dataset' and in_datasets:
+                yield builder.value
+            else:
+                headers[target] = builder.value
+            builder = None
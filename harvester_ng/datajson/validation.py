@@ -0,0 +1,225 @@
+""" Validate data.json datasets
+    Same validations (and errors) as harvesters DataJSONDataset but the JSON schema
+    is compiled once and the OMB bureau codes are downloaded once (per process) """
+import codecs
+import csv
+import json
+import logging
+import os
+import sqlite3
+import urllib.request
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import jsonschema as jss
+from harvesters.datajson import harvester as datajson_harvester
+from harvester_ng import helpers
+from harvester_ng.logs import logger
+
+
+logger = logging.getLogger(__name__)
+
+BUREAU_CODES_URL = 'https://project-open-data.cio.gov/data/omb_bureau_codes.csv'
+
+# one validator for each validator_schema. Each process in the pool keeps its own
+_validators = {}
+
+
+class DatasetValidator:
+    """ validate datasets with one validator_schema """
+
+    def __init__(self, validator_schema):
+        self.validator_schema = validator_schema
+        self.json_validator = None
+        self.bureau_codes = None
+
+        schemas_folder = os.path.join(os.path.dirname(datajson_harvester.__file__),
+                                      'validation',
+                                      'schemas',
+                                      validator_schema)
+        dataset_schema = os.path.join(schemas_folder, 'dataset.json')
+        if os.path.isfile(dataset_schema):
+            f = open(dataset_schema, 'r')
+            schema = json.load(f)
+            f.close()
+            validator_class = jss.validators.validator_for(schema)
+            validator_class.check_schema(schema)
+            self.json_validator = validator_class(schema)
+
+    def get_bureau_codes(self):
+        if self.bureau_codes is None:
+            # Constant URL is safe from protocol scheme abuse (bandit B310)
+            ftpstream = urllib.request.urlopen(BUREAU_CODES_URL)  # nosec
+            csvfile = csv.DictReader(codecs.iterdecode(ftpstream, 'utf-8'))
+            self.bureau_codes = set()
+            for row in csvfile:
+                self.bureau_codes.add(row["Agency Code"] + ":" + row["Bureau Code"])
+        return self.bureau_codes
+
+    def validate(self, dataset):
+        """ validate one dataset
+            Returns: list of errors """
+        errors = []
+        if self.json_validator is not None:
+            error = jss.exceptions.best_match(self.json_validator.iter_errors(dataset))
+            if error is not None:
+                errors.append("Error validating dataset: {}".format(error))
+                return errors
+
+        if self.validator_schema in ['federal-v1.1', 'federal']:
+            bureau_codes = self.get_bureau_codes()
+            for bc in dataset.get('bureauCode', None) or []:
+                if bc not in bureau_codes:
+                    errors.append(f'The bureau code {bc} was not found in our list at {BUREAU_CODES_URL}')
+                    break
+
+        return errors
+
+
+def get_validator(validator_schema):
+    if validator_schema not in _validators:
+        _validators[validator_schema] = DatasetValidator(validator_schema=validator_schema)
+    return _validators[validator_schema]
+
+
+def validate_chunk(datasets):
+    """ validate a list of datasets (runs in a pool process)
+        Returns: a list of errors for each dataset """
+    return [get_validator(dataset['validator_schema']).validate(dataset) for dataset in datasets]
+
+
+class ValidationCache:
+    """ persistent validation errors for each (dataset hash, validator_schema).
+        Each harvest run is numbered, entries not used in the last "max_runs" runs are removed """
+
+    def __init__(self, path, max_runs=5):
+        self.path = path
+        self.max_runs = max_runs
+        self.hits = 0
+        self.misses = 0
+        self.used = []  # hits pending to save as used in this run
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS validations (
+                                dataset_hash TEXT NOT NULL,
+                                validator_schema TEXT NOT NULL,
+                                errors TEXT NOT NULL,
+                                last_run INTEGER NOT NULL,
+                                PRIMARY KEY (dataset_hash, validator_schema))""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS runs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                started TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)""")
+        with self.conn:
+            self.run = self.conn.execute('INSERT INTO runs DEFAULT VALUES').lastrowid
+
+    def get(self, dataset_hash, validator_schema):
+        """ get the errors list or None if not in cache """
+        cursor = self.conn.execute('SELECT errors FROM validations WHERE dataset_hash = ? AND validator_schema = ?',
+                                   (dataset_hash, validator_schema))
+        res = cursor.fetchone()
+        if res is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.append((self.run, dataset_hash, validator_schema))
+        return json.loads(res[0])
+
+    def set_many(self, values):
+        """ save a list of (dataset_hash, validator_schema, errors) """
+        values = [(dataset_hash, validator_schema, json.dumps(errors), self.run)
+                  for dataset_hash, validator_schema, errors in values]
+        with self.conn:
+            self.conn.executemany("""INSERT OR REPLACE INTO validations
+                                     (dataset_hash, validator_schema, errors, last_run)
+                                     VALUES (?, ?, ?, ?)""", values)
+
+    def flush(self):
+        with self.conn:
+            self.conn.executemany('UPDATE validations SET last_run = ? WHERE dataset_hash = ? AND validator_schema = ?',
+                                  self.used)
+        self.used = []
+
+    def close(self):
+        """ save and remove old entries (and old runs, run IDs are never reused) """
+        self.flush()
+        with self.conn:
+            cursor = self.conn.execute('DELETE FROM validations WHERE last_run <= ?', (self.run - self.max_runs, ))
+            self.conn.execute('DELETE FROM runs WHERE id <= ?', (self.run - self.max_runs, ))
+        logger.info(f'Validation cache: {self.hits} hits, {self.misses} misses, {cursor.rowcount} entries removed')
+        self.conn.close()
+
+
+def validate_datasets_in_pool(workers=None, chunk_size=100, cache_path=None, cache_max_runs=5):
+    """ validate datasets in a pool of processes.
+        Rows are yielded in the same order with the "validation_errors" field
+        Params:
+            workers: number of processes (None for all the CPUs, 0 to validate in this process)
+            chunk_size: datasets sent to a process at once
+            cache_path: path for a ValidationCache. Datasets in cache are not validated again
+            cache_max_runs: remove from cache the datasets not found in this number of runs """
+
+    if workers == 0:
+        logger.info('Validating datasets')
+    else:
+        logger.info(f'Validating datasets in a pool of {workers or os.cpu_count()} processes')
+
+    def submit(executor, chunk):
+        datasets = [row for row, dataset_hash, errors in chunk if errors is None]
+        if executor is not None:
+            return executor.submit(validate_chunk, datasets)
+        future = Future()
+        future.set_result(validate_chunk(datasets))
+        return future
+
+    def finish_chunk(chunk, future, cache):
+        new_errors = iter(future.result())
+        new_values = []
+        for row, dataset_hash, errors in chunk:
+            if errors is None:
+                errors = next(new_errors)
+                if cache is not None:
+                    new_values.append((dataset_hash, row['validator_schema'], errors))
+            row['validation_errors'] = errors
+            if len(errors) > 0:
+                logger.error(f'Error validating {row["identifier"]}: {errors}')
+            yield row
+        if cache is not None:
+            cache.set_many(new_values)
+
+    def f(rows):
+        cache = None if cache_path is None else ValidationCache(path=cache_path, max_runs=cache_max_runs)
+        executor = None if workers == 0 else ProcessPoolExecutor(max_workers=workers)
+        max_pending = (workers or os.cpu_count()) * 2
+        pending = deque()
+        # list of (row, dataset hash, errors). errors is None if we need to validate
+        # (the hash is not saved in the dataset, it could change the validation result)
+        chunk = []
+        to_validate = 0
+        for row in rows:
+            dataset_hash = None
+            errors = None
+            if cache is not None:
+                dataset_hash = helpers.hash_dataset(row)
+                errors = cache.get(dataset_hash, row['validator_schema'])
+            chunk.append((row, dataset_hash, errors))
+            if errors is None:
+                to_validate += 1
+
+            if to_validate >= chunk_size:
+                pending.append((chunk, submit(executor, chunk)))
+                chunk = []
+                to_validate = 0
+                # do not read the full source, keep a few chunks in process
+                while len(pending) > max_pending:
+                    yield from finish_chunk(*pending.popleft(), cache)
+
+        if len(chunk) > 0:
+            pending.append((chunk, submit(executor, chunk)))
+        while len(pending) > 0:
+            yield from finish_chunk(*pending.popleft(), cache)
+
+        if executor is not None:
+            executor.shutdown()
+        if cache is not None:
+            cache.close()
+
+    return f
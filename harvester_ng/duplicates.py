@@ -0,0 +1,100 @@
+""" Detect datasets with duplicated identifiers in a harvest source """
+import logging
+import pytz
+from dateutil.parser import parse
+from harvester_ng.logs import logger
+
+
+logger = logging.getLogger(__name__)
+
+# which dataset to keep when the identifier is duplicated
+#   first: the first one we read
+#   newest: the one with the newest "modified" value
+#   fail: raise an error
+DEDUP_POLICIES = ['first', 'newest', 'fail']
+MAX_SAMPLES = 10  # max duplicated identifiers to include in the summary
+
+
+def parse_modified(value):
+    """ modified date as a timezone aware datetime. None if not exists or invalid """
+    if value in [None, '']:
+        return None
+    try:
+        modified = parse(value)
+    except Exception:
+        return None
+    if modified.tzinfo is None:
+        modified = modified.replace(tzinfo=pytz.UTC)
+    return modified
+
+
+def is_newer(modified, previous_modified):
+    if modified is None:
+        return False
+    return previous_modified is None or modified > previous_modified
+
+
+def deduplicate(rows, policy='first', identifier_field='identifier', summary=None):
+    """ mark the duplicated rows (is_duplicate = True) and yield all of them.
+        Params:
+            rows: iterable of dicts
+            policy: one of DEDUP_POLICIES.
+                    Note: "newest" needs to read all the rows before yielding the first one
+            summary: dict to fill with a summary of duplicates found (counts and samples) """
+
+    if policy not in DEDUP_POLICIES:
+        raise Exception(f'Unknown deduplication policy "{policy}". Use one of {DEDUP_POLICIES}')
+
+    logger.info(f'Cleaning duplicates (keep {policy})')
+    if summary is None:
+        summary = {}
+    summary.update({'policy': policy, 'total': 0, 'duplicates': 0, 'duplicated_identifiers': 0, 'samples': []})
+    duplicated = {}  # identifier: number of extra copies
+
+    def add_duplicate(identifier):
+        summary['duplicates'] += 1
+        duplicated[identifier] = duplicated.get(identifier, 0) + 1
+        if len(summary['samples']) < MAX_SAMPLES and identifier not in summary['samples']:
+            summary['samples'].append(identifier)
+
+    if policy == 'newest':
+        # identifier: (position, modified) of the row to keep
+        index = {}
+        buffer = []
+        for row in rows:
+            idf = row[identifier_field]
+            modified = parse_modified(row.get('modified', None))
+            position = len(buffer)
+            buffer.append(row)
+            if idf not in index:
+                index[idf] = (position, modified)
+            else:
+                add_duplicate(idf)
+                if is_newer(modified, index[idf][1]):
+                    index[idf] = (position, modified)
+
+        for position, row in enumerate(buffer):
+            if index[row[identifier_field]][0] != position:
+                row['is_duplicate'] = True
+            yield row
+        summary['total'] = len(buffer)
+
+    else:
+        index = set()
+        for row in rows:
+            summary['total'] += 1
+            idf = row[identifier_field]
+            if idf not in index:
+                index.add(idf)
+            else:
+                add_duplicate(idf)
+                if policy == 'fail':
+                    error = f'Duplicated identifier "{idf}"'
+                    logger.error(error)
+                    raise Exception(error)
+                row['is_duplicate'] = True
+            yield row
+
+    summary['duplicated_identifiers'] = len(duplicated)
+    logger.info('{} duplicates found ({} identifiers, e.g. {}). {} datasets readed'.format(
+        summary['duplicates'], summary['duplicated_identifiers'], summary['samples'], summary['total']))
@@ -2,7 +2,19 @@ import base64
 import json
 import logging
 from abc import ABC, abstractmethod
-from harvester_adapters.ckan.api import CKANPortalAPI
+from harvester_ng.ckan_api import (CKANSessionAPI,
+                                   SLIM_FIELDS,
+                                   normalize_slim_package,
+                                   DEFAULT_POOL_SIZE,
+                                   DEFAULT_CONNECT_TIMEOUT,
+                                   DEFAULT_READ_TIMEOUT,
+                                   DEFAULT_MAX_RETRIES,
+                                   DEFAULT_BACKOFF_BASE,
+                                   DEFAULT_BACKOFF_MAX,
+                                   DEFAULT_BREAKER_FAILURES,
+                                   DEFAULT_BREAKER_PAUSE)
+from harvester_ng.ckan_snapshot import CKANSnapshot, solr_date
+from harvester_ng.helpers import save_json_list
 from harvester_ng.logs import logger
 
 
@@ -14,9 +26,11 @@ class HarvestDestination(ABC):
     def __init__(self, *args, **kwargs):
         self.source = None  # class who call use this class as destination
         # configuration (e.g: CKAN uses validator_schema)
-        config = kwargs.get('config', {})  # configuration (e.g validation_schema)
+        config = kwargs.get('config', None) or {}  # configuration (e.g validation_schema)
         if type(config) == str:
             self.config = json.loads(config)
+        else:
+            self.config = config
 
     @abstractmethod
     def yield_datasets(self):
@@ -30,6 +44,10 @@ class HarvestDestination(ABC):
         pass
     '''
 
+    def get_stats(self):
+        """ stats about the calls to the destination (for the final report) """
+        return {}
+
     @abstractmethod
     def destination_type(self):
         """ class name """
@@ -48,27 +66,175 @@ class CKANHarvestDestination(HarvestDestination):
         self.api_key = api_key
         self.organization_id = organization_id
         self.harvest_source_id = harvest_source_id
+        # CKAN API calls to run at once while writing results
+        self.write_workers = int(self.config.get('ckan_write_workers', 1))
+        # pages of packages to request at once while listing the harvested packages
+        self.listing_workers = int(self.config.get('ckan_listing_workers', 1))
+        # first page size, max page size and expected seconds for each page (adaptive page size)
+        self.listing_rows = int(self.config.get('ckan_listing_rows', 1000))
+        self.listing_max_rows = int(self.config.get('ckan_listing_max_rows', 1000))
+        self.listing_page_seconds = float(self.config.get('ckan_listing_page_seconds', 5))
+        # list just the fields we need to compare. Full packages are readed later if required
+        self.slim_listing = self.config.get('ckan_slim_listing', False)
+        # full packages to read in one request
+        self.hydrate_batch_size = int(self.config.get('ckan_hydrate_batch_size', 100))
+        # don't update packages if the transformed package has no changes
+        self.skip_unchanged = self.config.get('ckan_skip_unchanged', True)
+        self.avoided_writes = 0
+        # update with package_patch, sending just the changed fields
+        self.patch_updates = self.config.get('ckan_patch_updates', False)
+        # what to do when a new package name is already in use: DELETE (and create again) or UPSERT
+        self.on_duplicated = self.config.get('ckan_on_duplicated', 'DELETE')
+        if self.on_duplicated not in ['DELETE', 'UPSERT']:
+            raise Exception(f'Unknown ckan_on_duplicated value: "{self.on_duplicated}"')
+        # local snapshot of the CKAN packages, updated with the packages modified since the last harvest
+        self.snapshot = self.config.get('ckan_snapshot', False)
+        # force a full sync of the snapshot (or after some harvests) to detect packages deleted at CKAN
+        self.snapshot_full_sync = self.config.get('ckan_snapshot_full_sync', False)
+        self.snapshot_full_sync_every = int(self.config.get('ckan_snapshot_full_sync_every', 10))
+        # HTTP connections to the catalog
+        self.pool_size = int(self.config.get('ckan_pool_size',
+                                             max(DEFAULT_POOL_SIZE, self.write_workers, self.listing_workers)))
+        self.connect_timeout = float(self.config.get('ckan_connect_timeout', DEFAULT_CONNECT_TIMEOUT))
+        self.read_timeout = float(self.config.get('ckan_read_timeout', DEFAULT_READ_TIMEOUT))
+        # retries and circuit breaker when the catalog is overloaded
+        self.max_retries = int(self.config.get('ckan_max_retries', DEFAULT_MAX_RETRIES))
+        self.backoff_base = float(self.config.get('ckan_backoff_base', DEFAULT_BACKOFF_BASE))
+        self.backoff_max = float(self.config.get('ckan_backoff_max', DEFAULT_BACKOFF_MAX))
+        self.breaker_failures = int(self.config.get('ckan_breaker_failures', DEFAULT_BREAKER_FAILURES))
+        self.breaker_pause = float(self.config.get('ckan_breaker_pause', DEFAULT_BREAKER_PAUSE))
+        self.ckan_api = None
         logger.info(f'Harvest destination set: {catalog_url}')
     
     def destination_type(self):
         return "CKAN"
 
-    def yield_datasets(self, harvest_source_id, save_results_json_path=None):
-        
-        logger.info(f'Extracting from harvest source id: {harvest_source_id}')
-        cpa = CKANPortalAPI(base_url=self.catalog_url)
-        resources = 0
+    def get_ckan_api(self):
+        """ CKAN API client shared by all the steps in a harvest run """
+        if self.ckan_api is None:
+            self.ckan_api = CKANSessionAPI(base_url=self.catalog_url,
+                                           api_key=self.api_key,
+                                           pool_size=self.pool_size,
+                                           connect_timeout=self.connect_timeout,
+                                           read_timeout=self.read_timeout,
+                                           max_retries=self.max_retries,
+                                           backoff_base=self.backoff_base,
+                                           backoff_max=self.backoff_max,
+                                           breaker_failures=self.breaker_failures,
+                                           breaker_pause=self.breaker_pause)
+        return self.ckan_api
+
+    def get_stats(self):
+        """ requests, retries and throttle state for this run """
+        if self.ckan_api is None:
+            return {}
+        stats = self.ckan_api.get_stats()
+        stats['avoided_writes'] = self.avoided_writes
+        return stats
+
+    def close(self):
+        if self.ckan_api is not None:
+            self.ckan_api.close()
+            self.ckan_api = None
+
+    def iter_packages(self, harvest_source_id, modified_since=None):
+        """ list the packages from one harvest source at CKAN
+            Params:
+                modified_since: Solr date. Just packages modified since this date.
+                    Listed (one page at a time) from the oldest to the newest, so if the
+                    listing stops we already have all the packages before the last one """
+        cpa = self.get_ckan_api()
+        fl = SLIM_FIELDS if self.slim_listing else None
+
+        if modified_since is not None:
+            pages = cpa.search_harvest_packages(harvest_source_id=harvest_source_id, fl=fl,
+                                                modified_since=modified_since,
+                                                sort='metadata_modified asc')
+        elif self.listing_workers > 1:
+            pages = cpa.search_harvest_packages_in_parallel(harvest_source_id=harvest_source_id,
+                                                            workers=self.listing_workers,
+                                                            rows=self.listing_rows,
+                                                            max_rows=self.listing_max_rows,
+                                                            page_seconds=self.listing_page_seconds,
+                                                            fl=fl,
+                                                            modified_since=modified_since)
+        else:
+            pages = cpa.search_harvest_packages(harvest_source_id=harvest_source_id, fl=fl)
 
         page = 0
-        for datasets in cpa.search_harvest_packages(harvest_source_id=harvest_source_id):
+        for datasets in pages:
             # getting resources in pages of packages
             page += 1
             logger.info('PAGE {} from harvest source id: {}'.format(page, harvest_source_id))
-            for dataset in datasets:
-                pkg_resources = len(dataset['resources'])
-                resources += pkg_resources
-                yield(dataset)
+            if self.slim_listing:
+                datasets = [normalize_slim_package(dataset) for dataset in datasets]
+            yield datasets
 
-        logger.info('{} total resources in harvest source id: {}'.format(resources, harvest_source_id))
+    def yield_datasets(self, harvest_source_id, save_results_json_path=None, snapshot_path=None):
+        """ yield all the packages from one harvest source at CKAN
+            Params:
+                save_results_json_path: save all the packages as a JSON list
+                snapshot_path: use (and update) a local snapshot if "ckan_snapshot" is enabled """
+        
+        logger.info(f'Extracting from harvest source id: {harvest_source_id}')
+        if self.snapshot and snapshot_path is not None:
+            yield from self.yield_datasets_from_snapshot(harvest_source_id, snapshot_path)
+            return
+
+        packages = (dataset for datasets in self.iter_packages(harvest_source_id=harvest_source_id)
+                    for dataset in datasets)
         if save_results_json_path is not None:
-            cpa.save_packages_list(path=save_results_json_path)
+            # saved while listing, we don't keep all the packages in memory
+            packages = save_json_list(save_results_json_path)(packages)
+
+        resources = 0
+        for dataset in packages:
+            pkg_resources = len(dataset.get('resources', []))
+            resources += pkg_resources
+            yield(dataset)
+
+        logger.info('{} total resources in harvest source id: {}'.format(resources, harvest_source_id))
+
+    def get_snapshot_settings(self, harvest_source_id):
+        """ a snapshot is valid only for the same source and listing type """
+        return {'harvest_source_id': harvest_source_id, 'slim_listing': self.slim_listing}
+
+    def yield_datasets_from_snapshot(self, harvest_source_id, snapshot_path):
+        """ update the local snapshot with the packages modified since the last harvest
+            (or all of them in a full sync) and yield all the packages from the snapshot """
+        snapshot = CKANSnapshot(path=snapshot_path)
+        runs = snapshot.get_info('runs_since_full_sync', None)
+        high_water_mark = snapshot.high_water_mark()
+        full_sync = (self.snapshot_full_sync or
+                     runs is None or
+                     runs + 1 >= self.snapshot_full_sync_every or
+                     high_water_mark is None or
+                     snapshot.get_info('settings') != self.get_snapshot_settings(harvest_source_id))
+
+        if full_sync:
+            logger.info('Full sync of the CKAN snapshot')
+            snapshot.reset()
+            modified_since = None
+        else:
+            modified_since = solr_date(high_water_mark)
+            logger.info(f'Incremental sync of the CKAN snapshot. Packages modified since {modified_since}')
+
+        updated = 0
+        for datasets in self.iter_packages(harvest_source_id=harvest_source_id, modified_since=modified_since):
+            snapshot.add_many(datasets)
+            updated += len(datasets)
+
+        snapshot.set_info('settings', self.get_snapshot_settings(harvest_source_id))
+        snapshot.set_info('runs_since_full_sync', 0 if full_sync else runs + 1)
+        logger.info(f'{updated} packages updated at the CKAN snapshot, {snapshot.count()} total')
+
+        yield from snapshot.packages()
+        snapshot.close()
+
+    def forget_packages(self, snapshot_path, ckan_ids):
+        """ remove packages from the snapshot (e.g. we deleted them) """
+        if not self.snapshot or len(ckan_ids) == 0:
+            return
+        snapshot = CKANSnapshot(path=snapshot_path)
+        snapshot.remove_many(ckan_ids)
+        snapshot.close()
@@ -4,6 +4,7 @@ import logging
 import os
 from abc import ABC, abstractmethod
 from harvester_ng import helpers
+from harvester_ng.datajson.streaming import iter_datajson_datasets
 from harvester_ng.logs import logger
 from tools.results.harvested_source import HarvestedSource
 from slugify import slugify
@@ -23,7 +24,7 @@ class HarvestSource(ABC):
         self.destination = destination
         self.destination.source = self
         self.url = kwargs.get('url', None)  # url to harvest from
-        config = kwargs.get('config', {})  # configuration (e.g validation_schema)
+        config = kwargs.get('config', None) or {}  # configuration (e.g validation_schema)
         if type(config) == str:
             self.config = json.loads(config)
         else:
@@ -31,6 +32,15 @@ class HarvestSource(ABC):
         
         # limit the number of resources to harvest
         self.limit_datasets = 0
+
+        # info about the last fetched source (ETag, Last-Modified, content digest)
+        self.data_cache_info = None
+        # the source didn't change since the last harvest, nothing to do
+        self.source_unchanged = False
+        # summary of duplicated identifiers found at source
+        self.duplicates_summary = None
+        # seconds spent in some harvest stages
+        self.timings = {}
     
     @abstractmethod
     def download(self):
@@ -39,16 +49,11 @@ class HarvestSource(ABC):
         pass
 
     def save_download_results(self, flow_results):
-        """ save results (data package and final datasets results) """
-        dest = self.get_download_result_path()
-        logger.info(f'Saving downloaded results to {dest}')
-        dmp = json.dumps(flow_results[0][0], indent=2)
-        f = open(dest, 'w')
-        f.write(dmp)
-        f.close()
-
-        pkg = flow_results[1]  # package returned
+        """ save the data package. The rows are saved (as JSON lines) by the download flow """
+        # (rows, package, stats) from Flow.results() or (package, stats) from Flow.process()
+        pkg = flow_results[-2]  # package returned
         pkg.save(self.get_data_package_result_path())
+        self.export_pretty_results(self.get_download_result_path(create=False))
 
     @abstractmethod
     def compare(self):
@@ -56,15 +61,10 @@ class HarvestSource(ABC):
         pass
 
     def save_compare_results(self, flow_results):
-        dest = self.get_comparison_result_path()
-        logger.info(f'Saving compared results to {dest}')
-        dmp = json.dumps(flow_results[0][0], indent=2)
-        f = open(dest, 'w')
-        f.write(dmp)
-        f.close()
-
-        pkg = flow_results[1]  # package returned
+        """ save the data package. The rows are saved (as JSON lines) by the compare flow """
+        pkg = flow_results[-2]  # package returned
         pkg.save(self.get_comparison_data_package_result_path())
+        self.export_pretty_results(self.get_comparison_result_path(create=False))
 
     @abstractmethod
     def write_destination(self):
@@ -72,13 +72,16 @@ class HarvestSource(ABC):
         pass
 
     def save_write_results(self, flow_results):
-        """ save results """
-        path = self.get_comparison_result_path()
-        logger.info(f'Saving write results to {path}, res {flow_results[0][0]}')
-        dmp = json.dumps(flow_results[0][0], indent=2)
-        f = open(path, 'w')
-        f.write(dmp)
-        f.close()
+        """ the rows are saved (as JSON lines) by the write flow """
+        self.export_pretty_results(self.get_write_result_path(create=False))
+
+    def export_pretty_results(self, path):
+        """ save a copy of a JSON lines results file as indented JSON (if "pretty_results" is set) """
+        if not self.config.get('pretty_results', False) or not os.path.isfile(path):
+            return
+        dest = os.path.splitext(path)[0] + '.json'
+        logger.info(f'Saving pretty results to {dest}')
+        helpers.export_pretty_json(source_path=path, dest_path=dest)
 
     def write_final_report(self):
         dest = self.get_final_json_results_for_report_path()
@@ -87,6 +90,13 @@ class HarvestSource(ABC):
         hs = HarvestedSource(harvest_source_obj=self)
         hs.process_results()
 
+        # we only trust the source cache info if all the changes were saved
+        if not self.source_unchanged:
+            if hs.has_fails():
+                logger.info('Some actions failed, the next harvest will not skip this source')
+            else:
+                self.save_data_cache_info()
+
         # write results
         results = hs.get_json_data()
         f = open(dest, 'w')
@@ -95,6 +105,43 @@ class HarvestSource(ABC):
 
         hs.render_template(save=True)
 
+    def get_previous_data_cache_info(self):
+        """ info about the source the last time it was fully harvested """
+        info = self.get_json_data_or_none(self.get_data_cache_info_path(create=False))
+        if info is None or 'error' in info:
+            return {}
+        return info
+
+    def save_data_cache_info(self):
+        if self.data_cache_info is None:
+            return
+        dest = self.get_data_cache_info_path()
+        logger.info(f'Saving source cache info to {dest}')
+        f = open(dest, 'w')
+        f.write(json.dumps(self.data_cache_info, indent=2))
+        f.close()
+
+    def save_duplicates_summary(self):
+        """ save the summary of duplicated identifiers found at source """
+        if self.duplicates_summary is None:
+            return
+        f = open(self.get_duplicates_path(), 'w')
+        f.write(json.dumps(self.duplicates_summary, indent=2))
+        f.close()
+
+    def save_destination_stats(self):
+        """ save the destination stats (e.g. retries and throttle state) """
+        stats = self.destination.get_stats()
+        logger.info(f'Destination stats: {stats}')
+        f = open(self.get_destination_stats_path(), 'w')
+        f.write(json.dumps(stats, indent=2))
+        f.close()
+
+    def save_timings(self):
+        f = open(self.get_timings_path(), 'w')
+        f.write(json.dumps(self.timings, indent=2))
+        f.close()
+
     def get_base_path(self):
         """ Get path for some resource (described as string).
             If none, return the base folder """
@@ -120,9 +167,35 @@ class HarvestSource(ABC):
 
         return data_packages_folder_path
     
+    def get_staging_path(self):
+        """ local path for the staging store (SQLite file with all the datasets from source) """
+        return os.path.join(self.get_base_path(), 'staging.db')
+
+    def get_ckan_snapshot_path(self):
+        """ local path for the snapshot of the CKAN packages (SQLite file, persistent between harvests) """
+        return os.path.join(self.get_base_path(), 'ckan-snapshot.db')
+
+    def get_destination_spool_path(self):
+        """ local path for the destination datasets listed in background (JSON lines) """
+        return os.path.join(self.get_base_path(), 'destination-spool.jsonl')
+
+    def get_write_journal_path(self):
+        """ local path for the journal of actions written at the destination (JSON lines) """
+        return os.path.join(self.get_base_path(), 'write-journal.jsonl')
+
+    def can_resume(self):
+        """ we have the compare results and the journal from a previous harvest """
+        compare_results = self.get_comparison_result_path(create=False)
+        return (os.path.isfile(self.get_write_journal_path()) and
+                os.path.isfile(compare_results) and os.path.getsize(compare_results) > 0)
+
+    def get_validation_cache_path(self):
+        """ local path for the validation cache (SQLite file, persistent between harvests) """
+        return os.path.join(self.get_base_path(), 'validation-cache.db')
+
     def get_download_result_path(self, create=True):
-        """ local path for flow1 results file """
-        return self.get_file(resource='download-results.json', create=create)
+        """ local path for flow1 results file (JSON lines) """
+        return self.get_file(resource='download-results.jsonl', create=create)
 
     def get_data_package_result_path(self, create=True):
         """ local path for flow1 file """
@@ -133,7 +206,12 @@ class HarvestSource(ABC):
         return self.get_file(resource='ckan-results.json', create=create)
     
     def get_comparison_result_path(self, create=True):
-        return self.get_file(resource='compare-datasets-results.json', create=create)
+        """ local path for flow2 results file (JSON lines) """
+        return self.get_file(resource='compare-datasets-results.jsonl', create=create)
+
+    def get_write_result_path(self, create=True):
+        """ local path for flow3 results file (JSON lines) """
+        return self.get_file(resource='write-results.jsonl', create=create)
     
     def get_comparison_data_package_result_path(self, create=True):
         """ local path for data packages comparison results file """
@@ -143,10 +221,26 @@ class HarvestSource(ABC):
         """ local path for json source file """
         return self.get_file(resource='data.json', create=create)
         
+    def get_data_cache_info_path(self, create=True):
+        """ local path for the ETag, Last-Modified and digest of the json source file """
+        return self.get_file(resource='data-cache-info.json', create=create)
+
     def get_errors_path(self, create=True):
         """ local path for errors """
         return self.get_file(resource='errors.json', create=create)
     
+    def get_duplicates_path(self, create=True):
+        """ local path for the duplicated identifiers summary """
+        return self.get_file(resource='duplicates.json', create=create)
+
+    def get_destination_stats_path(self, create=True):
+        """ local path for the stats about the calls to the destination """
+        return self.get_file(resource='destination-stats.json', create=create)
+
+    def get_timings_path(self, create=True):
+        """ local path for the seconds spent in some harvest stages """
+        return self.get_file(resource='timings.json', create=create)
+
     def get_final_json_results_for_report_path(self, create=True):
         return self.get_file(resource='final-results.json', create=create)
     
@@ -165,13 +259,34 @@ class HarvestSource(ABC):
             f.close()
             return j
 
+    def get_data_summary(self, path):
+        """ catalog values and datasets count of the cached data.json.
+            Read as a stream, we don't load the full catalog for the report """
+        if not os.path.isfile(path):
+            return None
+        headers = {}
+        f = open(path, 'rb')
+        try:
+            datasets = sum(1 for dataset in iter_datajson_datasets(fileobj=f, headers=headers))
+            summary = {'headers': headers, 'datasets': datasets}
+        except Exception as e:
+            summary = {'error': str(e)}
+        f.close()
+        return summary
+
     def get_report_files(self):
         """ Collect important files to write a final report """
         data_file = self.get_data_cache_path(create=False)
-        results_file = self.get_comparison_result_path(create=False)
+        results_file = self.get_write_result_path(create=False)
         errors_file = self.get_errors_path(create=False)
+        duplicates_file = self.get_duplicates_path(create=False)
+        timings_file = self.get_timings_path(create=False)
+        destination_stats_file = self.get_destination_stats_path(create=False)
 
-        return {'data': self.get_json_data_or_none(data_file),
-                'results': self.get_json_data_or_none(results_file),
-                'errors': self.get_json_data_or_none(errors_file)
+        return {'data': self.get_data_summary(data_file),
+                'results_file': results_file,  # JSON lines, could be huge. Read it as a stream
+                'errors': self.get_json_data_or_none(errors_file),
+                'duplicates': self.get_json_data_or_none(duplicates_file),
+                'timings': self.get_json_data_or_none(timings_file),
+                'destination_stats': self.get_json_data_or_none(destination_stats_file)
                 }
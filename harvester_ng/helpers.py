@@ -3,6 +3,7 @@ import hashlib
 import json
 import os
 import sys
+import time
 
 
 # we need a way to save as file using an unique identifier
@@ -70,4 +71,91 @@ def read_ckan_api_key_from_db(sql_alchemy_url, user='admin'):
 
     result.close()
     return row['apikey'], None
-    
\ No newline at end of file
+    
+
+def timed_rows(step, timings, name):
+    """ wrap a rows processor (a function that gets and yields rows) and
+        add to timings[name] the seconds spent inside it (not in the previous steps) """
+
+    def f(rows):
+        upstream = 0
+
+        def source():
+            nonlocal upstream
+            iterator = iter(rows)
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    upstream += time.perf_counter() - start
+                yield row
+
+        iterator = iter(step(source()))
+        total = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                total += time.perf_counter() - start
+            yield row
+        timings[name] = timings.get(name, 0) + total - upstream
+
+    return f
+
+
+def save_rows(path):
+    """ rows processor: save the rows (as JSON lines) while they pass.
+        Rows are written to a temporary file, renamed to "path" when all of them are saved """
+
+    def f(rows):
+        tmp_path = f'{path}.tmp'
+        out = open(tmp_path, 'w')
+        for row in rows:
+            out.write(json.dumps(row) + '\n')
+            yield row
+        out.close()
+        os.replace(tmp_path, path)
+
+    return f
+
+
+def read_rows(path):
+    """ yield the rows saved as JSON lines """
+    f = open(path, 'r')
+    try:
+        for line in f:
+            if line.strip() != '':
+                yield json.loads(line)
+    finally:
+        f.close()
+
+
+def save_json_list(path):
+    """ rows processor: save the rows as an indented JSON list (for humans) while they pass.
+        One row in memory at a time """
+
+    def f(rows):
+        out = open(path, 'w')
+        out.write('[')
+        separator = '\n'
+        for row in rows:
+            dmp = json.dumps(row, indent=2)
+            out.write(separator + '  ' + dmp.replace('\n', '\n  '))
+            separator = ',\n'
+            yield row
+        out.write('\n]\n')
+        out.close()
+
+    return f
+
+
+def export_pretty_json(source_path, dest_path):
+    """ save the rows from a JSON lines file as an indented JSON list (for humans) """
+    for row in save_json_list(dest_path)(read_rows(source_path)):
+        pass
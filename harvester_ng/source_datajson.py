@@ -1,9 +1,11 @@
 import os
 import hashlib
+import ijson
 import json
 import logging
 import pytz
 import requests
+import time
 
 from datetime import datetime
 from dataflows import Flow, add_field, load, update_resource, printer
@@ -12,17 +14,29 @@ from harvesters.datajson.harvester import DataJSON
 from harvesters import config
 
 from harvester_ng.logs import logger
+from harvester_ng.helpers import timed_rows, save_rows
 from harvester_ng.harvest_source import HarvestSource
-from harvester_ng.datajson.flows import (clean_duplicated_identifiers,
+from harvester_ng.datajson.flows import (remove_duplicates,
                                     validate_datasets,
-                                    save_as_data_packages,
+                                    save_to_staging,
+                                    mark_collections_in_staging,
                                     compare_resources)
+from harvester_ng.datajson.validation import validate_datasets_in_pool
+from harvester_ng.datajson.streaming import TeeReader, iter_datajson_datasets
+from harvester_ng.write_journal import WriteJournal
+from harvester_ng.spool import BackgroundSpool
 from harvester_ng.datajson.flows_ckan import (write_results,
+                                              hydrate_packages,
+                                              order_parents_first,
                                               assing_collection_pkg_id)
 
 
 logger = logging.getLogger(__name__)
 DEFAULT_VALIDATOR_SCHEMA = 'federal-v1.1'
+# full: validate the full catalog (including datasets) and then each dataset
+# single-pass: validate only the catalog values and structure, datasets are validated once
+VALIDATION_MODES = ['full', 'single-pass']
+STREAMING_HEADERS_HINT = 'Streaming requires the catalog values before the "dataset" list, disable it for this source'
 
 
 class HarvestDataJSON(HarvestSource):
@@ -31,38 +45,162 @@ class HarvestDataJSON(HarvestSource):
     def __init__(self, name, *args, **kwargs):
         super().__init__(name, *args, **kwargs)
         self.validator_schema = self.config.get('validator_schema', DEFAULT_VALIDATOR_SCHEMA)
+        # parse the data.json as a stream (do not load the full catalog in memory)
+        self.streaming = self.config.get('streaming', False)
+        # which dataset to keep if the identifier is duplicated (see DEDUP_POLICIES)
+        self.dedup_policy = self.config.get('dedup_policy', 'first')
+        self.duplicates_summary = {}
+        # processes to validate datasets (0: no pool, -1: all the CPUs)
+        # validate datasets with the catalog and then one by one or just one by one
+        self.validation_mode = self.config.get('validation_mode', 'full')
+        if self.validation_mode not in VALIDATION_MODES:
+            raise Exception(f'Unknown validation mode "{self.validation_mode}". Use one of {VALIDATION_MODES}')
+        if self.streaming and self.validation_mode == 'full':
+            # we never have the full catalog, just the catalog values
+            if 'validation_mode' in self.config:
+                logger.warning('Streaming sources can not validate the full catalog, using single-pass validation')
+            self.validation_mode = 'single-pass'
+        self.validation_workers = int(self.config.get('validation_workers', 0))
+        # save validation errors by dataset hash and skip validation for unchanged datasets
+        self.validation_cache = self.config.get('validation_cache', False)
+        # runs without seeing a dataset before removing it from the validation cache
+        self.validation_cache_runs = int(self.config.get('validation_cache_runs', 5))
+        # use ETag, Last-Modified and content digest to skip unchanged sources
+        self.conditional_get = self.config.get('conditional_get', True)
+        # list the destination datasets in background while downloading: false, "disk" or "memory"
+        self.destination_prefetch = self.config.get('destination_prefetch', False)
+        if self.destination_prefetch not in [False, 'disk', 'memory']:
+            raise Exception(f'Unknown destination_prefetch value "{self.destination_prefetch}"')
+        self.prefetch = None  # BackgroundSpool with the destination datasets
         self.source_datasets = []
+        # collections (isPartOf) identifiers detected while streaming
+        self.collection_identifiers = set()
         logger.debug('New HarvestDataJSON object')
 
-    def download(self):
-        """ donwload, validate and save as data packages """
+    def download(self, keep_results=True, save_results=True):
+        """ donwload, validate and save as data packages
+            keep_results: return all the rows (if not, just the data package and stats)
+            save_results: save the rows (JSON lines) at the download results file """
         logger.info(f'Downloading from data.json source {self.url}')
-        save_to = self.get_data_packages_folder_path()
-        res = Flow(
-            # get data.json and yield all datasets
-            # validate headers and save the validation errors
-            self.get_data_json_from_url(validator_schema=self.validator_schema),
-            update_resource('res_1', name='datajson', path='datajson.csv'),
+        self.source_unchanged = False
+        self.timings.clear()
+        if self.destination_prefetch:
+            self.start_prefetch()
 
-            # remove duplicates
-            clean_duplicated_identifiers,
+        compare = False  # the prefetched datasets are just required to compare
+        try:
+            # get data.json, validate headers and save the validation errors
+            datasets = self.get_data_json_from_url(validator_schema=self.validator_schema)
+            if datasets is None:
+                # nothing changed, keep the staging store and the previous results
+                return None
+
+            save_to = self.get_staging_path()
+            flow = Flow(
+                # yield all datasets
+                datasets,
+                update_resource('res_1', name='datajson', path='datajson.csv'),
+
+                # remove duplicates
+                remove_duplicates(policy=self.dedup_policy, summary=self.duplicates_summary),
+
+                # validate each dataset
+                self.get_validation_step(),
+
+                # save each dataset in the staging store
+                save_to_staging(path=save_to),
 
-            # validate each dataset
-            validate_datasets,
+                save_rows(path=self.get_download_result_path()) if save_results else None,
+            )
+            res = flow.results() if keep_results else flow.process()
+            compare = not self.source_unchanged
+        finally:
+            if not compare:
+                # the source didn't change or the download failed
+                self.stop_prefetch()
 
-            # save each dataset as data package
-            save_as_data_packages(path=save_to),
-        ).results()
+        self.save_duplicates_summary()
+        logger.info(f'Validation timings ({self.validation_mode}): {self.timings}')
+        self.save_timings()
+
+        if self.streaming:
+            # parents could be readed before their children, mark them at the end
+            mark_collections_in_staging(path=save_to, identifiers=self.collection_identifiers)
 
         return res
 
-    def compare(self):
-        """ compare new vs previous resources """
+    def get_validation_step(self):
+        """ validate row by row or in a pool of processes """
+        workers = self.validation_workers
+        if not self.validation_cache and workers == 0:
+            def step(rows):
+                for row in rows:
+                    validate_datasets(row)
+                    yield row
+        elif not self.validation_cache:
+            step = validate_datasets_in_pool(workers=None if workers < 0 else workers)
+        else:
+            step = validate_datasets_in_pool(workers=None if workers < 0 else workers,
+                                             cache_path=self.get_validation_cache_path(),
+                                             cache_max_runs=self.validation_cache_runs)
+
+        return timed_rows(step, timings=self.timings, name='datasets_validation')
+
+    def validate_catalog(self, datajson, validator_schema):
+        """ validate the data.json catalog.
+            In "single-pass" mode we only validate the catalog values and the structure,
+            datasets are validated (just once) at the validation step
+            Returns: Boolean """
+        start = time.perf_counter()
+        if self.validation_mode == 'full':
+            ret = datajson.validate(validator_schema=validator_schema)
+        else:
+            ret = self.validate_catalog_structure(datajson, validator_schema=validator_schema)
+        self.timings['catalog_validation'] = time.perf_counter() - start
+        return ret
+
+    def validate_catalog_structure(self, datajson, validator_schema):
+        """ validate the catalog values with an empty datasets list """
+        if datajson.raw_data_json is not None:
+            try:
+                datajson.data_json = json.loads(datajson.raw_data_json)
+            except Exception as e:
+                error = 'ERROR parsing JSON: {}. Data: {}'.format(e, datajson.raw_data_json)
+                datajson.errors.append(error)
+                logger.error(error)
+                return False
+            datajson.raw_data_json = None
+
+        data_json = datajson.data_json
+        if type(data_json) == dict:
+            if type(data_json.get('dataset', None)) != list:
+                error = 'The data.json "dataset" value must be a list'
+                datajson.errors.append(error)
+                logger.error(error)
+                return False
+            datajson.data_json = dict(data_json, dataset=[])
+
+        ret = datajson.validate(validator_schema=validator_schema)
+        datajson.data_json = data_json
+        return ret
+
+    def compare(self, keep_results=True):
+        """ compare new vs previous resources.
+            The rows are saved (JSON lines) at the compare results file """
         logger.info(f'Comparing resources')
-        data_packages_path = self.get_data_packages_folder_path()
-        res = Flow(
+        flow = Flow(
+            *self.get_compare_steps(),
+            save_rows(path=self.get_comparison_result_path()),
+        )
+        res = flow.results() if keep_results else flow.process()
+        return res
+
+    def get_compare_steps(self):
+        """ dataflows steps to compare the staged datasets with the CKAN packages """
+        staging_path = self.get_staging_path()
+        return [
             # add other resource to this process. The packages list from data.gov
-            self.get_current_ckan_resources_from_api(harvest_source_id=self.destination.harvest_source_id),
+            self.get_destination_datasets(),
             update_resource('res_1', name='ckan_results'),
             # new field at this copy for comparasion results
             add_field(name='comparison_results',
@@ -72,35 +210,89 @@ class HarvestDataJSON(HarvestSource):
             # Compare both resources
             # In data.json the datasets have the identifier field: "identifier": "USDA-ERS-00071"
             # In CKAN API results the datasets have the same identifier at "extras" list: {"key": "identifier", "value": "USDA-ERS-00071"}
-            compare_resources(data_packages_path=data_packages_path),
-        ).results()
+            compare_resources(staging_path=staging_path),
 
-        return res
+            # read the full packages to update (if we got just some fields from CKAN)
+            hydrate_packages(self.destination) if self.destination.slim_listing else None,
+        ]
 
-    def write_destination(self):
+    def write_destination(self, resume=False, keep_results=True):
+        """ resume: skip the actions saved at the write journal by a previous harvest """
         source = self.get_comparison_result_path()
         logger.info(f'Writting to destination: {self.destination} data from {source}')
-        
-        res = Flow(
-            load(load_source=source),
+        steps = [load(load_source=source, format='ndjson')]
+        return self.write_rows(steps=steps, resume=resume, keep_results=keep_results)
+
+    def write_rows(self, steps, resume=False, keep_results=True):
+        """ write at the destination the compare results from "steps" (dataflows steps).
+            The rows are saved (JSON lines) at the write results file """
+        journal = WriteJournal(path=self.get_write_journal_path(), resume=resume)
+        deleted = []
+
+        def collect_deleted(rows):
+            # the CKAN snapshot will not see our deletes in the next incremental sync
+            for row in rows:
+                comparison_results = row['comparison_results']
+                if comparison_results['action'] == 'delete' and comparison_results['action_results']['success']:
+                    deleted.append(comparison_results['ckan_id'])
+                yield row
+
+        flow = Flow(
+            *steps,
+            # collections first, then we can save the collection ID with each dataset
+            order_parents_first(),
             # fails self.destination.write_results,
-            write_results(self.destination),
+            write_results(self.destination, journal=journal, staging_path=self.get_staging_path()),
 
             # fails self.destination.assing_collection_pkg_id,
             assing_collection_pkg_id(self.destination),
 
-        ).results()
-    
+            collect_deleted,
+            save_rows(path=self.get_write_result_path()),
+        )
+        res = flow.results() if keep_results else flow.process()
+        journal.close()
+
+        self.destination.forget_packages(snapshot_path=self.get_ckan_snapshot_path(), ckan_ids=deleted)
+
+        self.save_destination_stats()
         return res
 
+    def harvest(self, save_debug_files=False, keep_results=True):
+        """ fused mode: download, compare and write in one process.
+            Compare results go straight to the write steps (not saved and loaded again).
+            save_debug_files: also save the download and compare results (required to resume)
+            keep_results: return all the write results (if not, just the data package and stats)
+            Returns the write results (None if the source didn't change) """
+        res = self.download(keep_results=False, save_results=save_debug_files)
+        if self.source_unchanged:
+            return None
+        if save_debug_files:
+            self.save_download_results(flow_results=res)
+
+        compare_results_path = self.get_comparison_result_path(create=False)
+        steps = self.get_compare_steps()
+        if save_debug_files:
+            steps.append(save_rows(path=compare_results_path))
+        elif os.path.isfile(compare_results_path):
+            # previous results, not valid to resume this harvest
+            os.remove(compare_results_path)
+
+        return self.write_rows(steps=steps, keep_results=keep_results)
+
     def get_data_json_from_url(self, validator_schema):
+        """ fetch (conditional GET), validate and save the data.json.
+            Returns: a generator with the datasets (None if the data.json didn't change) """
+        if self.streaming:
+            return self.get_data_json_streaming_from_url(validator_schema=validator_schema)
+
         logger.info(f'Geting data.json from {self.url}')
         self.source_datasets = []
         datajson = DataJSON()
         datajson.url = self.url
 
         try:
-            datajson.fetch(timeout=90)
+            changed = self.fetch_data_json(datajson, timeout=90)
             ret = True
         except Exception as e:
             ret = False
@@ -109,9 +301,13 @@ class HarvestDataJSON(HarvestSource):
             datajson.save_errors(path=self.get_errors_path())
             logger.error(error)
             raise Exception(error)
+        if not changed:
+            self.source_unchanged = True
+            logger.info(f'The data.json did not change since the last harvest')
+            return None
         logger.info('Downloaded OK')
 
-        ret = datajson.validate(validator_schema=validator_schema)
+        ret = self.validate_catalog(datajson, validator_schema=validator_schema)
         if not ret:
             error = 'Error validating data: {}'.format(datajson.errors)
             logger.error(error)
@@ -131,6 +327,9 @@ class HarvestDataJSON(HarvestSource):
 
         if self.limit_datasets > 0:
             datajson.datasets = datajson.datasets[:self.limit_datasets]
+        return self.yield_datasets(datajson, validator_schema=validator_schema)
+
+    def yield_datasets(self, datajson, validator_schema):
         for dataset in datajson.datasets:
             # add headers (previously called catalog_values)
             dataset['headers'] = datajson.headers
@@ -138,10 +337,215 @@ class HarvestDataJSON(HarvestSource):
             yield(dataset)
             self.source_datasets.append(dataset)
 
+    def get_data_json_streaming_from_url(self, validator_schema):
+        """ request the data.json to read it as a stream (see yield_streaming_datasets).
+            Returns: a generator with the datasets (None if the data.json didn't change) """
+        logger.info(f'Streaming data.json from {self.url}')
+        self.source_datasets = []
+        self.collection_identifiers = set()
+        datajson = DataJSON()
+        datajson.url = self.url
+
+        try:
+            req = requests.get(self.url,
+                               headers=self.get_conditional_request_headers(),
+                               stream=True,
+                               timeout=90)
+        except Exception as e:
+            datajson.errors.append('ERROR Donwloading data: {} [{}]'.format(self.url, e))
+            req = None
+        if req is not None and req.status_code == 304:
+            req.close()
+            self.source_unchanged = True
+            logger.info(f'The data.json did not change since the last harvest (HTTP 304)')
+            return None
+        if req is not None and req.status_code >= 400:
+            datajson.errors.append('{} HTTP error: {}'.format(self.url, req.status_code))
+        if req is None or req.status_code >= 400:
+            error = 'Error getting data: {}'.format(datajson.errors)
+            datajson.save_errors(path=self.get_errors_path())
+            logger.error(error)
+            raise Exception(error)
+
+        return self.yield_streaming_datasets(req, datajson, validator_schema=validator_schema)
+
+    def yield_streaming_datasets(self, req, datajson, validator_schema):
+        """ read the data.json as a stream and yield each dataset as soon as it is parsed.
+            Headers are validated before the first dataset is yielded, so they must be
+            before the "dataset" list (we fail if we find catalog values after it).
+            Datasets are not kept at self.source_datasets (we want bounded memory) """
+        req.raw.decode_content = True
+        headers = {}
+        c = 0
+        complete = True
+        digest = hashlib.sha256()
+        # save the original data.json while we read it
+        with open(self.get_data_cache_path(), 'wb') as cache:
+            reader = TeeReader(source=req.raw, sink=cache, hasher=digest)
+            try:
+                for dataset in iter_datajson_datasets(fileobj=reader, headers=headers):
+                    if c == 0:
+                        self.validate_streaming_headers(datajson, headers, validator_schema,
+                                                        hint=STREAMING_HEADERS_HINT)
+                    c += 1
+                    if type(dataset) != dict:
+                        error = f'Error validating data: the dataset #{c} is not a JSON object'
+                        datajson.errors.append(error)
+                        datajson.save_errors(path=self.get_errors_path())
+                        logger.error(error)
+                        raise Exception(error)
+
+                    # detect collections, the parents are marked later
+                    parent = dataset.get('isPartOf', None)
+                    if parent is not None:
+                        dataset['collection_pkg_id'] = ''
+                        self.collection_identifiers.add(parent)
+
+                    dataset['headers'] = datajson.headers
+                    dataset['validator_schema'] = validator_schema
+                    yield(dataset)
+
+                    if self.limit_datasets > 0 and c >= self.limit_datasets:
+                        complete = False
+                        break
+            except (ijson.JSONError, ValueError) as e:
+                error = 'ERROR parsing JSON: {}'.format(e)
+                datajson.errors.append(error)
+                datajson.save_errors(path=self.get_errors_path())
+                logger.error(error)
+                raise Exception(error)
+            finally:
+                req.close()
+
+        if c == 0:
+            self.validate_streaming_headers(datajson, headers, validator_schema)
+        else:
+            # the datasets we already yielded (and saved) don't have these catalog values
+            late_headers = [key for key in headers.keys() if key not in datajson.headers]
+            if len(late_headers) > 0:
+                error = f'Catalog values found after the "dataset" list: {late_headers}. {STREAMING_HEADERS_HINT}'
+                datajson.errors.append(error)
+                datajson.save_errors(path=self.get_errors_path())
+                logger.error(error)
+                raise Exception(error)
+
+        logger.info('{} datasets found ({} bytes readed)'.format(c, reader.bytes_read))
+        datajson.save_errors(path=self.get_errors_path())
+
+        if complete:
+            # we already yielded the datasets but we can skip compare and write stages
+            changed = self.set_data_cache_info(response_headers=req.headers, digest=digest.hexdigest())
+            if not changed:
+                self.source_unchanged = True
+                logger.info(f'The data.json did not change since the last harvest')
+
+    def get_conditional_request_headers(self):
+        """ headers for a conditional GET based on the last full harvest of this source """
+        if not self.conditional_get:
+            return {}
+        previous = self.get_previous_data_cache_info()
+        if previous.get('url') != self.url or previous.get('config') != self.get_cache_config():
+            return {}
+
+        headers = {}
+        if previous.get('etag') is not None:
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified') is not None:
+            headers['If-Modified-Since'] = previous['last_modified']
+        return headers
+
+    def get_cache_config(self):
+        """ values that change results even if the data.json is the same """
+        return {'config': self.config, 'limit_datasets': self.limit_datasets}
+
+    def set_data_cache_info(self, response_headers, digest):
+        """ save the new cache info and check (by content digest) if the source changed
+            Returns: Boolean (if the data.json changed) """
+        previous = self.get_previous_data_cache_info()
+        self.data_cache_info = {
+            'url': self.url,
+            'etag': response_headers.get('ETag', None),
+            'last_modified': response_headers.get('Last-Modified', None),
+            'sha256': digest,
+            'config': self.get_cache_config()
+            }
+
+        if not self.conditional_get:
+            return True
+        same_source = previous.get('url') == self.url and previous.get('config') == self.get_cache_config()
+        return not same_source or previous.get('sha256') != digest
+
+    def fetch_data_json(self, datajson, timeout=30):
+        """ conditional GET for the data.json file (same errors as DataJSON.fetch)
+            Returns: Boolean (if the data.json changed since the last full harvest) """
+        logger.info(f'Fetching data from {self.url}')
+        try:
+            req = requests.get(self.url, headers=self.get_conditional_request_headers(), timeout=timeout)
+        except Exception as e:
+            error = 'ERROR Donwloading data: {} [{}]'.format(self.url, e)
+            datajson.errors.append(error)
+            logger.error(error)
+            raise
+
+        logger.info(f'Data fetched status {req.status_code}')
+        if req.status_code == 304:
+            return False
+
+        if req.status_code >= 400:
+            error = '{} HTTP error: {}'.format(self.url, req.status_code)
+            datajson.errors.append(error)
+            logger.error(error)
+            raise Exception(error)
+
+        datajson.raw_data_json = req.content
+        content = req.content if type(req.content) == bytes else req.content.encode('utf-8')
+        digest = hashlib.sha256(content).hexdigest()
+        return self.set_data_cache_info(response_headers=req.headers, digest=digest)
+
+    def validate_streaming_headers(self, datajson, headers, validator_schema, hint=None):
+        """ validate the catalog values (without datasets) readed from a stream.
+            hint: added to the error message """
+        datajson.read_dict_data_json(dict(headers, dataset=[]))
+        start = time.perf_counter()
+        ret = datajson.validate(validator_schema=validator_schema)
+        self.timings['catalog_validation'] = self.timings.get('catalog_validation', 0) + time.perf_counter() - start
+        if not ret:
+            error = 'Error validating data: {}'.format(datajson.errors)
+            if hint is not None:
+                error = f'{error}. {hint}'
+            datajson.save_errors(path=self.get_errors_path())
+            logger.error(error)
+            raise Exception(error)
+        datajson.post_fetch()
+        logger.info('Validate headers OK')
+
+    def start_prefetch(self):
+        """ start to list the destination datasets in a background thread """
+        path = self.get_destination_spool_path() if self.destination_prefetch == 'disk' else None
+        logger.info(f'Listing destination datasets in background (spool: {path})')
+        datasets = self.get_current_ckan_resources_from_api(harvest_source_id=self.destination.harvest_source_id)
+        self.prefetch = BackgroundSpool(iterable=datasets, path=path).start()
+
+    def stop_prefetch(self):
+        """ stop the background listing (if any) and wait for it """
+        if self.prefetch is not None:
+            self.prefetch.stop()
+            self.prefetch = None
+
+    def get_destination_datasets(self):
+        """ datasets from the destination, from the background listing if we started it """
+        if self.prefetch is None:
+            return self.get_current_ckan_resources_from_api(harvest_source_id=self.destination.harvest_source_id)
+        prefetch = self.prefetch
+        self.prefetch = None  # just once
+        return iter(prefetch)
+
     def get_current_ckan_resources_from_api(self, harvest_source_id):
         save_results_json_path = self.get_ckan_results_cache_path()
         logger.info(f'Getting destination resources {self.url}')
-        dest = self.destination.yield_datasets(harvest_source_id=harvest_source_id, save_results_json_path=save_results_json_path)
+        dest = self.destination.yield_datasets(harvest_source_id=harvest_source_id,
+                                               save_results_json_path=save_results_json_path,
+                                               snapshot_path=self.get_ckan_snapshot_path())
         for dataset in dest:
-            logger.info(f'Destination resource: {dataset}')
+            logger.debug(f'Destination resource: {dataset["id"]}')
             yield dataset
@@ -0,0 +1,97 @@
+""" Run an iterator in a background thread and keep its items until we read them.
+    Items are saved in a JSON lines file (or in memory) so the consumer
+    could start at any time and read them while the thread is still running """
+import json
+import logging
+import threading
+from harvester_ng.logs import logger
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundSpool:
+    """ iterate "iterable" in a thread. Iterate this object to get the items (in the same order) """
+
+    def __init__(self, iterable, path=None):
+        """ path: JSON lines file for the items. In memory if None """
+        self.iterable = iterable
+        self.path = path
+        self.items = []  # just in memory mode
+        self.count = 0  # items available
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        # create the file before any read
+        out = open(self.path, 'w') if self.path is not None else None
+        self.thread = threading.Thread(target=self.run, args=(out, ), daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self, out):
+        try:
+            for item in self.iterable:
+                if self.cancelled:
+                    break
+                if out is not None:
+                    out.write(json.dumps(item) + '\n')
+                    out.flush()
+                with self.condition:
+                    if out is None:
+                        self.items.append(item)
+                    self.count += 1
+                    self.condition.notify_all()
+        except Exception as e:
+            logger.error(f'Background iteration failed: {e}')
+            self.error = e
+        finally:
+            if self.cancelled and hasattr(self.iterable, 'close'):
+                # e.g. a generator, run its cleanup (stop pending requests)
+                self.iterable.close()
+            if out is not None:
+                out.close()
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def cancel(self):
+        """ stop the thread (after the current item) """
+        self.cancelled = True
+
+    def stop(self):
+        """ cancel and wait for the thread """
+        self.cancel()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __iter__(self):
+        """ yield all the items, waiting for the thread if required.
+            Raise the thread exception (if any) at the end """
+        reader = open(self.path, 'r') if self.path is not None else None
+        position = 0
+        while True:
+            with self.condition:
+                while position >= self.count and not self.done:
+                    self.condition.wait()
+                available = self.count
+                done = self.done
+
+            while position < available:
+                if reader is not None:
+                    item = json.loads(reader.readline())
+                else:
+                    item = self.items[position]
+                position += 1
+                yield item
+
+            if done:
+                break
+
+        if reader is not None:
+            reader.close()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,72 @@
+""" Staging store for harvested datasets
+    All the datasets we read from a source (in one harvest run) are saved
+    in a single SQLite file, keyed and indexed by the dataset identifier """
+import json
+import logging
+import sqlite3
+from harvester_ng.logs import logger
+
+
+logger = logging.getLogger(__name__)
+
+
+class StagingStore:
+    """ datasets from a harvest source keyed by identifier """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS datasets (
+                                identifier TEXT PRIMARY KEY,
+                                data TEXT NOT NULL)""")
+        self.conn.commit()
+
+    def reset(self):
+        """ remove all datasets (start a new harvest run) """
+        with self.conn:
+            self.conn.execute('DELETE FROM datasets')
+
+    def add_many(self, datasets):
+        """ save a list of datasets in one transaction.
+            If the identifier already exists we keep the first one """
+        values = [(dataset['identifier'], json.dumps(dataset)) for dataset in datasets]
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO datasets (identifier, data) VALUES (?, ?)', values)
+
+    def get(self, identifier):
+        """ get a dataset or None if not exists """
+        cursor = self.conn.execute('SELECT data FROM datasets WHERE identifier = ?', (identifier, ))
+        res = cursor.fetchone()
+        return None if res is None else json.loads(res[0])
+
+    def exists(self, identifier):
+        cursor = self.conn.execute('SELECT 1 FROM datasets WHERE identifier = ?', (identifier, ))
+        return cursor.fetchone() is not None
+
+    def update(self, identifier, values):
+        """ update some values of a saved dataset
+            Returns: Boolean (if the dataset exists) """
+        dataset = self.get(identifier)
+        if dataset is None:
+            return False
+        dataset.update(values)
+        with self.conn:
+            self.conn.execute('UPDATE datasets SET data = ? WHERE identifier = ?', (json.dumps(dataset), identifier))
+        return True
+
+    def identifiers(self):
+        """ list of all the identifiers (in the same order we saved them) """
+        cursor = self.conn.execute('SELECT identifier FROM datasets ORDER BY rowid')
+        return [res[0] for res in cursor]
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM datasets').fetchone()[0]
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,151 @@
+""" Rate control for calls to a remote API (e.g. the CKAN destination)
+    - AdaptiveThrottle: AIMD limit of requests in flight, based on errors and latency
+    - CircuitBreaker: pause all the requests while the remote API is unhealthy
+    - backoff_delay: jittered exponential backoff for retries """
+import logging
+import random
+import threading
+import time
+from harvester_ng.logs import logger
+
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt, base=0.5, max_delay=60):
+    """ seconds to wait before retry number "attempt" (starting at 1).
+        Full jitter: a random value up to base * 2^(attempt - 1) """
+    return random.uniform(0, min(max_delay, base * 2 ** (attempt - 1)))
+
+
+class AdaptiveThrottle:
+    """ limit the requests in flight with AIMD (additive increase, multiplicative decrease).
+        The limit grows by one for each "limit" successful requests and it's halved when
+        the remote API fails (e.g. HTTP 429 or 503) or when the latency is too high
+        compared with the baseline latency of the same kind of request (e.g. the CKAN action).
+        The baseline drops at once to a faster latency and slowly follows a slower one,
+        so a sustained (not overloaded) latency becomes the new normal """
+
+    def __init__(self, max_limit, min_limit=1, latency_factor=3, ewma_weight=0.2, baseline_weight=0.1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.latency_factor = latency_factor
+        self.ewma_weight = ewma_weight
+        self.baseline_weight = baseline_weight
+        self.latency = None  # EWMA of the latency (seconds) for all the requests
+        self.latencies = {}  # key -> {'latency': EWMA, 'baseline': slow EWMA}
+        self.in_flight = 0
+        self.decreases = 0
+        self.min_seen_limit = self.limit
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def ewma(self, previous, value, weight):
+        return value if previous is None else weight * value + (1 - weight) * previous
+
+    def on_success(self, latency, key=None):
+        """ key: kind of request, each one has its own baseline latency """
+        with self.condition:
+            self.latency = self.ewma(self.latency, latency, self.ewma_weight)
+            stats = self.latencies.setdefault(key, {'latency': None, 'baseline': None})
+            stats['latency'] = self.ewma(stats['latency'], latency, self.ewma_weight)
+            if stats['baseline'] is None or stats['latency'] < stats['baseline']:
+                stats['baseline'] = stats['latency']
+            else:
+                stats['baseline'] = self.ewma(stats['baseline'], stats['latency'], self.baseline_weight)
+
+            if stats['latency'] > stats['baseline'] * self.latency_factor:
+                self.decrease()
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def on_error(self):
+        with self.condition:
+            self.decrease()
+
+    def decrease(self):
+        """ halve the limit (just once for all the requests in flight when it fails) """
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit / 2)
+        self.min_seen_limit = min(self.min_seen_limit, self.limit)
+        self.decreases += 1
+        logger.info(f'Throttle limit decreased to {int(self.limit)} requests in flight')
+
+    def get_stats(self):
+        return {'limit': int(self.limit),
+                'max_limit': self.max_limit,
+                'min_limit_reached': int(self.min_seen_limit),
+                'decreases': self.decreases,
+                'latency': self.latency}
+
+
+class CircuitBreaker:
+    """ open the circuit after "max_failures" consecutive failures.
+        While open, all the requests wait "pause" seconds, then just one request
+        is allowed (half-open): if it works the circuit is closed again """
+
+    def __init__(self, max_failures=5, pause=30):
+        self.max_failures = max_failures
+        self.pause = pause
+        self.failures = 0
+        self.opened_at = None
+        self.testing = False  # one request in half-open state
+        self.times_opened = 0
+        self.paused_seconds = 0
+        self.condition = threading.Condition()
+
+    def wait(self):
+        """ wait until we are allowed to send a request """
+        with self.condition:
+            while self.opened_at is not None:
+                remaining = self.opened_at + self.pause - time.monotonic()
+                if remaining <= 0 and not self.testing:
+                    self.testing = True
+                    return
+                start = time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(timeout=remaining)
+                else:
+                    # half-open: wait for the test request result (on_success or on_failure)
+                    self.condition.wait()
+                self.paused_seconds += time.monotonic() - start
+
+    def on_success(self):
+        with self.condition:
+            self.failures = 0
+            if self.opened_at is not None:
+                logger.info('Circuit closed, the remote API is healthy again')
+            self.opened_at = None
+            self.testing = False
+            self.condition.notify_all()
+
+    def on_failure(self):
+        with self.condition:
+            self.failures += 1
+            if self.testing or (self.opened_at is None and self.failures >= self.max_failures):
+                logger.error(f'Circuit opened after {self.failures} failures. Pause {self.pause} seconds')
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+            self.testing = False
+            self.condition.notify_all()
+
+    def get_stats(self):
+        return {'state': 'closed' if self.opened_at is None else 'open',
+                'times_opened': self.times_opened,
+                'paused_seconds': round(self.paused_seconds, 3)}
@@ -0,0 +1,60 @@
+""" Append-only journal of the actions written at the destination
+    Each line is a JSON dict with the identifier, action, CKAN ID, result and timestamp.
+    If a harvest stops while writing, the next one could resume and skip
+    the rows already saved """
+import json
+import logging
+import os
+from harvester_ng.logs import logger
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteJournal:
+    """ JSON lines file with the completed actions """
+
+    def __init__(self, path, resume=False):
+        """ resume: keep (and read) the previous journal. If not, start a new one """
+        self.path = path
+        self.done = {}  # (key, action) -> journal entry, for successful actions
+        if resume and os.path.isfile(path):
+            self.read()
+        self.file = open(path, 'a' if resume else 'w')
+
+    def read(self):
+        f = open(self.path, 'r')
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line could be incomplete after a crash
+                logger.error(f'Invalid line at the write journal {self.path}: {line}')
+                continue
+            if entry['success']:
+                self.done[(entry['key'], entry['action'])] = entry
+        f.close()
+        logger.info(f'{len(self.done)} actions already written at {self.path}')
+
+    def get_key(self, identifier, ckan_id):
+        """ the data.json identifier or the CKAN ID (e.g. packages to delete without identifier) """
+        return identifier if identifier is not None else ckan_id
+
+    def get_done(self, identifier, ckan_id, action):
+        """ the journal entry if this action was already written for this dataset.
+            A different action (e.g. a delete after an update) is not done """
+        return self.done.get((self.get_key(identifier, ckan_id), action), None)
+
+    def append(self, identifier, action, ckan_id, success, timestamp):
+        entry = {'key': self.get_key(identifier, ckan_id),
+                 'identifier': identifier,
+                 'action': action,
+                 'ckan_id': ckan_id,
+                 'success': success,
+                 'timestamp': timestamp}
+        self.file.write(json.dumps(entry) + '\n')
+        # available if the process is killed
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,292 @@
+"""
+Tests for the CKAN API client with a pooled session
+"""
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from harvester_ng.harvest_destination import CKANHarvestDestination
+from harvester_ng.datajson.flows_ckan import hydrate_packages
+from harvester_ng.throttle import AdaptiveThrottle, CircuitBreaker
+from tools.fake_ckan import FakeCKAN
+
+
+class CKANSessionAPITestClass(unittest.TestCase):
+
+    def get_destination(self, url, config=None):
+        return CKANHarvestDestination(catalog_url=url,
+                                      api_key='xxxx',
+                                      organization_id='xxxx',
+                                      harvest_source_id='xxxx',
+                                      config=config)
+
+    def test_reuse_connections(self):
+        with FakeCKAN() as ckan:
+            destination = self.get_destination(url=ckan.url)
+            cpa = destination.get_ckan_api()
+            for n in range(5):
+                res = cpa.create_package(ckan_package={'name': f'dataset-{n}', 'title': f'Dataset {n}'})
+                self.assertTrue(res['success'])
+                res = cpa.update_package(ckan_package=dict(res['result'], title='New title'))
+                self.assertTrue(res['success'])
+
+            # the same client (and connection) is used for all the steps
+            self.assertIs(destination.get_ckan_api(), cpa)
+            destination.close()
+
+        clients = set(client for action, client in ckan.requests)
+        self.assertEqual(len(ckan.requests), 10)
+        self.assertEqual(len(clients), 1)
+
+    def test_duplicated_create(self):
+        with FakeCKAN() as ckan:
+            cpa = self.get_destination(url=ckan.url).get_ckan_api()
+            first = cpa.create_package(ckan_package={'name': 'dataset', 'title': 'Dataset'})
+            second = cpa.create_package(ckan_package={'name': 'dataset', 'title': 'Dataset'}, on_duplicated='DELETE')
+
+        self.assertNotEqual(first['result']['id'], second['result']['id'])
+        self.assertEqual(list(ckan.packages.keys()), [second['result']['id']])
+
+    def test_upsert_duplicated_create(self):
+        with FakeCKAN() as ckan:
+            cpa = self.get_destination(url=ckan.url).get_ckan_api()
+            resources = [{'url': 'http://some-resource.com/1'}]
+            first = cpa.create_package(ckan_package={'name': 'dataset', 'title': 'Dataset', 'resources': resources})
+            first['result']['resources'][0]['id'] = 'resource-id'
+            ckan.packages[first['result']['id']] = first['result']
+            second = cpa.create_package(ckan_package={'name': 'dataset', 'title': 'New title', 'resources': resources},
+                                        on_duplicated='UPSERT')
+
+        self.assertEqual(second['on_duplicated'], 'UPSERT')
+        self.assertEqual(first['result']['id'], second['result']['id'])
+        self.assertEqual(second['result']['title'], 'New title')
+        self.assertEqual(second['result']['resources'][0]['id'], 'resource-id')
+        self.assertEqual([action for action, client in ckan.requests],
+                         ['package_create', 'package_create', 'package_show', 'package_update'])
+
+    def test_config(self):
+        destination = self.get_destination(url='http://not-in-use.com',
+                                           config={'ckan_pool_size': 4, 'ckan_read_timeout': 30})
+        cpa = destination.get_ckan_api()
+        self.assertEqual(cpa.pool_size, 4)
+        self.assertEqual(cpa.timeout, (10, 30))
+
+    def test_retry_overloaded(self):
+        config = {'ckan_backoff_base': 0.01}
+        with FakeCKAN(failures=[503, 429, 502]) as ckan:
+            destination = self.get_destination(url=ckan.url, config=config)
+            cpa = destination.get_ckan_api()
+            res = cpa.create_package(ckan_package={'name': 'dataset', 'title': 'Dataset'})
+            self.assertTrue(res['success'])
+            self.assertEqual(len(ckan.packages), 1)
+
+        # after the 502 we check the package was not created before sending it again
+        self.assertEqual([action for action, client in ckan.requests],
+                         ['package_create'] * 3 + ['package_show', 'package_create'])
+        stats = destination.get_stats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['retries'], 3)
+        self.assertEqual(stats['retried_requests'], 1)
+        self.assertEqual(stats['gave_up'], 0)
+        self.assertLess(stats['throttle']['min_limit_reached'], 10)
+
+    def test_lost_write_responses(self):
+        config = {'ckan_backoff_base': 0.01}
+        with FakeCKAN() as ckan:
+            cpa = self.get_destination(url=ckan.url, config=config).get_ckan_api()
+            # saved by CKAN but we don't get the response
+            ckan.lost_responses = [504]
+            created = cpa.create_package(ckan_package={'name': 'dataset', 'title': 'Dataset'}, on_duplicated='DELETE')
+            ckan.lost_responses = [502]
+            updated = cpa.update_package(ckan_package={'name': 'dataset', 'title': 'New title'})
+            ckan.lost_responses = [504]
+            deleted = cpa.delete_package(ckan_package_id_or_name='dataset')
+
+        self.assertEqual(created['result']['title'], 'Dataset')
+        self.assertNotIn('on_duplicated', created)
+        self.assertEqual(updated['result']['id'], created['result']['id'])
+        self.assertEqual(updated['result']['title'], 'New title')
+        self.assertTrue(deleted['success'])
+        self.assertEqual(len(ckan.packages), 0)
+        # each write is sent just once, then we read the package
+        self.assertEqual([action for action, client in ckan.requests],
+                         ['package_create', 'package_show', 'package_update', 'package_show',
+                          'package_delete', 'package_show'])
+
+    def test_give_up(self):
+        config = {'ckan_backoff_base': 0.01, 'ckan_max_retries': 2, 'ckan_breaker_failures': 100}
+        with FakeCKAN(failures=[503] * 3) as ckan:
+            cpa = self.get_destination(url=ckan.url, config=config).get_ckan_api()
+            with self.assertRaisesRegex(Exception, 'Status code: 503'):
+                cpa.create_package(ckan_package={'name': 'dataset', 'title': 'Dataset'})
+
+        self.assertEqual(cpa.get_stats()['gave_up'], 1)
+        self.assertEqual(len(ckan.packages), 0)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(max_failures=2, pause=0.2)
+        breaker.on_failure()
+        breaker.wait()  # still closed
+        breaker.on_failure()
+        self.assertEqual(breaker.get_stats()['state'], 'open')
+
+        start = time.monotonic()
+        breaker.wait()  # half-open after the pause
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        # the test request fails, open again
+        breaker.on_failure()
+        self.assertEqual(breaker.get_stats()['times_opened'], 2)
+        breaker.wait()
+        breaker.on_success()
+        self.assertEqual(breaker.get_stats()['state'], 'closed')
+
+    def test_circuit_breaker_half_open(self):
+        breaker = CircuitBreaker(max_failures=1, pause=0.05)
+        breaker.on_failure()
+        breaker.wait()  # the test request
+        waited = []
+        thread = threading.Thread(target=lambda: waited.append(breaker.wait()))
+        thread.start()
+        time.sleep(0.2)
+        # blocked until the test request finishes
+        self.assertEqual(waited, [])
+        breaker.on_success()
+        thread.join(timeout=1)
+        self.assertEqual(waited, [None])
+
+    def test_throttle_aimd(self):
+        throttle = AdaptiveThrottle(max_limit=16)
+        throttle.on_error()
+        self.assertEqual(throttle.get_stats()['limit'], 8)
+        for n in range(100):
+            throttle.on_success(latency=0.01)
+        self.assertEqual(throttle.get_stats()['limit'], 16)
+
+        # too slow compared with the best latency
+        throttle = AdaptiveThrottle(max_limit=16)
+        for n in range(10):
+            throttle.on_success(latency=0.01)
+        for n in range(20):
+            throttle.on_success(latency=1)
+        self.assertLess(throttle.get_stats()['limit'], 16)
+
+    def test_throttle_mixed_latencies(self):
+        # far apart decreases, so each latency spike could halve the limit
+        with mock.patch('harvester_ng.throttle.time.monotonic', side_effect=itertools.count(start=100, step=100)):
+            # fast deletes first, then slower creates
+            throttle = AdaptiveThrottle(max_limit=16)
+            for n in range(5):
+                throttle.on_success(latency=0.1, key='package_delete')
+            for n in range(200):
+                throttle.on_success(latency=0.6, key='package_create')
+            self.assertEqual(throttle.get_stats()['decreases'], 0)
+
+            # a sustained slower latency for the same action becomes the new normal
+            throttle = AdaptiveThrottle(max_limit=16)
+            for n in range(5):
+                throttle.on_success(latency=0.1, key='package_create')
+            for n in range(200):
+                throttle.on_success(latency=0.6, key='package_create')
+                throttle.on_success(latency=0.1, key='package_delete')
+            self.assertEqual(throttle.get_stats()['limit'], 16)
+
+            # but a spike is still too slow
+            for n in range(10):
+                throttle.on_success(latency=10, key='package_create')
+            self.assertLess(throttle.get_stats()['limit'], 16)
+
+    def test_parallel_listing(self):
+        with FakeCKAN(max_rows=40) as ckan:
+            for n in range(257):
+                ckan.packages[f'{n:04d}'] = {'id': f'{n:04d}', 'name': f'dataset-{n}', 'resources': []}
+
+            config = {'ckan_listing_workers': 4, 'ckan_listing_rows': 50, 'ckan_listing_page_seconds': 0.001}
+            destination = self.get_destination(url=ckan.url, config=config)
+            parallel = [dataset['id'] for dataset in destination.yield_datasets(harvest_source_id='xxxx')]
+
+        # pages smaller than requested (CKAN rows limit) are completed
+        self.assertEqual(parallel, sorted(ckan.packages.keys()))
+
+    def test_listing_saved_as_stream(self):
+        tmp_folder = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_folder.name, 'ckan-results.json')
+        with FakeCKAN(max_rows=40) as ckan:
+            for n in range(100):
+                ckan.packages[f'{n:04d}'] = {'id': f'{n:04d}', 'name': f'dataset-{n}', 'resources': []}
+
+            config = {'ckan_listing_workers': 2, 'ckan_listing_rows': 40}
+            destination = self.get_destination(url=ckan.url, config=config)
+            datasets = list(destination.yield_datasets(harvest_source_id='xxxx', save_results_json_path=path))
+
+        f = open(path)
+        self.assertEqual(json.load(f), datasets)
+        f.close()
+        tmp_folder.cleanup()
+        self.assertEqual(len(datasets), 100)
+        # the listed packages are not kept by the API client
+        self.assertEqual(destination.get_ckan_api().package_list, [])
+
+    def test_stop_parallel_listing(self):
+        with FakeCKAN(latency=0.01) as ckan:
+            for n in range(100):
+                ckan.packages[f'{n:04d}'] = {'id': f'{n:04d}', 'name': f'dataset-{n}', 'resources': []}
+
+            cpa = self.get_destination(url=ckan.url).get_ckan_api()
+            pages = cpa.search_harvest_packages_in_parallel(harvest_source_id='xxxx', workers=2, rows=5,
+                                                            min_rows=5, max_rows=5)
+            self.assertEqual(len(next(pages)), 5)
+            self.assertEqual(len(next(pages)), 5)
+            # pending pages are cancelled (or finished) without errors
+            pages.close()
+            requests = len(ckan.requests)
+            time.sleep(0.1)
+
+        self.assertLessEqual(requests, 4)
+        self.assertEqual(len(ckan.requests), requests)
+
+    def test_adapt_page_size(self):
+        cpa = self.get_destination(url='http://not-in-use.com').get_ckan_api()
+        self.assertEqual(cpa.adapt_page_size(rows=1000, seconds=20, min_rows=100, max_rows=1000, page_seconds=5), 500)
+        self.assertEqual(cpa.adapt_page_size(rows=300, seconds=1, min_rows=100, max_rows=1000, page_seconds=5), 600)
+        self.assertEqual(cpa.adapt_page_size(rows=150, seconds=60, min_rows=100, max_rows=1000, page_seconds=5), 100)
+
+    def test_slim_listing(self):
+        with FakeCKAN() as ckan:
+            for n in range(5):
+                ckan.packages[f'{n:04d}'] = {'id': f'{n:04d}',
+                                             'name': f'dataset-{n}',
+                                             'metadata_modified': '2019-05-02T21:36:22.693792',
+                                             'notes': 'A long description',
+                                             'resources': [{'url': f'http://some-resource.com/{n}'}],
+                                             'extras': [{'key': 'identifier', 'value': f'identifier-{n}'},
+                                                        {'key': 'source_hash', 'value': f'hash-{n}'},
+                                                        {'key': 'publisher', 'value': 'Some publisher'}]}
+
+            destination = self.get_destination(url=ckan.url,
+                                               config={'ckan_slim_listing': True, 'ckan_hydrate_batch_size': 2})
+            datasets = list(destination.yield_datasets(harvest_source_id='xxxx'))
+            self.assertEqual(datasets[0], {'id': '0000',
+                                           'name': 'dataset-0',
+                                           'metadata_modified': '2019-05-02T21:36:22.693792',
+                                           'extras': [{'key': 'identifier', 'value': 'identifier-0'},
+                                                      {'key': 'source_hash', 'value': 'hash-0'}]})
+
+            # read the full package only for updates
+            actions = ['update', 'ignore', 'update', 'delete', 'update']
+            for dataset, action in zip(datasets, actions):
+                dataset['comparison_results'] = {'action': action}
+            del ckan.packages['0004']
+            searches = len(ckan.requests)
+            rows = list(hydrate_packages(destination)(datasets))
+
+        self.assertEqual(len(ckan.requests) - searches, 2)
+        self.assertEqual([row['id'] for row in rows], ['0000', '0001', '0002', '0003', '0004'])
+        self.assertEqual(rows[0]['resources'], [{'url': 'http://some-resource.com/0'}])
+        self.assertEqual(rows[2]['notes'], 'A long description')
+        self.assertNotIn('resources', rows[1])
+        self.assertEqual(rows[4]['comparison_results']['action'], 'error')
@@ -0,0 +1,128 @@
+"""
+Tests for the local snapshot of CKAN packages
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from harvester_ng.ckan_api import CKANSessionAPI
+from harvester_ng.ckan_snapshot import CKANSnapshot, solr_date
+from harvester_ng.harvest_destination import CKANHarvestDestination
+from tools.fake_ckan import FakeCKAN
+
+
+class CKANSnapshotTestClass(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_folder = tempfile.TemporaryDirectory()
+        self.snapshot_path = os.path.join(self.tmp_folder.name, 'ckan-snapshot.db')
+
+    def tearDown(self):
+        self.tmp_folder.cleanup()
+
+    def get_destination(self, url, **config):
+        config = dict({'ckan_snapshot': True}, **config)
+        return CKANHarvestDestination(catalog_url=url,
+                                      api_key='xxxx',
+                                      organization_id='xxxx',
+                                      harvest_source_id='xxxx',
+                                      config=config)
+
+    def list_packages(self, destination):
+        return sorted(dataset['name'] for dataset in destination.yield_datasets(harvest_source_id='xxxx',
+                                                                                 snapshot_path=self.snapshot_path))
+
+    def test_solr_date(self):
+        self.assertEqual(solr_date('2019-05-02T21:36:22.693792'), '2019-05-02T21:36:22.693Z')
+        self.assertEqual(solr_date('2019-05-02T21:36:22'), '2019-05-02T21:36:22.000Z')
+
+    def test_incremental_sync(self):
+        with FakeCKAN() as ckan:
+            destination = self.get_destination(url=ckan.url)
+            cpa = destination.get_ckan_api()
+            packages = [cpa.create_package(ckan_package={'name': f'dataset-{n}'})['result'] for n in range(5)]
+
+            self.assertEqual(self.list_packages(destination), [f'dataset-{n}' for n in range(5)])
+
+            # changes at CKAN
+            cpa.update_package(ckan_package=dict(packages[0], title='New title'))
+            cpa.create_package(ckan_package={'name': 'dataset-new'})
+            cpa.delete_package(ckan_package_id_or_name=packages[1]['id'])
+            destination.forget_packages(snapshot_path=self.snapshot_path, ckan_ids=[packages[1]['id']])
+            # deleted by someone else
+            del ckan.packages[packages[2]['id']]
+
+            requests = len(ckan.requests)
+            names = self.list_packages(destination)
+            # just one page of packages (and the last empty one)
+            self.assertEqual(len(ckan.requests) - requests, 2)
+            self.assertEqual(names, ['dataset-0', 'dataset-2', 'dataset-3', 'dataset-4', 'dataset-new'])
+            datasets = list(destination.yield_datasets(harvest_source_id='xxxx', snapshot_path=self.snapshot_path))
+            self.assertEqual(datasets[[d['name'] for d in datasets].index('dataset-0')]['title'], 'New title')
+
+            # full sync on request
+            destination = self.get_destination(url=ckan.url, ckan_snapshot_full_sync=True)
+            self.assertEqual(self.list_packages(destination), ['dataset-0', 'dataset-3', 'dataset-4', 'dataset-new'])
+
+    def test_incremental_sync_sorted(self):
+        """ the incremental listing goes from the oldest to the newest package """
+        with FakeCKAN() as ckan:
+            destination = self.get_destination(url=ckan.url)
+            cpa = destination.get_ckan_api()
+            cpa.create_package(ckan_package={'name': 'dataset'})
+            self.list_packages(destination)
+
+            with mock.patch.object(CKANSessionAPI, 'search_page', autospec=True,
+                                   side_effect=CKANSessionAPI.search_page) as search_page:
+                self.list_packages(destination)
+
+        for call in search_page.call_args_list:
+            self.assertIsNotNone(call[1]['modified_since'])
+            self.assertEqual(call[1]['sort'], 'metadata_modified asc')
+
+    def test_failed_full_sync(self):
+        """ if a full sync stops, the next harvest does a full sync again """
+        config = {'ckan_listing_workers': 2, 'ckan_listing_rows': 100, 'ckan_listing_max_rows': 100}
+        with FakeCKAN() as ckan:
+            for n in range(250):
+                ckan.packages[f'{n:04d}'] = {'id': f'{n:04d}', 'name': f'dataset-{n:04d}', 'resources': [],
+                                             'metadata_modified': f'2019-05-02T21:36:22.{n:06d}'}
+            expected = sorted(package['name'] for package in ckan.packages.values())
+            self.assertEqual(self.list_packages(self.get_destination(url=ckan.url, **config)), expected)
+            self.assertEqual(self.list_packages(self.get_destination(url=ckan.url, **config)), expected)
+
+            # the second page fails
+            ckan.failures = [None, 500]
+            destination = self.get_destination(url=ckan.url, ckan_snapshot_full_sync=True, **config)
+            with self.assertRaises(Exception):
+                self.list_packages(destination)
+            snapshot = CKANSnapshot(path=self.snapshot_path)
+            self.assertIsNone(snapshot.get_info('runs_since_full_sync'))
+            snapshot.close()
+
+            self.assertEqual(self.list_packages(self.get_destination(url=ckan.url, **config)), expected)
+
+    def test_periodic_full_sync(self):
+        with FakeCKAN() as ckan:
+            destination = self.get_destination(url=ckan.url, ckan_snapshot_full_sync_every=2)
+            cpa = destination.get_ckan_api()
+            package = cpa.create_package(ckan_package={'name': 'dataset'})['result']
+
+            self.assertEqual(self.list_packages(destination), ['dataset'])
+            del ckan.packages[package['id']]
+            # incremental sync, can't detect the delete
+            self.assertEqual(self.list_packages(destination), ['dataset'])
+            # full sync
+            self.assertEqual(self.list_packages(destination), [])
+
+    def test_settings_changed(self):
+        with FakeCKAN() as ckan:
+            destination = self.get_destination(url=ckan.url)
+            package = destination.get_ckan_api().create_package(ckan_package={'name': 'dataset'})['result']
+            self.list_packages(destination)
+            del ckan.packages[package['id']]
+
+            # slim packages are not mixed with full packages
+            destination = self.get_destination(url=ckan.url, ckan_slim_listing=True)
+            self.assertEqual(self.list_packages(destination), [])
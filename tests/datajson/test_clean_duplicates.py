@@ -4,7 +4,8 @@ Tests all functions used in flow file
 import unittest
 
 from harvesters import config
-from harvester_ng.datajson.flows import clean_duplicated_identifiers
+from harvester_ng.datajson.flows import clean_duplicated_identifiers, remove_duplicates
+from harvester_ng.duplicates import deduplicate
 
 
 class FunctionsDuplicatesTestClass(unittest.TestCase):
@@ -58,3 +59,36 @@ class FunctionsDuplicatesTestClass(unittest.TestCase):
 
         self.assertEqual(total_ok, 2)
         self.assertEqual(total_duplicates, 1)
+
+    def test_newest_wins(self):
+        rows = [{'identifier': 'A', 'modified': '2019-01-01'},
+                {'identifier': 'B', 'modified': '2019-01-01'},
+                {'identifier': 'A', 'modified': '2020-01-01T10:00:00Z'},
+                {'identifier': 'A', 'modified': 'not a date'}]
+
+        summary = {}
+        datasets = list(deduplicate(rows, policy='newest', summary=summary))
+
+        self.assertEqual([('is_duplicate' in dataset) for dataset in datasets], [True, False, False, True])
+        self.assertEqual(summary['total'], 4)
+        self.assertEqual(summary['duplicates'], 2)
+        self.assertEqual(summary['duplicated_identifiers'], 1)
+        self.assertEqual(summary['samples'], ['A'])
+
+    def test_fail_on_duplicate(self):
+        rows = [{'identifier': 'A'}, {'identifier': 'B'}, {'identifier': 'A'}]
+
+        with self.assertRaises(Exception) as context:
+            list(deduplicate(rows, policy='fail'))
+        self.assertIn('Duplicated identifier "A"', str(context.exception))
+
+    def test_summary_samples(self):
+        rows = [{'identifier': str(n % 20)} for n in range(100)]
+
+        summary = {}
+        for dataset in remove_duplicates(summary=summary)(rows):
+            pass
+
+        self.assertEqual(summary['duplicates'], 80)
+        self.assertEqual(summary['duplicated_identifiers'], 20)
+        self.assertEqual(len(summary['samples']), 10)
@@ -1,12 +1,21 @@
 """
 Tests all functions used in flow file
 """
+import io
 import json
-import shutil
+import os
+import tempfile
+import time
 from unittest import TestCase, mock
+from datapackage import Package
+from harvesters.datajson.harvester import DataJSON
 from harvester_ng.source_datajson import HarvestDataJSON
 from harvester_ng.harvest_destination import CKANHarvestDestination
-from harvester_ng.datajson.flows import clean_duplicated_identifiers, compare_resources
+from harvester_ng.datajson.flows import clean_duplicated_identifiers, compare_resources, get_source_hash
+from harvester_ng.helpers import read_rows
+from harvester_ng.spool import BackgroundSpool
+from harvester_ng.staging import StagingStore
+from tools.fake_ckan import FakeCKAN
 
 
 class FunctionsTestClass(TestCase):
@@ -16,12 +25,23 @@ class FunctionsTestClass(TestCase):
                                                   api_key='xxxx',
                                                   organization_id='xxxx',
                                                   harvest_source_id='xxxx')
+        self.tmp_folder = tempfile.TemporaryDirectory()
+        self.staging_path = os.path.join(self.tmp_folder.name, 'staging.db')
+
+    def tearDown(self):
+        self.tmp_folder.cleanup()
+
+    def save_to_staging(self, datasets):
+        store = StagingStore(path=self.staging_path)
+        store.add_many(datasets)
+        store.close()
 
     def mocked_requests_get(*args, **kwargs):
         class MockResponse:
             def __init__(self, content, status_code):
                 self.content = content
                 self.status_code = status_code
+                self.headers = {}
 
             def json(self):
                 return json.loads(self.content)
@@ -169,12 +189,11 @@ class FunctionsTestClass(TestCase):
              'extras': [{'key': 'identifier', 'value': 'New unexpected identifier'}]},
         ]
 
-        f = compare_resources(data_packages_path='tests/datajson/samples/compare_test')
-        # this files will be deleted after process, use a copy (in a external folder)
-        shutil.copyfile('tests/datajson/samples/data-json-0003.json',
-                        'tests/datajson/samples/compare_test/data-json-dXNkYS1vY2lvLTE1LTAx.json')
-        shutil.copyfile('tests/datajson/samples/data-json-0004.json',
-                        'tests/datajson/samples/compare_test/data-json-VVNEQS1ETS0wMDM=.json')
+        f = compare_resources(staging_path=self.staging_path)
+        datasets = [Package(path).get_resource('inline').source
+                    for path in ['tests/datajson/samples/data-json-0003.json',
+                                 'tests/datajson/samples/data-json-0004.json']]
+        self.save_to_staging(datasets)
 
         for row in f(rows=fake_rows):
             # I expect first resoults
@@ -200,3 +219,334 @@ class FunctionsTestClass(TestCase):
 
             elif ckan_id == '0005':
                 self.assertEqual(cr['action'], 'delete')
+
+    def test_compare_resources_by_hash(self):
+        headers = {'@context': 'https://project-open-data.cio.gov/v1.1/schema/catalog.jsonld',
+                   'schema_version': '1.1'}
+        datasets = [
+            {'identifier': 'HASH-001', 'modified': '2010-01-01', 'title': 'Same', 'headers': headers},
+            {'identifier': 'HASH-002', 'modified': '2010-01-01', 'title': 'Changed', 'headers': headers},
+        ]
+        self.save_to_staging(datasets)
+
+        fake_rows = [
+            # same hash, dates are not used
+            {'id': '0001',
+             'metadata_modified': '2000-01-01T21:36:22.693792',
+             'extras': [{'key': 'identifier', 'value': 'HASH-001'},
+                        {'key': 'source_hash', 'value': get_source_hash(datasets[0])}]},
+            # different hash but an old date
+            {'id': '0002',
+             'metadata_modified': '2019-05-02T21:36:22.693792',
+             'extras': [{'key': 'identifier', 'value': 'HASH-002'},
+                        {'key': 'source_hash', 'value': 'previous-hash'}]},
+        ]
+
+        f = compare_resources(staging_path=self.staging_path)
+        actions = {row['comparison_results']['ckan_id']: row['comparison_results']['action'] for row in f(rows=fake_rows)}
+        self.assertEqual(actions, {'0001': 'ignore', '0002': 'update'})
+
+    def test_compare_resources_is_repeatable(self):
+        self.save_to_staging([{'identifier': 'A', 'modified': '2010-01-01'},
+                              {'identifier': 'B', 'modified': '2010-01-01'},
+                              {'identifier': 'C', 'modified': '2010-01-01'}])
+        fake_rows = [
+            {'id': '0001',
+             'metadata_modified': '2019-05-02T21:36:22.693792',
+             'extras': [{'key': 'identifier', 'value': 'B'}]},
+            {'id': '0002',
+             'metadata_modified': '2019-05-02T21:36:22.693792',
+             'extras': [{'key': 'identifier', 'value': 'Z'}]},
+        ]
+
+        for n in range(2):
+            f = compare_resources(staging_path=self.staging_path)
+            results = [(row['comparison_results']['action'],
+                        row['comparison_results']['ckan_id'] or row['comparison_results']['new_data']['identifier'])
+                       for row in f(rows=[row.copy() for row in fake_rows])]
+            self.assertEqual(results, [('ignore', '0001'), ('delete', '0002'), ('create', 'A'), ('create', 'C')])
+
+    def mocked_conditional_requests_get(*args, **kwargs):
+        class MockResponse:
+            def __init__(self, content, status_code, headers):
+                self.content = content
+                self.status_code = status_code
+                self.headers = headers
+
+        url = args[0]
+        headers = kwargs.get('headers', {})
+        content = b'{"conformsTo": "https://project-open-data.cio.gov/v1.1/schema", "dataset": []}'
+        if url == 'https://some-source.com/etag.json':
+            if headers.get('If-None-Match', None) == '"v1"':
+                return MockResponse(b'', 304, {})
+            return MockResponse(content, 200, {'ETag': '"v1"'})
+        elif url == 'https://some-source.com/etag-datasets.json':
+            if headers.get('If-None-Match', None) == '"v1"':
+                return MockResponse(b'', 304, {})
+            datasets = [{'identifier': str(n), 'title': f'Dataset {n}'} for n in range(3)]
+            data = {'conformsTo': 'https://project-open-data.cio.gov/v1.1/schema', 'dataset': datasets}
+            return MockResponse(json.dumps(data).encode('utf-8'), 200, {'ETag': '"v1"'})
+        elif url == 'https://some-source.com/no-etag.json':
+            return MockResponse(content, 200, {})
+        elif url == 'https://some-source.com/datasets.json':
+            datasets = [{'identifier': str(n), 'title': f'Dataset {n}', 'bureauCode': [f'005:0{n}']} for n in range(3)]
+            data = {'conformsTo': 'https://project-open-data.cio.gov/v1.1/schema', 'dataset': datasets}
+            return MockResponse(json.dumps(data).encode('utf-8'), 200, {})
+        elif url == 'https://some-source.com/full-datasets.json':
+            datasets = [{'identifier': str(n),
+                         'title': f'Dataset {n}',
+                         'description': 'Some description',
+                         'modified': '2019-01-01',
+                         'publisher': {'name': 'Some publisher'},
+                         'contactPoint': {'fn': 'Some Name', 'hasEmail': 'mailto:some@email.com'},
+                         'keyword': ['harvest'],
+                         'bureauCode': ['005:00'],
+                         'programCode': ['005:000'],
+                         'accessLevel': 'public'} for n in range(3)]
+            data = {'conformsTo': 'https://project-open-data.cio.gov/v1.1/schema', 'dataset': datasets}
+            return MockResponse(json.dumps(data).encode('utf-8'), 200, {})
+        elif url == 'https://some-source.com/no-datasets.json':
+            return MockResponse(b'{"conformsTo": "https://project-open-data.cio.gov/v1.1/schema"}', 200, {})
+
+        return MockResponse(f'UNDEFINED URL {url}', 400, {})
+
+    @mock.patch('requests.get', side_effect=mocked_conditional_requests_get)
+    def test_not_modified_data_json(self, mock_req):
+        url = 'https://some-source.com/etag.json'
+        hdj = HarvestDataJSON(name='Test Conditional GET', url=url, destination=self.destination)
+        # forget previous runs
+        open(hdj.get_data_cache_info_path(), 'w').close()
+
+        hdj.download()
+        self.assertFalse(hdj.source_unchanged)
+        hdj.save_data_cache_info()
+
+        hdj = HarvestDataJSON(name='Test Conditional GET', url=url, destination=self.destination)
+        hdj.download()
+        self.assertTrue(hdj.source_unchanged)
+        self.assertEqual(mock_req.call_args_list[-1][1]['headers'], {'If-None-Match': '"v1"'})
+
+    @mock.patch('requests.get', side_effect=mocked_conditional_requests_get)
+    def test_same_digest_data_json(self, mock_req):
+        url = 'https://some-source.com/no-etag.json'
+        hdj = HarvestDataJSON(name='Test Conditional GET digest', url=url, destination=self.destination)
+        open(hdj.get_data_cache_info_path(), 'w').close()
+
+        hdj.download()
+        self.assertFalse(hdj.source_unchanged)
+        hdj.save_data_cache_info()
+
+        hdj = HarvestDataJSON(name='Test Conditional GET digest', url=url, destination=self.destination)
+        hdj.download()
+        self.assertTrue(hdj.source_unchanged)
+
+        # any change in config requires a full harvest
+        hdj = HarvestDataJSON(name='Test Conditional GET digest', url=url, destination=self.destination,
+                              config={'validator_schema': 'non-federal-v1.1'})
+        hdj.download()
+        self.assertFalse(hdj.source_unchanged)
+
+    def mocked_bureau_codes(*args, **kwargs):
+        return io.BytesIO(b'Agency Code,Bureau Code\n005,00\n005,01\n')
+
+    @mock.patch('urllib.request.urlopen', side_effect=mocked_bureau_codes)
+    @mock.patch('requests.get', side_effect=mocked_conditional_requests_get)
+    def test_not_modified_keeps_staging(self, mock_req, mock_urlopen):
+        url = 'https://some-source.com/etag-datasets.json'
+        config = {'validation_mode': 'single-pass'}
+        hdj = HarvestDataJSON(name='Test Conditional GET staging', url=url, destination=self.destination, config=config)
+        open(hdj.get_data_cache_info_path(), 'w').close()
+        hdj.download()
+        hdj.save_data_cache_info()
+
+        # nothing changed: the staged datasets and the results are still valid (e.g. to resume)
+        self.assertIsNone(hdj.download())
+        self.assertTrue(hdj.source_unchanged)
+        store = StagingStore(path=hdj.get_staging_path())
+        self.assertEqual(store.count(), 3)
+        store.close()
+        self.assertEqual(len(list(read_rows(hdj.get_download_result_path(create=False)))), 3)
+
+        # a new download with the same object starts again
+        open(hdj.get_data_cache_info_path(), 'w').close()
+        hdj.download()
+        self.assertFalse(hdj.source_unchanged)
+
+    @mock.patch('urllib.request.urlopen', side_effect=mocked_bureau_codes)
+    @mock.patch('requests.get', side_effect=mocked_conditional_requests_get)
+    def test_single_pass_validation(self, mock_req, mock_urlopen):
+        url = 'https://some-source.com/datasets.json'
+        validation_errors = {}
+        for mode in ['full', 'single-pass']:
+            hdj = HarvestDataJSON(name='Test single pass validation', url=url, destination=self.destination,
+                                  config={'validator_schema': 'federal-v1.1',
+                                          'validation_mode': mode,
+                                          'conditional_get': False})
+            hdj.download()
+            store = StagingStore(path=hdj.get_staging_path())
+            validation_errors[mode] = [store.get(identifier)['validation_errors'] for identifier in store.identifiers()]
+            store.close()
+            self.assertEqual(sorted(hdj.timings.keys()), ['catalog_validation', 'datasets_validation'])
+
+        self.assertEqual(validation_errors['full'][:2], [[], []])
+        self.assertEqual(len(validation_errors['full'][2]), 1)
+        self.assertEqual(validation_errors['full'], validation_errors['single-pass'])
+
+    @mock.patch('requests.get', side_effect=mocked_conditional_requests_get)
+    def test_single_pass_without_datasets(self, mock_req):
+        url = 'https://some-source.com/no-datasets.json'
+        hdj = HarvestDataJSON(name='Test single pass validation', url=url, destination=self.destination,
+                              config={'validation_mode': 'single-pass', 'conditional_get': False})
+        with self.assertRaisesRegex(Exception, 'The data.json "dataset" value must be a list'):
+            hdj.download()
+
+    def test_streaming_catalog_values_order(self):
+        """ streaming needs the catalog values before the "dataset" list """
+        class StreamResponse:
+            def __init__(self, data_json):
+                self.raw = io.BytesIO(json.dumps(data_json).encode('utf-8'))
+                self.headers = {}
+
+            def close(self):
+                pass
+
+        hdj = HarvestDataJSON(name='Test streaming catalog values', url='https://some-source.com/late.json',
+                              destination=self.destination, config={'streaming': True})
+        self.assertEqual(hdj.validation_mode, 'single-pass')
+        validated = []
+
+        def validate(datajson, validator_schema):
+            validated.append(datajson.data_json)
+            return 'conformsTo' in datajson.data_json
+
+        def read(data_json):
+            datasets = hdj.yield_streaming_datasets(StreamResponse(data_json), DataJSON(), validator_schema='federal-v1.1')
+            return [dataset['identifier'] for dataset in datasets]
+
+        with mock.patch.object(DataJSON, 'validate', autospec=True, side_effect=validate):
+            self.assertEqual(read({'conformsTo': 'x', 'dataset': [{'identifier': '1'}]}), ['1'])
+            # validated just with the values before the first dataset
+            with self.assertRaisesRegex(Exception, 'Streaming requires the catalog values before'):
+                read({'dataset': [{'identifier': '1'}], 'conformsTo': 'x'})
+            # the datasets we already yielded don't have the late values
+            with self.assertRaisesRegex(Exception, 'Catalog values found after the "dataset" list.*describedBy'):
+                read({'conformsTo': 'x', 'dataset': [{'identifier': '1'}], 'describedBy': 'y'})
+            with self.assertRaisesRegex(Exception, 'the dataset #2 is not a JSON object'):
+                read({'conformsTo': 'x', 'dataset': [{'identifier': '1'}, 'not a dataset']})
+
+        self.assertEqual(validated[:2], [{'conformsTo': 'x', 'dataset': []}, {'dataset': []}])
+
+    @mock.patch('urllib.request.urlopen', side_effect=mocked_bureau_codes)
+    @mock.patch('requests.get', side_effect=mocked_conditional_requests_get)
+    def test_fused_harvest(self, mock_req, mock_urlopen):
+        url = 'https://some-source.com/full-datasets.json'
+        config = {'conditional_get': False}
+        for save_debug_files in [False, True]:
+            with FakeCKAN() as ckan:
+                destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                     api_key='xxxx',
+                                                     organization_id='xxxx',
+                                                     harvest_source_id='xxxx')
+                hdj = HarvestDataJSON(name='Test fused harvest', url=url, destination=destination, config=config)
+                res = hdj.harvest(save_debug_files=save_debug_files)
+                destination.close()
+
+            actions = [row['comparison_results']['action'] for row in res[0][0]]
+            self.assertEqual(actions, ['create'] * 3)
+            self.assertEqual(len(ckan.packages), 3)
+            compare_results_path = hdj.get_comparison_result_path(create=False)
+            # intermediate results just for debug
+            self.assertEqual(os.path.isfile(compare_results_path), save_debug_files)
+
+        compare_results = list(read_rows(compare_results_path))
+        self.assertEqual([row['comparison_results']['action'] for row in compare_results], ['create'] * 3)
+        self.assertNotIn('action_results', compare_results[0]['comparison_results'])
+
+    @mock.patch('urllib.request.urlopen', side_effect=mocked_bureau_codes)
+    @mock.patch('requests.get', side_effect=mocked_conditional_requests_get)
+    def test_results_files(self, mock_req, mock_urlopen):
+        url = 'https://some-source.com/full-datasets.json'
+        config = {'conditional_get': False, 'pretty_results': True}
+        with FakeCKAN() as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx')
+            hdj = HarvestDataJSON(name='Test results files', url=url, destination=destination, config=config)
+            hdj.save_download_results(flow_results=hdj.download(keep_results=False))
+            hdj.save_compare_results(flow_results=hdj.compare(keep_results=False))
+            hdj.save_write_results(flow_results=hdj.write_destination(keep_results=False))
+            hdj.write_final_report()
+            destination.close()
+
+        # JSON lines, one row each
+        download_results = list(read_rows(hdj.get_download_result_path(create=False)))
+        self.assertEqual(len(download_results), 3)
+        compare_results = list(read_rows(hdj.get_comparison_result_path(create=False)))
+        self.assertEqual([row['comparison_results']['action'] for row in compare_results], ['create'] * 3)
+        # references to the staged datasets
+        self.assertIn('staged_hash', compare_results[0]['comparison_results']['new_data'])
+        self.assertNotIn('title', compare_results[0]['comparison_results']['new_data'])
+        write_results = list(read_rows(hdj.get_write_result_path(create=False)))
+        self.assertTrue(all(row['comparison_results']['action_results']['success'] for row in write_results))
+
+        # the same rows for humans
+        f = open(os.path.splitext(hdj.get_write_result_path(create=False))[0] + '.json')
+        self.assertEqual(json.load(f), write_results)
+        f.close()
+
+        f = open(hdj.get_final_json_results_for_report_path(create=False))
+        final_results = json.load(f)
+        f.close()
+        self.assertEqual(final_results['results_count'], 3)
+        self.assertEqual(final_results['data']['datasets'], 3)
+        self.assertEqual(final_results['actions']['create'], {'total': 3, 'success': 3, 'fails': 0})
+
+    @mock.patch('urllib.request.urlopen', side_effect=mocked_bureau_codes)
+    @mock.patch('requests.get', side_effect=mocked_conditional_requests_get)
+    def test_destination_prefetch(self, mock_req, mock_urlopen):
+        url = 'https://some-source.com/full-datasets.json'
+        with FakeCKAN() as ckan:
+            ckan.packages['0000'] = {'id': '0000', 'name': 'old', 'resources': [],
+                                     'extras': [{'key': 'identifier', 'value': 'old'}]}
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx')
+            config = {'conditional_get': False, 'destination_prefetch': 'disk'}
+            hdj = HarvestDataJSON(name='Test destination prefetch', url=url, destination=destination, config=config)
+            hdj.download()
+            res = hdj.compare()
+            destination.close()
+
+        actions = [row['comparison_results']['action'] for row in res[0][0]]
+        self.assertEqual(actions, ['delete', 'create', 'create', 'create'])
+        self.assertTrue(os.path.isfile(hdj.get_destination_spool_path()))
+
+    @mock.patch('requests.get', side_effect=mocked_conditional_requests_get)
+    def test_destination_prefetch_stopped(self, mock_req):
+        """ the background listing stops if the download fails """
+        url = 'https://some-source.com/undefined.json'
+        with FakeCKAN(latency=0.05, max_rows=10) as ckan:
+            for n in range(100):
+                ckan.packages[f'{n:04d}'] = {'id': f'{n:04d}', 'name': f'dataset-{n}', 'resources': []}
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx',
+                                                 config={'ckan_listing_workers': 2, 'ckan_listing_rows': 10})
+            config = {'conditional_get': False, 'destination_prefetch': 'memory'}
+            hdj = HarvestDataJSON(name='Test destination prefetch', url=url, destination=destination, config=config)
+            with mock.patch.object(BackgroundSpool, 'stop', autospec=True, side_effect=BackgroundSpool.stop) as stop:
+                with self.assertRaises(Exception):
+                    hdj.download()
+            requests = len(ckan.requests)
+            time.sleep(0.2)
+            # no more pages requested
+            self.assertEqual(len(ckan.requests), requests)
+            destination.close()
+
+        self.assertIsNone(hdj.prefetch)
+        spool = stop.call_args[0][0]
+        self.assertFalse(spool.thread.is_alive())
+        self.assertLess(requests, 10)
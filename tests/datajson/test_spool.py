@@ -0,0 +1,73 @@
+"""
+Tests for iterating in a background thread
+"""
+import os
+import tempfile
+import threading
+import unittest
+
+from harvester_ng.spool import BackgroundSpool
+
+
+class BackgroundSpoolTestClass(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_folder.name, 'spool.jsonl')
+
+    def tearDown(self):
+        self.tmp_folder.cleanup()
+
+    def test_read_while_running(self):
+        produced = threading.Event()
+        consumed = threading.Event()
+
+        def items():
+            yield {'n': 0}
+            produced.set()
+            # wait until the first item is consumed
+            consumed.wait(timeout=5)
+            for n in range(1, 100):
+                yield {'n': n}
+
+        for path in [self.path, None]:
+            produced.clear()
+            consumed.clear()
+            spool = BackgroundSpool(iterable=items(), path=path).start()
+            produced.wait(timeout=5)
+            results = []
+            for item in spool:
+                results.append(item['n'])
+                consumed.set()
+            self.assertEqual(results, list(range(100)))
+            self.assertTrue(consumed.is_set())
+
+    def test_error(self):
+        def items():
+            yield {'n': 0}
+            raise Exception('Listing failed')
+
+        spool = BackgroundSpool(iterable=items(), path=self.path).start()
+        results = []
+        with self.assertRaisesRegex(Exception, 'Listing failed'):
+            for item in spool:
+                results.append(item)
+        self.assertEqual(results, [{'n': 0}])
+
+    def test_stop(self):
+        closed = threading.Event()
+
+        def items():
+            try:
+                n = 0
+                while True:
+                    yield {'n': n}
+                    n += 1
+            finally:
+                closed.set()
+
+        spool = BackgroundSpool(iterable=items(), path=self.path).start()
+        spool.stop()
+        self.assertFalse(spool.thread.is_alive())
+        # the generator cleanup runs
+        self.assertTrue(closed.is_set())
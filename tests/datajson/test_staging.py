@@ -0,0 +1,42 @@
+"""
+Tests for the staging store
+"""
+import os
+import tempfile
+import unittest
+
+from harvester_ng.staging import StagingStore
+
+
+class StagingStoreTestClass(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_folder = tempfile.TemporaryDirectory()
+        self.store = StagingStore(path=os.path.join(self.tmp_folder.name, 'staging.db'))
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_folder.cleanup()
+
+    def test_first_dataset_wins(self):
+        self.store.add_many([{'identifier': 'A', 'title': 'first'}])
+        self.store.add_many([{'identifier': 'A', 'title': 'second'}, {'identifier': 'B'}])
+
+        self.assertEqual(self.store.count(), 2)
+        self.assertEqual(self.store.get('A'), {'identifier': 'A', 'title': 'first'})
+        self.assertIsNone(self.store.get('C'))
+        self.assertTrue(self.store.exists('B'))
+        self.assertFalse(self.store.exists('C'))
+
+    def test_identifiers_order(self):
+        self.store.add_many([{'identifier': idf} for idf in ['C', 'A', 'B']])
+        self.assertEqual(self.store.identifiers(), ['C', 'A', 'B'])
+
+    def test_update_and_reset(self):
+        self.store.add_many([{'identifier': 'A'}])
+        self.assertTrue(self.store.update('A', {'is_collection': True}))
+        self.assertFalse(self.store.update('B', {'is_collection': True}))
+        self.assertEqual(self.store.get('A'), {'identifier': 'A', 'is_collection': True})
+
+        self.store.reset()
+        self.assertEqual(self.store.count(), 0)
@@ -0,0 +1,46 @@
+"""
+Tests for the incremental data.json parser
+"""
+import io
+import json
+import unittest
+
+from harvester_ng.datajson.streaming import TeeReader, iter_datajson_datasets
+
+
+class StreamingTestClass(unittest.TestCase):
+
+    def test_same_datasets_as_json_load(self):
+        path = 'tests/datajson/samples/healthdata.gov.data.json'
+        f = open(path, 'rb')
+        raw = f.read()
+        f.close()
+        data_json = json.loads(raw)
+
+        headers = {}
+        datasets = list(iter_datajson_datasets(fileobj=io.BytesIO(raw), headers=headers))
+
+        self.assertEqual(datasets, data_json['dataset'])
+        expected_headers = data_json.copy()
+        del expected_headers['dataset']
+        self.assertEqual(headers, expected_headers)
+
+    def test_headers_before_first_dataset(self):
+        raw = b'{"@type": "dcat:Catalog", "conformsTo": "x", "dataset": [{"identifier": "1"}, {"identifier": "2"}]}'
+        headers = {}
+        for dataset in iter_datajson_datasets(fileobj=io.BytesIO(raw), headers=headers):
+            self.assertEqual(headers, {'@type': 'dcat:Catalog', 'conformsTo': 'x'})
+
+    def test_list_data_json(self):
+        raw = b'[{"identifier": "1"}]'
+        with self.assertRaises(ValueError):
+            list(iter_datajson_datasets(fileobj=io.BytesIO(raw), headers={}))
+
+    def test_tee_reader(self):
+        raw = b'{"dataset": [{"identifier": "1", "keyword": ["a", "b"]}]}'
+        sink = io.BytesIO()
+        reader = TeeReader(source=io.BytesIO(raw), sink=sink)
+        datasets = list(iter_datajson_datasets(fileobj=reader, headers={}))
+        self.assertEqual(datasets, [{'identifier': '1', 'keyword': ['a', 'b']}])
+        self.assertEqual(sink.getvalue(), raw)
+        self.assertEqual(reader.bytes_read, len(raw))
@@ -0,0 +1,96 @@
+"""
+Tests for datasets validation
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from harvester_ng.datajson import validation
+from harvester_ng.datajson.validation import DatasetValidator, ValidationCache, validate_datasets_in_pool
+
+
+class ValidationTestClass(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.folder, 'validation-cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_bureau_codes(self):
+        validator = DatasetValidator(validator_schema='federal-v1.1')
+        validator.bureau_codes = {'005:00', '005:12'}
+
+        self.assertEqual(validator.validate({'bureauCode': ['005:12']}), [])
+        self.assertEqual(validator.validate({'bureauCode': ['005:99', '005:98']}),
+                         ['The bureau code 005:99 was not found in our list at '
+                          'https://project-open-data.cio.gov/data/omb_bureau_codes.csv'])
+
+    def test_pool_keeps_order(self):
+        rows = [{'identifier': str(n), 'validator_schema': 'non-federal-v1.1'} for n in range(250)]
+
+        f = validate_datasets_in_pool(workers=2, chunk_size=7)
+        results = list(f(rows))
+
+        self.assertEqual([row['identifier'] for row in results], [str(n) for n in range(250)])
+        for row in results:
+            self.assertEqual(row['validation_errors'], [])
+
+    def test_cache_skip_validated(self):
+        rows = [{'identifier': str(n), 'validator_schema': 'non-federal-v1.1'} for n in range(10)]
+
+        f = validate_datasets_in_pool(workers=0, chunk_size=3, cache_path=self.cache_path)
+        list(f([dict(row) for row in rows]))
+
+        # same datasets, nothing to validate. One changed dataset
+        rows[4]['title'] = 'new title'
+        validated = []
+
+        def validate_chunk(datasets):
+            # the datasets as they are at source (the hash could change the validation)
+            validated.extend(sorted(dataset.keys()) for dataset in datasets)
+            return original_validate_chunk(datasets)
+
+        original_validate_chunk = validation.validate_chunk
+        with mock.patch.object(validation, 'validate_chunk', side_effect=validate_chunk):
+            f = validate_datasets_in_pool(workers=0, chunk_size=3, cache_path=self.cache_path)
+            results = list(f([dict(row) for row in rows]))
+
+        self.assertEqual(validated, [['identifier', 'title', 'validator_schema']])
+        self.assertEqual([row['identifier'] for row in results], [str(n) for n in range(10)])
+        for row in results:
+            self.assertEqual(row['validation_errors'], [])
+            self.assertNotIn('_validation_hash', row)
+
+    def test_cache_by_schema(self):
+        cache = ValidationCache(path=self.cache_path)
+        cache.set_many([('hash1', 'federal-v1.1', ['Some error'])])
+        self.assertEqual(cache.get('hash1', 'federal-v1.1'), ['Some error'])
+        self.assertIsNone(cache.get('hash1', 'non-federal-v1.1'))
+        cache.close()
+
+    def test_cache_eviction(self):
+        cache = ValidationCache(path=self.cache_path, max_runs=2)
+        cache.set_many([('old', 'federal-v1.1', []), ('used', 'federal-v1.1', [])])
+        cache.close()
+
+        for n in range(2):
+            cache = ValidationCache(path=self.cache_path, max_runs=2)
+            self.assertEqual(cache.get('used', 'federal-v1.1'), [])
+            cache.close()
+
+        cache = ValidationCache(path=self.cache_path, max_runs=2)
+        self.assertIsNone(cache.get('old', 'federal-v1.1'))
+        self.assertEqual(cache.get('used', 'federal-v1.1'), [])
+        cache.close()
+
+        # just the last runs are kept
+        for n in range(5):
+            ValidationCache(path=self.cache_path, max_runs=2).close()
+        cache = ValidationCache(path=self.cache_path, max_runs=2)
+        runs = [run for run, in cache.conn.execute('SELECT id FROM runs ORDER BY id')]
+        cache.close()
+        self.assertEqual(runs, [8, 9, 10])
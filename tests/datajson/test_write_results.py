@@ -0,0 +1,446 @@
+"""
+Tests for writing results at a (fake) CKAN destination
+"""
+import os
+import tempfile
+import unittest
+
+from harvester_ng.ckan_diff import get_changed_fields, get_package_patch
+from harvester_ng.harvest_destination import CKANHarvestDestination
+from harvester_ng.write_journal import WriteJournal
+from harvester_ng.staging import StagingStore
+from harvester_ng.datajson.flows import compare_resources, get_new_data_reference
+from harvester_ng.datajson.flows_ckan import write_results, order_parents_first, assing_collection_pkg_id
+from tools.fake_ckan import FakeCKAN
+
+
+class FakeSource:
+    name = 'Fake source'
+
+
+def get_datajson_dataset(identifier):
+    return {'identifier': identifier,
+            'title': f'Dataset {identifier}',
+            'description': 'Some description',
+            'modified': '2019-01-01',
+            'publisher': {'name': 'Some publisher'},
+            'contactPoint': {'fn': 'Some Name', 'hasEmail': 'mailto:some@email.com'},
+            'keyword': ['harvest'],
+            'bureauCode': ['005:00'],
+            'programCode': ['005:000'],
+            'accessLevel': 'public',
+            'headers': {'schema_version': '1.1'}}
+
+
+def get_rows(ckan_ids):
+    """ some rows from the compare step: creates, updates, deletes and errors """
+    rows = []
+    for n in range(20):
+        rows.append({'comparison_results': {'action': 'create',
+                                            'ckan_id': None,
+                                            'new_data': get_datajson_dataset(f'new-{n}'),
+                                            'reason': 'Not found in the CKAN results'}})
+    for n, ckan_id in enumerate(ckan_ids):
+        if n % 3 == 0:
+            comparison_results = {'action': 'delete', 'ckan_id': ckan_id, 'new_data': None}
+        elif n % 3 == 1:
+            comparison_results = {'action': 'update', 'ckan_id': ckan_id,
+                                  'new_data': dict(get_datajson_dataset(f'old-{n}'), id=ckan_id)}
+        else:
+            comparison_results = {'action': 'ignore', 'ckan_id': ckan_id, 'new_data': None}
+        rows.append({'id': ckan_id, 'resources': [], 'comparison_results': comparison_results})
+    rows.append({'id': 'xxxx', 'comparison_results': {'action': 'error', 'ckan_id': 'xxxx',
+                                                      'new_data': None, 'reason': 'Some error'}})
+    # fails because it does not exists at CKAN
+    rows.append({'id': 'not-exists', 'comparison_results': {'action': 'delete', 'ckan_id': 'not-exists',
+                                                            'new_data': None}})
+    return rows
+
+
+class WriteResultsTestClass(unittest.TestCase):
+
+    def write(self, workers):
+        with FakeCKAN(latency=0.01) as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx',
+                                                 config={'ckan_write_workers': workers})
+            destination.source = FakeSource()
+            cpa = destination.get_ckan_api()
+            ckan_ids = []
+            for n in range(9):
+                res = cpa.create_package(ckan_package={'name': f'old-{n}', 'title': f'Old {n}'})
+                ckan_ids.append(res['result']['id'])
+
+            f = write_results(destination_obj=destination)
+            results = list(f(get_rows(ckan_ids)))
+            destination.close()
+            return results, ckan
+
+    def test_concurrent_write_is_deterministic(self):
+        sequential, ckan = self.write(workers=1)
+        concurrent, ckan = self.write(workers=8)
+
+        def summary(rows):
+            return [(row['comparison_results']['action'],
+                     row['comparison_results']['action_results']['success'])
+                    for row in rows]
+
+        self.assertEqual(summary(sequential), summary(concurrent))
+        # ignored rows are not yielded
+        self.assertEqual(len(concurrent), 20 + 6 + 2)
+        self.assertEqual(summary(concurrent)[-2:], [('error', False), ('delete', False)])
+        for row in concurrent[:20]:
+            self.assertIn(row['id'], ckan.packages)
+        # 9 old packages - 3 deleted + 20 new
+        self.assertEqual(len(ckan.packages), 26)
+
+    def test_skip_unchanged_updates(self):
+        with FakeCKAN() as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx')
+            destination.source = FakeSource()
+            f = write_results(destination_obj=destination)
+            created = list(f(get_rows(ckan_ids=[])))
+
+            # update with the same data.json datasets, just one changed
+            rows = []
+            for n, row in enumerate(created[:3]):
+                package = dict(ckan.packages[row['id']])
+                # same content in other order, CKAN values
+                package['extras'] = list(reversed(package['extras']))
+                package['metadata_modified'] = '2019-05-02T21:36:22.693792'
+                datajson_dataset = get_datajson_dataset(f'new-{n}')
+                if n == 1:
+                    datajson_dataset['title'] = 'New title'
+                package['comparison_results'] = {'action': 'update', 'ckan_id': package['id'],
+                                                 'new_data': datajson_dataset}
+                rows.append(package)
+
+            requests = len(ckan.requests)
+            results = list(f(rows))
+            self.assertEqual(len(ckan.requests) - requests, 1)
+            stats = destination.get_stats()
+
+        actions = [row['comparison_results']['action'] for row in results]
+        self.assertEqual(actions, ['ignore', 'update', 'ignore'])
+        self.assertEqual(results[0]['comparison_results']['reason'], 'No changes at the CKAN package')
+        self.assertTrue(results[0]['comparison_results']['action_results']['success'])
+        self.assertEqual(stats['avoided_writes'], 2)
+
+    def test_save_changed_source_hash(self):
+        tmp_folder = tempfile.TemporaryDirectory()
+        staging_path = os.path.join(tmp_folder.name, 'staging.db')
+        store = StagingStore(path=staging_path)
+        store.add_many([get_datajson_dataset(f'new-{n}') for n in range(3)])
+        store.close()
+
+        def harvest(ckan, destination):
+            """ compare the CKAN packages with the staged datasets and write the results """
+            packages = [dict(package) for package in ckan.packages.values()]
+            rows = list(compare_resources(staging_path=staging_path)(packages))
+            list(write_results(destination_obj=destination, staging_path=staging_path)(rows))
+            return rows
+
+        with FakeCKAN() as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx')
+            destination.source = FakeSource()
+            harvest(ckan, destination)
+            # the source datasets changed, but not the CKAN packages
+            for package in ckan.packages.values():
+                package['extras'] = [dict(extra, value='previous-hash') if extra['key'] == 'source_hash' else extra
+                                     for extra in package['extras']]
+
+            requests = len(ckan.requests)
+            second = harvest(ckan, destination)
+            actions = [action for action, client in ckan.requests[requests:]]
+            third = harvest(ckan, destination)
+            destination.close()
+
+        tmp_folder.cleanup()
+        # just the new hash is saved
+        self.assertEqual([row['comparison_results']['reason'] for row in second], ['Just the source hash changed'] * 3)
+        self.assertEqual(actions, ['package_patch'] * 3)
+        # the next harvest has nothing to do
+        self.assertEqual([row['comparison_results']['action'] for row in third], ['ignore'] * 3)
+
+    def test_changed_fields(self):
+        existing = {'id': 'xxxx',
+                    'title': 'Dataset',
+                    'notes': '',
+                    'metadata_modified': '2019-05-02T21:36:22.693792',
+                    'tags': [{'name': 'b', 'id': '1'}, {'name': 'a', 'id': '2'}],
+                    'extras': [{'key': 'source_hash', 'value': 'old'}, {'key': 'flag', 'value': 'True'}],
+                    'resources': [{'id': '1', 'url': 'http://b.com', 'position': 0},
+                                  {'id': '2', 'url': 'http://a.com', 'position': 1}]}
+        new = {'title': 'Dataset',
+               'tag_string': 'a,b',
+               'extras': [{'key': 'flag', 'value': True}, {'key': 'source_hash', 'value': 'new'}],
+               'resources': [{'url': 'http://a.com'}, {'url': 'http://b.com', 'description': ''}]}
+        self.assertEqual(get_changed_fields(existing, new), [])
+
+        new['resources'].append({'url': 'http://c.com'})
+        new['notes'] = 'Some notes'
+        self.assertEqual(get_changed_fields(existing, new), ['notes', 'resources'])
+
+    def test_patch_updates(self):
+        with FakeCKAN() as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx',
+                                                 config={'ckan_patch_updates': True})
+            destination.source = FakeSource()
+            f = write_results(destination_obj=destination)
+            created = list(f(get_rows(ckan_ids=[])[:1]))
+            ckan_id = created[0]['id']
+
+            package = dict(ckan.packages[ckan_id])
+            datajson_dataset = dict(get_datajson_dataset('new-0'), title='New title')
+            package['comparison_results'] = {'action': 'update', 'ckan_id': ckan_id, 'new_data': datajson_dataset}
+            results = list(f([package]))
+
+        self.assertTrue(results[0]['comparison_results']['action_results']['success'])
+        self.assertEqual(ckan.requests[-1][0], 'package_patch')
+        self.assertEqual(ckan.packages[ckan_id]['title'], 'New title')
+        self.assertEqual(ckan.packages[ckan_id]['notes'], 'Some description')
+
+    def test_package_patch(self):
+        existing = {'id': 'xxxx',
+                    'title': 'Dataset',
+                    'notes': 'Old notes',
+                    'tags': [{'name': 'a'}],
+                    'extras': [{'key': 'source_hash', 'value': 'old'},
+                               {'key': 'collection_package_id', 'value': 'yyyy'}],
+                    'resources': [{'id': '1', 'url': 'http://a.com'}]}
+        new = {'title': 'New title',
+               'tag_string': 'a',
+               'extras': [{'key': 'source_hash', 'value': 'new'}],
+               'resources': [{'id': '1', 'url': 'http://a.com'}]}
+        changed_fields = get_changed_fields(existing, new)
+        self.assertEqual(changed_fields, ['notes', 'title'])
+        patch = get_package_patch(existing, new, changed_fields)
+        self.assertEqual(patch, {'id': 'xxxx',
+                                 'title': 'New title',
+                                 'notes': '',
+                                 'extras': [{'key': 'source_hash', 'value': 'new'},
+                                            {'key': 'collection_package_id', 'value': 'yyyy'}]})
+
+    def test_upsert_name_collisions(self):
+        with FakeCKAN() as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx',
+                                                 config={'ckan_on_duplicated': 'UPSERT'})
+            destination.source = FakeSource()
+            f = write_results(destination_obj=destination)
+            created = list(f(get_rows(ckan_ids=[])[:3]))
+            # create again (e.g. the previous results were lost)
+            again = list(f(get_rows(ckan_ids=[])[:3]))
+
+        self.assertEqual([row['id'] for row in created], [row['id'] for row in again])
+        self.assertEqual(len(ckan.packages), 3)
+        for row in again:
+            self.assertTrue(row['comparison_results']['action_results']['success'])
+            self.assertTrue(row['comparison_results']['action_results']['name_collision'])
+        self.assertFalse(created[0]['comparison_results']['action_results']['name_collision'])
+
+    def test_parents_first(self):
+        with FakeCKAN() as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx',
+                                                 config={'ckan_write_workers': 4})
+            destination.source = FakeSource()
+            res = destination.get_ckan_api().create_package(ckan_package={'name': 'Dataset-old', 'title': 'Old'})
+            ckan_id = res['result']['id']
+
+            rows = []
+            for n in range(3):
+                rows.append({'comparison_results': {'action': 'create',
+                                                    'ckan_id': None,
+                                                    'new_data': dict(get_datajson_dataset(f'child-{n}'),
+                                                                     isPartOf='parent')}})
+            rows.append({'id': ckan_id, 'resources': [],
+                         'comparison_results': {'action': 'update', 'ckan_id': ckan_id,
+                                                'new_data': dict(get_datajson_dataset('old'), id=ckan_id,
+                                                                isPartOf='parent')}})
+            rows.append({'comparison_results': {'action': 'create',
+                                                'ckan_id': None,
+                                                'new_data': get_datajson_dataset('parent')}})
+
+            requests = len(ckan.requests)
+            steps = [order_parents_first(), write_results(destination), assing_collection_pkg_id(destination)]
+            for step in steps:
+                rows = step(rows)
+            rows = list(rows)
+            actions = [action for action, client in ckan.requests[requests:]]
+
+        self.assertEqual(rows[0]['comparison_results']['new_data']['identifier'], 'parent')
+        parent_id = rows[0]['id']
+        for row in rows[1:]:
+            self.assertTrue(row['comparison_results']['action_results']['success'])
+            extras = {extra['key']: extra['value'] for extra in ckan.packages[row['id']]['extras']}
+            self.assertEqual(extras['collection_package_id'], parent_id)
+        # no second pass to save the collection ID
+        self.assertEqual(sorted(actions), ['package_create'] * 4 + ['package_update'])
+
+    def test_order_parents_first_streams(self):
+        consumed = []
+
+        def rows():
+            for identifier, parent in [('a', None), ('child', 'parent'), ('parent', None), ('b', None),
+                                       ('orphan', 'not-found'), ('c', None)]:
+                consumed.append(identifier)
+                new_data = dict(get_datajson_dataset(identifier), isPartOf=parent)
+                yield {'comparison_results': {'action': 'create', 'ckan_id': None, 'new_data': new_data}}
+
+        ordered = order_parents_first()(rows())
+        self.assertEqual(next(ordered)['comparison_results']['new_data']['identifier'], 'a')
+        # we don't read all the rows before writing
+        self.assertEqual(consumed, ['a'])
+        identifiers = [row['comparison_results']['new_data']['identifier'] for row in ordered]
+        self.assertEqual(identifiers, ['parent', 'child', 'b', 'c', 'orphan'])
+
+    def test_collection_ids_second_pass(self):
+        with FakeCKAN() as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx',
+                                                 config={'ckan_write_workers': 4})
+            destination.source = FakeSource()
+            # datasets before the collection (not ordered)
+            rows = []
+            for n in range(5):
+                rows.append({'comparison_results': {'action': 'create',
+                                                    'ckan_id': None,
+                                                    'new_data': dict(get_datajson_dataset(f'child-{n}'),
+                                                                     isPartOf='parent')}})
+            rows.append({'comparison_results': {'action': 'create',
+                                                'ckan_id': None,
+                                                'new_data': dict(get_datajson_dataset('orphan'),
+                                                                 isPartOf='unknown')}})
+            rows.append({'comparison_results': {'action': 'create',
+                                                'ckan_id': None,
+                                                'new_data': get_datajson_dataset('parent')}})
+
+            rows = list(assing_collection_pkg_id(destination)(write_results(destination)(rows)))
+            actions = [action for action, client in ckan.requests]
+
+        parent_id = rows[0]['id']
+        self.assertEqual(rows[0]['comparison_results']['new_data']['identifier'], 'parent')
+        for row in rows[1:6]:
+            self.assertEqual(row['comparison_results']['action_results']['errors'], [])
+            extras = {extra['key']: extra['value'] for extra in ckan.packages[row['id']]['extras']}
+            self.assertEqual(extras['collection_package_id'], parent_id)
+            self.assertEqual(extras['identifier'], row['comparison_results']['new_data']['identifier'])
+        self.assertIn('Unable to detect the collection_pkg_id', rows[6]['comparison_results']['action_results']['errors'][0])
+        # just one patch per dataset, no package_show
+        self.assertEqual(actions, ['package_create'] * 7 + ['package_patch'] * 5)
+
+    def test_resume_with_journal(self):
+        tmp_folder = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_folder.name, 'write-journal.jsonl')
+        with FakeCKAN() as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx')
+            destination.source = FakeSource()
+
+            # the harvest stops after writing 5 rows
+            journal = WriteJournal(path=path)
+            rows = write_results(destination_obj=destination, journal=journal)(get_rows(ckan_ids=[]))
+            first = [next(rows) for n in range(5)]
+            journal.close()
+
+            journal = WriteJournal(path=path, resume=True)
+            results = list(write_results(destination_obj=destination, journal=journal)(get_rows(ckan_ids=[])))
+            journal.close()
+
+        tmp_folder.cleanup()
+        self.assertEqual(len(results), 20 + 2)
+        resumed = [row for row in results if row['comparison_results']['action_results'].get('resumed', False)]
+        self.assertEqual([row['id'] for row in resumed], [row['id'] for row in first])
+        for row in results[:20]:
+            self.assertTrue(row['comparison_results']['action_results']['success'])
+            self.assertIn(row['id'], ckan.packages)
+        self.assertEqual(len(ckan.packages), 20)
+
+    def test_resume_with_other_action(self):
+        """ a journal entry is done just for the same action """
+        tmp_folder = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_folder.name, 'write-journal.jsonl')
+        with FakeCKAN() as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx')
+            destination.source = FakeSource()
+
+            journal = WriteJournal(path=path)
+            rows = get_rows(ckan_ids=[])[:1]
+            created = list(write_results(destination_obj=destination, journal=journal)(rows))
+            journal.close()
+            ckan_id = created[0]['id']
+
+            # now the same dataset must be deleted
+            journal = WriteJournal(path=path, resume=True)
+            rows = [{'id': ckan_id,
+                     'extras': [{'key': 'identifier', 'value': 'new-0'}],
+                     'comparison_results': {'action': 'delete', 'ckan_id': ckan_id, 'new_data': None}}]
+            results = list(write_results(destination_obj=destination, journal=journal)(rows))
+            journal.close()
+            journal = WriteJournal(path=path, resume=True)
+            journal.close()
+            actions = [action for action, client in ckan.requests]
+
+        tmp_folder.cleanup()
+        action_results = results[0]['comparison_results']['action_results']
+        self.assertTrue(action_results['success'])
+        self.assertNotIn('resumed', action_results)
+        self.assertEqual(actions, ['package_create', 'package_delete'])
+        self.assertEqual(sorted(action for key, action in journal.done), ['create', 'delete'])
+
+    def test_write_from_staging_references(self):
+        tmp_folder = tempfile.TemporaryDirectory()
+        staging_path = os.path.join(tmp_folder.name, 'staging.db')
+        store = StagingStore(path=staging_path)
+        datasets = [get_datajson_dataset(f'new-{n}') for n in range(3)]
+        store.add_many(datasets)
+        rows = [{'comparison_results': {'action': 'create',
+                                        'ckan_id': None,
+                                        'new_data': get_new_data_reference(dataset)}} for dataset in datasets]
+        # the dataset changed after the comparison
+        store.update('new-2', {'title': 'New title'})
+        store.close()
+
+        self.assertEqual(set(rows[0]['comparison_results']['new_data'].keys()), {'identifier', 'staged_hash'})
+        with FakeCKAN() as ckan:
+            destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                                 api_key='xxxx',
+                                                 organization_id='xxxx',
+                                                 harvest_source_id='xxxx')
+            destination.source = FakeSource()
+            results = list(write_results(destination_obj=destination, staging_path=staging_path)(rows))
+            destination.close()
+
+        tmp_folder.cleanup()
+        for row in results[:2]:
+            self.assertTrue(row['comparison_results']['action_results']['success'])
+            identifier = row['comparison_results']['new_data']['identifier']
+            self.assertEqual(ckan.packages[row['id']]['title'], f'Dataset {identifier}')
+            # just the reference at the results
+            self.assertNotIn('title', row['comparison_results']['new_data'])
+        self.assertFalse(results[2]['comparison_results']['action_results']['success'])
+        self.assertIn('changed at the staging store', results[2]['comparison_results']['action_results']['errors'][0])
+        self.assertEqual(len(ckan.packages), 2)
@@ -0,0 +1,78 @@
+"""
+Benchmark the CKAN writer (write_results) against a local fake CKAN API with latency
+    python -m tools.benchmark_ckan_writer --rows 500 --latency 0.05 --workers 1 4 16
+"""
+import argparse
+import logging
+import time
+
+from harvester_ng.harvest_destination import CKANHarvestDestination
+from harvester_ng.datajson.flows_ckan import write_results
+from tools.fake_ckan import FakeCKAN
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--rows", type=int, default=500, help="Datasets to create, update and delete")
+parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to each CKAN API response")
+parser.add_argument("--workers", type=int, nargs='+', default=[1, 4, 16], help="Concurrent CKAN calls to test")
+args = parser.parse_args()
+
+# we don't want to measure the logs
+logging.disable(logging.CRITICAL)
+
+
+class BenchmarkSource:
+    name = 'Benchmark source'
+
+
+def get_datajson_dataset(identifier):
+    return {'identifier': identifier,
+            'title': f'Dataset {identifier}',
+            'description': 'Benchmark dataset',
+            'modified': '2019-01-01',
+            'publisher': {'name': 'Benchmark'},
+            'contactPoint': {'fn': 'Benchmark', 'hasEmail': 'mailto:benchmark@example.com'},
+            'keyword': ['benchmark'],
+            'bureauCode': ['005:00'],
+            'programCode': ['005:000'],
+            'accessLevel': 'public',
+            'headers': {'schema_version': '1.1'}}
+
+
+def run(workers):
+    with FakeCKAN(latency=args.latency) as ckan:
+        destination = CKANHarvestDestination(catalog_url=ckan.url,
+                                             api_key='xxxx',
+                                             organization_id='xxxx',
+                                             harvest_source_id='xxxx',
+                                             config={'ckan_write_workers': workers})
+        destination.source = BenchmarkSource()
+
+        # create all of them, then update and delete all of them
+        create_rows = [{'comparison_results': {'action': 'create',
+                                               'ckan_id': None,
+                                               'new_data': get_datajson_dataset(str(n))}}
+                       for n in range(args.rows)]
+        start = time.perf_counter()
+        created = list(write_results(destination_obj=destination)(create_rows))
+        update_rows = [{'id': row['id'],
+                        'resources': [],
+                        'comparison_results': {'action': 'update',
+                                               'ckan_id': row['id'],
+                                               'new_data': get_datajson_dataset(str(n))}}
+                       for n, row in enumerate(created)]
+        list(write_results(destination_obj=destination)(update_rows))
+        delete_rows = [{'id': row['id'],
+                        'comparison_results': {'action': 'delete', 'ckan_id': row['id'], 'new_data': None}}
+                       for row in created]
+        list(write_results(destination_obj=destination)(delete_rows))
+        elapsed = time.perf_counter() - start
+        destination.close()
+
+    calls = args.rows * 3
+    print(f'workers: {workers:3d} | {calls} calls in {elapsed:7.2f}s | {calls / elapsed:8.1f} calls/s')
+
+
+print(f'Fake CKAN latency: {args.latency}s')
+for workers in args.workers:
+    run(workers)
@@ -0,0 +1,200 @@
+"""
+In-memory CKAN API (just the package actions we use) for tests and benchmarks.
+It runs an HTTP/1.1 server (keep-alive) in a thread and it could add latency to each request
+"""
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeCKANHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send headers and body together (avoid delayed ACK waits with keep-alive)
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_params(self):
+        url = urlparse(self.path)
+        params = self.parse_query(url.query)
+        length = int(self.headers.get('Content-Length', 0))
+        if length > 0:
+            body = self.rfile.read(length).decode('utf-8')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body))
+            else:
+                params.update(self.parse_query(body))
+        return url.path.split('/')[-1], params
+
+    def parse_query(self, query):
+        """ repeated params (e.g. "fl") are lists """
+        return {k: v if len(v) > 1 or k == 'fl' else v[0] for k, v in parse_qs(query).items()}
+
+    def send_json(self, status, data):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_action(self):
+        action, params = self.read_params()
+        self.server.ckan.register_request(action=action, client=self.client_address)
+        if self.server.ckan.latency > 0:
+            time.sleep(self.server.ckan.latency)
+        failure = self.server.ckan.get_failure()
+        if failure is not None:
+            self.send_json(failure, {'success': False, 'error': {'message': 'Service unavailable'}})
+            return
+        status, data = self.server.ckan.run_action(action, params)
+        lost_response = self.server.ckan.get_lost_response()
+        if lost_response is not None:
+            self.send_json(lost_response, {'success': False, 'error': {'message': 'Gateway timeout'}})
+            return
+        self.send_json(status, data)
+
+    do_GET = handle_action
+    do_POST = handle_action
+
+
+class FakeCKAN:
+    """ fake CKAN catalog. Use as a context manager
+        with FakeCKAN(latency=0.05) as ckan:
+            ckan.url  # base URL for the API
+            ckan.packages  # dict with all the packages (by ID)
+        ckan.failures  # list of HTTP status codes to return for the next requests
+        ckan.lost_responses  # like failures, but the action runs (e.g. a timeout at a proxy) """
+
+    def __init__(self, latency=0, failures=None, max_rows=1000, lost_responses=None):
+        self.latency = latency
+        # like ckan.search.rows_max
+        self.max_rows = max_rows
+        self.failures = failures or []
+        self.lost_responses = lost_responses or []
+        self.packages = {}
+        self.requests = []  # list of (action, client address)
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCKANHandler)
+        self.server.daemon_threads = True
+        self.server.ckan = self
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def register_request(self, action, client):
+        with self.lock:
+            self.requests.append((action, client))
+
+    def get_failure(self):
+        with self.lock:
+            return self.failures.pop(0) if len(self.failures) > 0 else None
+
+    def get_lost_response(self):
+        with self.lock:
+            return self.lost_responses.pop(0) if len(self.lost_responses) > 0 else None
+
+    def get_package(self, id_or_name):
+        for package in self.packages.values():
+            if id_or_name in [package['id'], package['name']]:
+                return package
+        return None
+
+    def now(self):
+        """ like CKAN: naive UTC dates """
+        return datetime.utcnow().isoformat()
+
+    def project_package(self, package, fields):
+        """ just some fields from the package (like Solr) """
+        extras = {extra['key']: extra['value'] for extra in package.get('extras', [])}
+        result = {}
+        for field in fields:
+            if field.startswith('extras_'):
+                if field[len('extras_'):] in extras:
+                    result[field] = extras[field[len('extras_'):]]
+            elif field in package:
+                result[field] = package[field]
+        return result
+
+    def run_action(self, action, params):
+        """ Returns: HTTP status, JSON response """
+        with self.lock:
+            if action == 'package_create':
+                if self.get_package(params['name']) is not None:
+                    return 409, {'success': False, 'error': {'name': ['That URL is already in use.']}}
+                package = dict(params, id=str(uuid.uuid4()), metadata_modified=self.now())
+                self.packages[package['id']] = package
+                return 200, {'success': True, 'result': package}
+
+            if action == 'package_update':
+                package = self.get_package(params.get('id', params.get('name')))
+                if package is None:
+                    return 404, {'success': False, 'error': {'message': 'Not found'}}
+                package = dict(params, id=package['id'], metadata_modified=self.now())
+                self.packages[package['id']] = package
+                return 200, {'success': True, 'result': package}
+
+            if action == 'package_patch':
+                package = self.get_package(params['id'])
+                if package is None:
+                    return 404, {'success': False, 'error': {'message': 'Not found'}}
+                package = dict(package, **dict(params, id=package['id'], metadata_modified=self.now()))
+                self.packages[package['id']] = package
+                return 200, {'success': True, 'result': package}
+
+            if action == 'package_show':
+                package = self.get_package(params['id'])
+                if package is None:
+                    return 404, {'success': False, 'error': {'message': 'Not found'}}
+                return 200, {'success': True, 'result': package}
+
+            if action == 'package_delete':
+                package = self.get_package(params['id'])
+                if package is None:
+                    return 404, {'success': False, 'error': {'message': 'Not found'}}
+                del self.packages[package['id']]
+                return 200, {'success': True, 'result': None}
+
+            if action == 'package_search':
+                start = int(params.get('start', 0))
+                rows = min(self.max_rows, int(params.get('rows', 10)))
+                sort = params.get('sort', 'id asc')
+                if sort == 'metadata_modified asc':
+                    packages = sorted(self.packages.values(), key=lambda package: (package['metadata_modified'],
+                                                                                  package['id']))
+                else:
+                    packages = sorted(self.packages.values(), key=lambda package: package['id'])
+                # filter by ID: id:("ID1" OR "ID2")
+                fq = params.get('fq', '')
+                if fq.startswith('id:'):
+                    ids = re.findall(r'"([^"]+)"', fq)
+                    packages = [package for package in packages if package['id'] in ids]
+                # filter by date: +metadata_modified:[2019-05-02T21:36:22.693Z TO *]
+                modified_since = re.search(r'metadata_modified:\[(\S+) TO \*\]', fq)
+                if modified_since is not None:
+                    since = modified_since.group(1).rstrip('Z')
+                    packages = [package for package in packages if package['metadata_modified'] >= since]
+                results = packages[start:start + rows]
+                if 'fl' in params:
+                    results = [self.project_package(package, params['fl']) for package in results]
+                return 200, {'success': True,
+                             'result': {'count': len(packages),
+                                        'sort': sort,
+                                        'facets': {},
+                                        'results': results}}
+
+        return 400, {'success': False, 'error': {'message': f'Unknown action {action}'}}
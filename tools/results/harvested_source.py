@@ -2,6 +2,7 @@ import logging
 import os
 from jinja2 import Template
 
+from harvester_ng import helpers
 from harvester_ng.logs import logger
 
 
@@ -13,8 +14,9 @@ class HarvestedSource:
     analyze all data from a particular previously harvested source
     """
     name = None  # source name (and folder name)
-    data = None  # data dict
-    results = None  # harvest results
+    data = None  # data.json summary (catalog values and datasets count)
+    results_file = None  # harvest results (JSON lines)
+    results_count = 0  # rows at results_file
     errors = None
     final_results = {}  # all files processed
 
@@ -23,8 +25,16 @@ class HarvestedSource:
         self.name = self.harvest_source.name
         data = self.harvest_source.get_report_files()
         self.data = data['data']
-        self.results = data['results']
+        self.results_file = data['results_file']
         self.errors = data['errors']
+        self.duplicates = data.get('duplicates', None)
+        self.timings = data.get('timings', None)
+        self.destination_stats = data.get('destination_stats', None)
+        # the source didn't change, previous results are not from this harvest
+        self.no_op = getattr(self.harvest_source, 'source_unchanged', False)
+        if self.no_op:
+            self.results_file = None
+            self.destination_stats = None
 
     def process_results(self):
 
@@ -34,36 +44,24 @@ class HarvestedSource:
         validation_errors = []
         action_errors = []
         action_warnings = []
-        # print(f'Result: {self.results}')
-        if type(self.results) != list:
-            logger.error(f'Unexpected results: {self.results}')
+        self.results_count = 0
+        if self.no_op:
+            results = []
+        elif self.results_file is None or not os.path.isfile(self.results_file):
+            logger.error(f'Missing results file: {self.results_file}')
+            return False
+        else:
+            # one row in memory at a time
+            results = helpers.read_rows(self.results_file)
+
+        try:
+            for result in results:
+                self.results_count += 1
+                if not self.process_result(result, actions, validation_errors, action_warnings, action_errors):
+                    return False
+        except ValueError as e:
+            logger.error(f'Unexpected results at {self.results_file}: {e}')
             return False
-
-        for result in self.results:
-
-            # print(f'Result: {result}')
-            comparison_results = result.get('comparison_results', None)
-            if comparison_results is None:
-                # this is bad. This source is broken
-                return False
-            action = comparison_results['action']
-            if action not in actions.keys():
-                actions[action] = {'total': 0, 'success': 0, 'fails': 0}
-            actions[action]['total'] += 1
-
-            if action in ['create', 'update']:  # delete has no new_data
-                if len(comparison_results['new_data'].get('validation_errors', [])) > 0:
-                    validation_errors += comparison_results['new_data']['validation_errors']
-
-            action_results = comparison_results.get('action_results', {})
-            success = action_results.get('success', False)
-            if success:
-                actions[action]['success'] += 1
-            else:
-                actions[action]['fails'] += 1
-
-            action_warnings += action_results.get('warnings', [])
-            action_errors += action_results.get('errors', [])
 
         self.final_results['actions'] = actions
         self.final_results['validation_errors'] = validation_errors
@@ -72,12 +70,52 @@ class HarvestedSource:
 
         return True
 
+    def process_result(self, result, actions, validation_errors, action_warnings, action_errors):
+        """ count one row from the results """
+        # print(f'Result: {result}')
+        comparison_results = result.get('comparison_results', None)
+        if comparison_results is None:
+            # this is bad. This source is broken
+            return False
+        action = comparison_results['action']
+        if action not in actions.keys():
+            actions[action] = {'total': 0, 'success': 0, 'fails': 0}
+        actions[action]['total'] += 1
+
+        if action in ['create', 'update']:  # delete has no new_data
+            if len(comparison_results['new_data'].get('validation_errors', [])) > 0:
+                validation_errors += comparison_results['new_data']['validation_errors']
+
+        action_results = comparison_results.get('action_results', {})
+        success = action_results.get('success', False)
+        if success:
+            actions[action]['success'] += 1
+        else:
+            actions[action]['fails'] += 1
+        if action_results.get('name_collision', False):
+            actions[action]['collisions'] = actions[action].get('collisions', 0) + 1
+
+        action_warnings += action_results.get('warnings', [])
+        action_errors += action_results.get('errors', [])
+
+        return True
+
+    def has_fails(self):
+        """ some action failed (call after process_results) """
+        actions = self.final_results.get('actions', {})
+        return len([a for a in actions.values() if a['fails'] > 0]) > 0
+
     def get_json_data(self):
         data = {
             'name': self.name,
+            'status': 'no-op' if self.no_op else 'harvested',
             'data': self.data,
-            'results': self.results,
+            'results_file': self.results_file,
+            'results_count': self.results_count,
             'errors': self.errors,
+            'duplicates': self.duplicates,
+            'timings': self.timings,
+            'destination_stats': self.destination_stats,
             'actions': self.final_results.get('actions', {}),
             'validation_errors': self.final_results.get('validation_errors', {}),
             'action_warnings': self.final_results.get('action_warnings', {}),